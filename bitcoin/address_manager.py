@@ -0,0 +1,469 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import array
+import mmap
+import os
+import random
+import socket
+import struct
+import sys
+import time
+import zlib
+
+import logmanager.logmanager
+import bitcoin.handler
+import bitcoin.message
+
+LM = logmanager.logmanager
+Messages = bitcoin.message
+
+
+class AddressFileError(Exception): pass
+
+FREE, NEW, TRIED = range(3)
+
+# key (16 byte address and big endian port), services, last seen, last attempt, successes, failures, table, position
+RECORD = struct.Struct(b"<18sQIIHHBI")
+KEY_SIZE = 18
+PORT = struct.Struct(b">H")
+
+NEW_BUCKETS = 1024
+TRIED_BUCKETS = 256
+
+# Addresses from one network group a bucket may hold, which limits how much of a table a single group can fill
+BUCKET_SIZE = 1024
+
+MAX_ADDRESSES = 0x400000
+MAX_FAILURES = 10
+
+# Oldest last seen time accepted from gossip
+HORIZON = 30 * 24 * 60 * 60
+
+INITIAL_INDEX_SIZE = 1024
+
+SNAPSHOT_MAGIC = b"PCAM"
+SNAPSHOT_VERSION = 1
+# magic, version, record count, index size, new count, tried count, free count
+SNAPSHOT_HEADER = struct.Struct(b"<4sIIIIII")
+ITEM_SIZE = array.array(b'I').itemsize
+
+SAVE_INTERVAL = 300
+
+IP4_PREFIX = bytes(Messages.IP4_PREFIX)
+
+
+def get_key(address, port):
+    return bytes(address) + PORT.pack(port)
+
+
+def get_group(address):
+    """Gets the network group of an address, the /16 for IP4 and the /32 for IP6"""
+    address = bytes(address)
+    if address[0:12] == IP4_PREFIX:
+        return b"\x04" + address[12:14]
+    return b"\x06" + address[0:4]
+
+
+def get_bucket(group, buckets):
+    return (zlib.crc32(group) & 0xFFFFFFFF) % buckets
+
+
+def host_to_address(host):
+    """Converts a numeric host to its 16 byte address, returns None for names"""
+    if host.count(".") == 3:
+        try:
+            return IP4_PREFIX + socket.inet_aton(host)
+        except socket.error:
+            return None
+    try:
+        return socket.inet_pton(socket.AF_INET6, host)
+    except (socket.error, AttributeError, ValueError):
+        return None
+
+
+def address_to_host(address):
+    address = bytes(address)
+    if address[0:12] == IP4_PREFIX:
+        return socket.inet_ntoa(address[12:16])
+    return socket.inet_ntop(socket.AF_INET6, address)
+
+
+def _hash_key(key):
+    return zlib.crc32(key) & 0xFFFFFFFF
+
+
+class AddressManager(object):
+    """ Store of known peer addresses, kept in packed arrays so that it can hold millions of them
+
+    Each address is a fixed size RECORD in a single bytearray. An open addressing hash table of record slots finds
+    an address by its key and each of the new and tried tables is a dense array of slots, so a random address can
+    be selected from either table in constant time and removed by moving the last entry into its place. Addresses
+    start in the new table and move to the tried table once a connection to them succeeds. Each table is split
+    into buckets by network group and a full bucket accepts no more addresses, so no single group can crowd out
+    the others.
+
+    All of the arrays are written to a snapshot with save() and load() copies them straight back, without
+    rebuilding anything.
+    """
+
+    def __init__(self, max_addresses=MAX_ADDRESSES, new_buckets=NEW_BUCKETS, tried_buckets=TRIED_BUCKETS,
+                 bucket_size=BUCKET_SIZE):
+        self.__max_addresses = max_addresses
+        self.__bucket_size = bucket_size
+        self.__records = bytearray()
+        self.__slot_count = 0
+        self.__free = array.array(b'I')
+        self.__index = array.array(b'i', [-1]) * INITIAL_INDEX_SIZE
+        self.__tables = [None, array.array(b'I'), array.array(b'I')]
+        self.__buckets = [None, array.array(b'I', [0]) * new_buckets, array.array(b'I', [0]) * tried_buckets]
+
+    def __len__(self):
+        return len(self.__tables[NEW]) + len(self.__tables[TRIED])
+
+    def get_counts(self):
+        """Gets the number of (new, tried) addresses"""
+        return len(self.__tables[NEW]), len(self.__tables[TRIED])
+
+    def add(self, records, t=None):
+        """Adds a batch of (timestamp, services, address, port) ADDRESS_RECORD tuples, such as the addresses of an
+        addr message, and returns the number of new addresses
+
+        Duplicates within the batch are dropped before the table is searched. Known addresses have their last
+        seen time and services updated.
+        """
+        if t is None:
+            t = time.time()
+        now = int(t)
+        horizon = now - HORIZON
+        records_buf = self.__records
+        size = RECORD.size
+        added = 0
+        seen = set()
+        for timestamp, services, address, port in records:
+            key = bytes(address) + bytes(port)
+            if key in seen:
+                continue
+            seen.add(key)
+            if timestamp > now:
+                timestamp = now
+            elif timestamp < horizon:
+                continue
+            pos, slot = self.__find(key)
+            if slot >= 0:
+                offset = slot * size
+                record = RECORD.unpack_from(records_buf, offset)
+                if timestamp > record[2] or services & ~record[1]:
+                    RECORD.pack_into(records_buf, offset, key, record[1] | services, max(timestamp, record[2]),
+                                     *record[3:])
+                continue
+            if self.__insert(key, services, timestamp, pos) is not None:
+                added += 1
+                records_buf = self.__records
+        return added
+
+    def add_host(self, host, port, services=0, timestamp=None):
+        """Adds a single numeric host, names are ignored"""
+        address = host_to_address(host)
+        if address is None:
+            return 0
+        if timestamp is None:
+            timestamp = int(time.time())
+        return self.add([(timestamp, services, address, PORT.pack(port))], timestamp)
+
+    def select(self, tried_bias=0.5, exclude_groups=None, attempts=64):
+        """Selects a random address, from the tried table with probability tried_bias
+
+        Returns (host, port, group), or None if no address outside of exclude_groups was found.
+        """
+        new_table = self.__tables[NEW]
+        tried_table = self.__tables[TRIED]
+        for i in range(attempts):
+            if tried_table and (not new_table or random.random() < tried_bias):
+                table = tried_table
+            elif new_table:
+                table = new_table
+            else:
+                return None
+            offset = table[random.randrange(len(table))] * RECORD.size
+            key = bytes(self.__records[offset:offset + KEY_SIZE])
+            group = get_group(key[0:16])
+            if exclude_groups and group in exclude_groups:
+                continue
+            return address_to_host(key[0:16]), PORT.unpack(key[16:18])[0], group
+        return None
+
+    def get_addresses(self, count):
+        """Gets up to count random addresses as ADDRESS_RECORD tuples, for an addr message"""
+        new_table = self.__tables[NEW]
+        tried_table = self.__tables[TRIED]
+        total = len(new_table) + len(tried_table)
+        addresses = []
+        for i in random.sample(xrange(total), min(count, total)):
+            slot = new_table[i] if i < len(new_table) else tried_table[i - len(new_table)]
+            key, services, last_seen = RECORD.unpack_from(self.__records, slot * RECORD.size)[0:3]
+            addresses.append((last_seen, services, key[0:16], key[16:18]))
+        return addresses
+
+    def get(self, address, port):
+        """Gets (services, last seen, last attempt, successes, failures, table) for an address, or None"""
+        pos, slot = self.__find(get_key(address, port))
+        if slot < 0:
+            return None
+        return RECORD.unpack_from(self.__records, slot * RECORD.size)[1:7]
+
+    def mark_attempt(self, address, port, t=None):
+        """Records a failed connection attempt, addresses which keep failing are removed"""
+        pos, slot = self.__find(get_key(address, port))
+        if slot < 0:
+            return
+        offset = slot * RECORD.size
+        key, services, last_seen, last_try, successes, failures, table, position = \
+            RECORD.unpack_from(self.__records, offset)
+        failures += 1
+        if failures >= MAX_FAILURES:
+            self.__remove(pos, slot)
+            return
+        RECORD.pack_into(self.__records, offset, key, services, last_seen, int(time.time() if t is None else t),
+                         successes, min(failures, 0xFFFF), table, position)
+
+    def mark_good(self, address, port, t=None):
+        """Records a successful connection, moving the address to the tried table"""
+        key = get_key(address, port)
+        pos, slot = self.__find(key)
+        if slot < 0:
+            if len(self) >= self.__max_addresses:
+                return
+            slot = self.__insert(key, 0, 0, pos)
+            if slot is None:
+                return
+        now = int(time.time() if t is None else t)
+        offset = slot * RECORD.size
+        record = RECORD.unpack_from(self.__records, offset)
+        table = record[6]
+        position = record[7]
+        if table == NEW:
+            tried_bucket = get_bucket(get_group(key[0:16]), len(self.__buckets[TRIED]))
+            if self.__buckets[TRIED][tried_bucket] < self.__bucket_size:
+                self.__table_remove(NEW, slot, position, key)
+                table = TRIED
+                position = self.__table_add(TRIED, slot, key)
+        RECORD.pack_into(self.__records, offset, key, record[1], now, now, min(record[4] + 1, 0xFFFF), 0, table,
+                         position)
+
+    def save(self, path):
+        """Writes the tables to a snapshot file through a memory map, replacing the file once it is complete"""
+        sections = [self.__records[0:self.__slot_count * RECORD.size], self.__index.tostring(),
+                    self.__tables[NEW].tostring(), self.__tables[TRIED].tostring(), self.__free.tostring(),
+                    self.__buckets[NEW].tostring(), self.__buckets[TRIED].tostring()]
+        size = SNAPSHOT_HEADER.size + sum(len(section) for section in sections)
+        temp_path = path + ".tmp"
+        with open(temp_path, "w+b") as f:
+            f.truncate(size)
+            m = mmap.mmap(f.fileno(), size)
+            try:
+                SNAPSHOT_HEADER.pack_into(m, 0, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.__slot_count, len(self.__index),
+                                          len(self.__tables[NEW]), len(self.__tables[TRIED]), len(self.__free))
+                offset = SNAPSHOT_HEADER.size
+                for section in sections:
+                    m[offset:offset + len(section)] = bytes(section)
+                    offset += len(section)
+                m.flush()
+            finally:
+                m.close()
+        if sys.platform == 'win32' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+
+    def load(self, path):
+        """Replaces the tables with a snapshot written by save()"""
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < SNAPSHOT_HEADER.size:
+                raise AddressFileError("Address file %s is truncated" % path)
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                magic, version, slot_count, index_size, new_count, tried_count, free_count = \
+                    SNAPSHOT_HEADER.unpack_from(m, 0)
+                if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                    raise AddressFileError("Address file %s has an unknown format" % path)
+                sizes = [slot_count * RECORD.size] + [count * ITEM_SIZE for count in
+                                                      (index_size, new_count, tried_count, free_count,
+                                                       len(self.__buckets[NEW]), len(self.__buckets[TRIED]))]
+                if SNAPSHOT_HEADER.size + sum(sizes) != size:
+                    raise AddressFileError("Address file %s is truncated" % path)
+                sections = []
+                offset = SNAPSHOT_HEADER.size
+                for section_size in sizes:
+                    sections.append(m[offset:offset + section_size])
+                    offset += section_size
+            finally:
+                m.close()
+        self.__records = bytearray(sections[0])
+        self.__slot_count = slot_count
+        self.__index = self.__load_array(b'i', sections[1])
+        self.__tables = [None, self.__load_array(b'I', sections[2]), self.__load_array(b'I', sections[3])]
+        self.__free = self.__load_array(b'I', sections[4])
+        self.__buckets = [None, self.__load_array(b'I', sections[5]), self.__load_array(b'I', sections[6])]
+
+    @staticmethod
+    def __load_array(code, data):
+        a = array.array(code)
+        a.fromstring(data)
+        return a
+
+    def __find(self, key):
+        """Finds a key in the index, returns (index position, slot), the slot is -1 and the position is where the
+        key would be inserted if it is not present"""
+        index = self.__index
+        mask = len(index) - 1
+        records = self.__records
+        size = RECORD.size
+        pos = _hash_key(key) & mask
+        while True:
+            slot = index[pos]
+            if slot < 0:
+                return pos, -1
+            offset = slot * size
+            if records[offset:offset + KEY_SIZE] == key:
+                return pos, slot
+            pos = (pos + 1) & mask
+
+    def __insert(self, key, services, timestamp, pos):
+        """Adds a new address to the new table, pos is the free index position found for its key"""
+        if len(self) >= self.__max_addresses:
+            return None
+        bucket = get_bucket(get_group(key[0:16]), len(self.__buckets[NEW]))
+        if self.__buckets[NEW][bucket] >= self.__bucket_size:
+            return None
+        if (self.__slot_count - len(self.__free) + 1) * 2 > len(self.__index):
+            self.__grow_index()
+            pos = self.__find(key)[0]
+        if self.__free:
+            slot = self.__free.pop()
+        else:
+            slot = self.__slot_count
+            self.__slot_count += 1
+            self.__records.extend(bytearray(RECORD.size))
+        position = self.__table_add(NEW, slot, key)
+        RECORD.pack_into(self.__records, slot * RECORD.size, key, services, timestamp, 0, 0, 0, NEW, position)
+        self.__index[pos] = slot
+        return slot
+
+    def __remove(self, pos, slot):
+        offset = slot * RECORD.size
+        record = RECORD.unpack_from(self.__records, offset)
+        self.__table_remove(record[6], slot, record[7], record[0])
+        RECORD.pack_into(self.__records, offset, b"", 0, 0, 0, 0, 0, FREE, 0)
+        self.__free.append(slot)
+        self.__index_remove(pos)
+
+    def __index_remove(self, pos):
+        """Removes an index entry, shifting back the entries after it so no probe sequence is broken"""
+        index = self.__index
+        mask = len(index) - 1
+        records = self.__records
+        size = RECORD.size
+        index[pos] = -1
+        j = pos
+        while True:
+            j = (j + 1) & mask
+            slot = index[j]
+            if slot < 0:
+                return
+            offset = slot * size
+            home = _hash_key(bytes(records[offset:offset + KEY_SIZE])) & mask
+            # The entry can fill the hole unless its home position is cyclically within (pos, j]
+            if pos <= j:
+                stays = pos < home <= j
+            else:
+                stays = home > pos or home <= j
+            if not stays:
+                index[pos] = slot
+                index[j] = -1
+                pos = j
+
+    def __grow_index(self):
+        index = array.array(b'i', [-1]) * (len(self.__index) * 2)
+        mask = len(index) - 1
+        records = self.__records
+        size = RECORD.size
+        for table in (NEW, TRIED):
+            for slot in self.__tables[table]:
+                offset = slot * size
+                pos = _hash_key(bytes(records[offset:offset + KEY_SIZE])) & mask
+                while index[pos] >= 0:
+                    pos = (pos + 1) & mask
+                index[pos] = slot
+        self.__index = index
+
+    def __table_add(self, table, slot, key):
+        self.__buckets[table][get_bucket(get_group(key[0:16]), len(self.__buckets[table]))] += 1
+        self.__tables[table].append(slot)
+        return len(self.__tables[table]) - 1
+
+    def __table_remove(self, table, slot, position, key):
+        self.__buckets[table][get_bucket(get_group(key[0:16]), len(self.__buckets[table]))] -= 1
+        slots = self.__tables[table]
+        last = slots.pop()
+        if last != slot:
+            # The last entry takes the removed entry's place
+            slots[position] = last
+            offset = last * RECORD.size
+            record = list(RECORD.unpack_from(self.__records, offset))
+            record[7] = position
+            RECORD.pack_into(self.__records, offset, *record)
+
+
+class AddressHandler(bitcoin.handler.Handler):
+    """ Keeps the node's AddressManager up to date
+
+    Addresses gossiped by peers are added in bulk, outbound peers are asked for their addresses once the handshake
+    completes and are marked as good and getaddr requests are answered from the known addresses. If the manager is
+    empty it starts with the protocol's fixed seeds. With a path, the manager is loaded from the snapshot at start
+    and saved every save_rate seconds and at shutdown.
+    """
+
+    def __init__(self, node, address_manager, protocol_info, path=None, save_rate=SAVE_INTERVAL):
+        super(AddressHandler, self).__init__(node)
+        self.address_manager = address_manager
+        self.path = path
+        self.save_rate = save_rate
+        if path and os.path.exists(path):
+            try:
+                address_manager.load(path)
+                LM.info("Loaded %d new and %d tried addresses" % address_manager.get_counts())
+            except (AddressFileError, IOError, ValueError) as e:
+                LM.info("Unable to load addresses: %s" % e)
+        if not len(address_manager):
+            for host in protocol_info.get_fixed_seeds():
+                address_manager.add_host(host, protocol_info.get_default_net_port())
+
+    def poll(self):
+        self.save()
+
+    def save(self):
+        if self.path:
+            try:
+                self.address_manager.save(self.path)
+            except (IOError, OSError) as e:
+                LM.info("Unable to save addresses: %s" % e)
+
+    def required_messages(self):
+        return "addr", "getaddr", "verack"
+
+    def polling_rate(self):
+        return self.save_rate if self.path else None
+
+    def on_shutdown(self):
+        self.save()
+
+    def handle_message(self, peer_id, peer_handle, command, message):
+        if command == u"addr":
+            self.address_manager.add(message.addresses)
+        elif command == u"getaddr":
+            addresses = self.address_manager.get_addresses(Messages.MAX_ADDR_COUNT)
+            peer_handle.send_message("addr", Messages.Addr(addresses))
+        elif command == u"verack" and peer_handle.outgoing:
+            if peer_handle.ip:
+                self.address_manager.mark_good(peer_handle.ip, peer_handle.port)
+            peer_handle.send_message("getaddr", Messages.GetAddr())
@@ -8,66 +8,88 @@ import bitcoin.message
 
 BAC = bitcoin.byte_array_codec
 
+HEADER_SIZE = 24
+HEADER_STRUCT = BAC.get_struct(BAC.LE, "I12sII")
+CHECKSUM_STRUCT = BAC.get_struct(BAC.LE, "I")
+
+
+def get_checksum(data):
+    """Gets the frame checksum, the first 4 bytes of the double SHA-256 of the payload, as an unsigned int"""
+    return finish_checksum(hashlib.sha256(data))
+
+
+def finish_checksum(sha256):
+    """Completes a checksum from a SHA-256 object which has been fed the whole payload"""
+    digest = hashlib.sha256(sha256.digest()).digest()
+    return CHECKSUM_STRUCT.unpack_from(digest)[0]
+
 
 class MessageCodec(object):
 
     def __init__(self, protocol_info):
         self.protocol_info = protocol_info
 
+    def decode_header(self, buf, offset=0):
+        """Decodes the 24 byte frame header at offset, returning (command, length, checksum)"""
+        start, command, length, crc = HEADER_STRUCT.unpack_from(buf, offset)
+
+        if start != self.protocol_info.get_message_start():
+            raise network.network.DecodeError
+
+        if length > self.protocol_info.get_max_message_size():
+            raise network.network.DecodeError
+
+        return command.rstrip(b"\x00"), length, crc
+
+    def decode_payload(self, version, command, data):
+        """Decodes a checksum verified payload, returning (command, message)
+
+        The payload is owned by the caller and not reused, so it is decoded without copying and record arrays in
+        the message are views into it.
+        """
+        message_class = bitcoin.message.get_message_by_name(command)
+        if message_class:
+            message = message_class()
+            if not isinstance(data, memoryview):
+                data = memoryview(data)
+            decoder = BAC.BinDecoder(data, zero_copy=True)
+            message.decode(version, decoder)
+        else:
+            message = None
+        return command, message
+
     def decode_message(self, buf, version):
         assert(isinstance(buf, bytearray))
-        byte_stream = BAC.BinDecoder(buf)
-        try:
-            start = byte_stream.get_int() & 0xFFFFFFFF
-            command = byte_stream.get_string(12)
-            length = byte_stream.get_int()
-            crc = byte_stream.get_int()
+        if len(buf) < HEADER_SIZE:
+            return None, buf
 
-            if length < 0 or length > self.protocol_info.get_max_message_size():
-                raise network.network.DecodeError
+        command, length, crc = self.decode_header(buf)
 
-            data = byte_stream.get_byte_array(length)
-        except BAC.DecoderEOF:
+        if len(buf) < HEADER_SIZE + length:
             return None, buf
 
-        if version == 0 and command != b"version\x00\x00\x00\x00\x00":
+        if version == 0 and command != b"version":
             return None, buf
 
-        if start != self.protocol_info.get_message_start():
-            raise network.network.DecodeError
+        data = buf[HEADER_SIZE:HEADER_SIZE + length]
 
-        sha256 = hashlib.sha256()
-        sha256.update(data)
-        digest = sha256.digest()
-        sha256 = hashlib.sha256()
-        sha256.update(digest)
-        digest = sha256.digest()
-        digest_stream = BAC.BinDecoder(bytearray(digest))
-
-        expected_crc = digest_stream.get_int()
-
-        if expected_crc == crc:
-            message_class = bitcoin.message.get_message(command)
-            if message_class:
-                message = message_class()
-                decoder = BAC.BinDecoder(data)
-                message.decode(version, decoder)
-            else:
-                message = None
-            for i in range(12):
-                if command[11 - i] != '\x00':
-                    return (command[0:(12 - i)], message), byte_stream.get_remaining_buf()
+        if get_checksum(data) == crc:
+            return self.decode_payload(version, command, data), buf[HEADER_SIZE + length:]
         else:
             return None, buf
 
     def encode_message(self, version, command, msg):
 
-        data_encoder = BAC.BinEncoder()
+        data_encoder = BAC.BinEncoder(bitcoin.message.get_size_hint(msg, version))
         msg.encode(version, data_encoder)
 
-        data = data_encoder.as_byte_array()
+        data = data_encoder.as_byte_array(False)
 
-        byte_out_stream = BAC.BinEncoder()
+        return self.encode_frame(command, data)
+
+    def encode_frame(self, command, data):
+        """Frames an encoded payload with its header"""
+        byte_out_stream = BAC.BinEncoder(HEADER_SIZE + len(data))
 
         command = bytearray(command, 'ascii')
 
@@ -79,20 +101,109 @@ class MessageCodec(object):
         if len(data) > self.protocol_info.get_max_message_size():
             raise network.network.EncodeError
 
-        sha256 = hashlib.sha256()
-        sha256.update(data)
-        digest = sha256.digest()
-        sha256 = hashlib.sha256()
-        sha256.update(digest)
-        digest = sha256.digest()
-        digest = bytearray(digest)
-        digest_stream = BAC.BinDecoder(digest)
-        crc = digest_stream.get_int()
-
         byte_out_stream.put_int(self.protocol_info.get_message_start())
         byte_out_stream.put_byte_array(command)
         byte_out_stream.put_int(len(data))
-        byte_out_stream.put_int(crc)
+        byte_out_stream.put_int(get_checksum(data))
         byte_out_stream.put_byte_array(data)
 
-        return byte_out_stream.as_byte_array()
+        return byte_out_stream.as_byte_array(False)
+
+
+class MessageFramer(object):
+    """Splits a received byte stream into frames
+
+    The read offset and the current frame header are tracked between calls, so each header is parsed once and
+    the unread part of the buffer is only moved when the consumed prefix exceeds the compaction threshold.
+
+    The first SHA-256 pass of the checksum is fed with payload bytes as they arrive, so only the short second
+    pass remains once the last byte of a large frame is received.
+    """
+
+    def __init__(self, message_codec, compact_threshold=0x10000):
+        self.__message_codec = message_codec
+        self.__compact_threshold = compact_threshold
+        self.__buf = bytearray()
+        self.__i = 0
+        self.__header = None
+        self.__sha256 = None
+        self.__hashed = 0
+
+    def feed(self, data):
+        self.__buf.extend(data)
+
+    def get_buffered(self):
+        return len(self.__buf) - self.__i
+
+    def get_in_progress(self):
+        """Gets the buffered bytes of the frame whose header has been read, 0 if there is none"""
+        if self.__header is None:
+            return 0
+        return min(len(self.__buf) - self.__i, HEADER_SIZE + self.__header[1])
+
+    def get_wanted(self):
+        """Gets the number of bytes needed to complete the frame being received, or its header"""
+        available = len(self.__buf) - self.__i
+        if self.__header is None:
+            return max(HEADER_SIZE - available, 0)
+        return max(HEADER_SIZE + self.__header[1] - available, 0)
+
+    def frames(self, version):
+        """Yields (command, payload) for each complete frame with a valid checksum, the payload is a byte string"""
+        try:
+            while True:
+                frame = self.__next_frame(version)
+                if frame is None:
+                    return
+                command, data, valid = frame
+                if valid:
+                    yield command, data
+        finally:
+            self.__compact()
+
+    def messages(self, version):
+        """Yields decoded (command, message) pairs for each complete frame"""
+        for command, data in self.frames(version):
+            yield self.__message_codec.decode_payload(version, command, data)
+
+    def __next_frame(self, version):
+        buf = self.__buf
+        i = self.__i
+
+        if self.__header is None:
+            if len(buf) - i < HEADER_SIZE:
+                return None
+            self.__header = self.__message_codec.decode_header(buf, i)
+            self.__sha256 = hashlib.sha256()
+            self.__hashed = 0
+
+        command, length, crc = self.__header
+
+        start = i + HEADER_SIZE
+        end = start + length
+
+        available = min(len(buf), end) - start
+        if available > self.__hashed:
+            self.__sha256.update(memoryview(buf)[start + self.__hashed:start + available])
+            self.__hashed = available
+
+        if version == 0 and command != b"version":
+            return None
+
+        if len(buf) < end:
+            return None
+
+        valid = finish_checksum(self.__sha256) == crc
+        self.__header = None
+        self.__sha256 = None
+        self.__i = end
+        # The buffer is compacted and refilled, so the payload is handed off as a copy of its own
+        return command, memoryview(buf)[start:end].tobytes(), valid
+
+    def __compact(self):
+        if self.__i == len(self.__buf):
+            del self.__buf[:]
+            self.__i = 0
+        elif self.__i >= self.__compact_threshold:
+            del self.__buf[:self.__i]
+            self.__i = 0
@@ -9,16 +9,90 @@ LE, BE = "<", ">"
 
 LONG_MASK = 0xFFFFFFFFFFFFFFFFL
 
+_struct_cache = {}
+
+
+def get_struct(endian, code):
+    """Gets a cached precompiled struct for the given endian and format code"""
+    key = endian + code
+    s = _struct_cache.get(key)
+    if s is None:
+        s = struct.Struct(key.encode('utf-8'))
+        _struct_cache[key] = s
+    return s
+
+INT_STRUCTS = {
+    LE: {code: get_struct(LE, code) for code in 'BbHhIiQq'},
+    BE: {code: get_struct(BE, code) for code in 'BbHhIiQq'}
+}
+
+
+class RecordArray(object):
+    """An array of fixed size records backed by the buffer they were decoded from
+
+    Records are tuples unpacked with record_struct. Iterating unpacks every record in place with the same struct,
+    stepping through the buffer by its size.
+    """
+
+    def __init__(self, record_struct, buf, count):
+        self.__struct = record_struct
+        self.__buf = buf
+        self.__count = count
+        self.__records = None
+
+    def __len__(self):
+        return self.__count
+
+    def __getitem__(self, i):
+        if self.__records is not None:
+            return self.__records[i]
+        if i < 0:
+            i += self.__count
+        if i < 0 or i >= self.__count:
+            raise IndexError
+        return self.__struct.unpack_from(self.__buf, i * self.__struct.size)
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def get_record_size(self):
+        return self.__struct.size
+
+    def get_buffer(self):
+        return self.__buf
+
+    def to_list(self):
+        if self.__records is None:
+            unpack_from = self.__struct.unpack_from
+            buf = self.__buf
+            size = self.__struct.size
+            self.__records = [unpack_from(buf, offset) for offset in xrange(0, self.__count * size, size)]
+        return self.__records
+
+
 class BinDecoder(object):
 
-    def __init__(self, b):
-        assert(isinstance(b, bytearray))
+    def __init__(self, b, zero_copy=False):
+        """Decodes a bytearray, if zero_copy is set, byte arrays are returned as views into the buffer"""
+        assert(isinstance(b, (bytearray, memoryview)))
+        if zero_copy and not isinstance(b, memoryview):
+            b = memoryview(b)
         self.__buf = b
+        self.__zero_copy = zero_copy
         self.__i = 0
-        self.__endian = LE
+        self.__endian = None
+        self.__structs = None
+        self.set_endian(LE)
 
     def set_endian(self, endian):
         self.__endian = endian
+        self.__structs = INT_STRUCTS[endian]
+
+    def get_offset(self):
+        return self.__i
+
+    def get_remaining(self):
+        return len(self.__buf) - self.__i
 
     def get_ubyte(self):
         return self.__get('B', 1)
@@ -58,17 +132,41 @@ class BinDecoder(object):
     def get_long(self):
         return self.__get('q', 8)
 
+    def get_struct(self, s):
+        """Decodes a precompiled struct.Struct at the current position and returns the tuple of values"""
+        if self.__i + s.size > len(self.__buf):
+            raise DecoderEOF
+        values = s.unpack_from(self.__buf, self.__i)
+        self.__i += s.size
+        return values
+
+    def get_records(self, count, dtype):
+        """Decodes an array of count fixed size records in one call
+
+        dtype is a struct format for a single record, without the endian prefix, or a struct.Struct, and the result
+        is a RecordArray. If dtype is a numpy dtype, a numpy structured array is returned instead.
+        """
+        if hasattr(dtype, 'itemsize'):
+            import numpy
+            data = self.get_byte_array(count * dtype.itemsize)
+            return numpy.frombuffer(data, dtype=dtype, count=count)
+        if not isinstance(dtype, struct.Struct):
+            dtype = get_struct(self.__endian, dtype)
+        data = self.get_byte_array(count * dtype.size)
+        return RecordArray(dtype, data, count)
+
     def __get(self, code, length):
         if self.__i + length > len(self.__buf):
             raise DecoderEOF
-        section = self.__buf[self.__i:self.__i + length]
-        value = struct.unpack((self.__endian + code).encode('utf-8'), section)[0]
+        value = self.__structs[code].unpack_from(self.__buf, self.__i)[0]
         self.__i += length
         return value
 
     def get_string(self, length):
-        value = str(self.get_byte_array(length))
-        return value
+        value = self.get_byte_array(length)
+        if isinstance(value, memoryview):
+            return value.tobytes()
+        return str(value)
 
     def get_byte_array(self, length):
         if self.__i + length > len(self.__buf):
@@ -89,21 +187,30 @@ class BinDecoder(object):
         return bitcoin.messages.NetworkAddress(timestamp, services, address, port)
 
     def get_remaining_buf(self):
+        if self.__zero_copy:
+            return self.__buf[self.__i:]
         return bytearray(self.__buf[self.__i:])
 
 class BinEncoder(object):
 
-    def __init__(self):
-        self.__buf = bytearray()
+    def __init__(self, size_hint=64):
+        """Encodes into a preallocated buffer which grows as required, size_hint is the initial capacity"""
+        self.__buf = bytearray(max(size_hint, 1))
         self.__i = 0
-        self.__endian = LE
+        self.__endian = None
+        self.__structs = None
+        self.set_endian(LE)
 
     def set_endian(self, endian):
         self.__endian = endian
+        self.__structs = INT_STRUCTS[endian]
+
+    def get_size(self):
+        return self.__i
 
     def put_byte(self, b):
         b &= 0xFF
-        self.put_byte_array(self.call_struct_pack(self.__endian + 'B', b))
+        self.__put('B', 1, b)
 
     def put_boolean(self, b):
         if b:
@@ -113,11 +220,11 @@ class BinEncoder(object):
 
     def put_short(self, s):
         s &= 0xFFFF
-        self.put_byte_array(self.call_struct_pack(self.__endian + 'H', s))
+        self.__put('H', 2, s)
 
     def put_int(self, i):
         i &= 0xFFFFFFFF
-        self.put_byte_array(self.call_struct_pack(self.__endian + 'I', i))
+        self.__put('I', 4, i)
 
     def put_var_int(self, i):
         i &= LONG_MASK
@@ -135,15 +242,34 @@ class BinEncoder(object):
 
     def put_long(self, l):
         l &= LONG_MASK
-        self.put_byte_array(self.call_struct_pack(self.__endian + 'Q', l))
+        self.__put('Q', 8, l)
+
+    def put_struct(self, s, *values):
+        """Encodes values using a precompiled struct.Struct at the current position"""
+        self.__reserve(s.size)
+        s.pack_into(self.__buf, self.__i, *values)
+        self.__i += s.size
 
-    def call_struct_pack(self, t, value):
-        type_str = t.encode('utf-8')
-        return struct.pack(type_str, value)
+    def __put(self, code, length, value):
+        self.__reserve(length)
+        self.__structs[code].pack_into(self.__buf, self.__i, value)
+        self.__i += length
+
+    def __reserve(self, length):
+        required = self.__i + length
+        capacity = len(self.__buf)
+        if required > capacity:
+            self.__buf.extend(bytearray(max(required, capacity * 2) - capacity))
 
     def put_byte_array(self, buf):
-        for b in buf:
-            self.__buf.append(b)
+        length = len(buf)
+        self.__reserve(length)
+        self.__buf[self.__i:self.__i + length] = buf
+        self.__i += length
 
-    def as_byte_array(self):
-        return bytearray(self.__buf)
\ No newline at end of file
+    def as_byte_array(self, copy=True):
+        """Returns the encoded bytes, if copy is False, the internal buffer is trimmed and handed out directly"""
+        if copy:
+            return self.__buf[:self.__i]
+        del self.__buf[self.__i:]
+        return self.__buf
\ No newline at end of file
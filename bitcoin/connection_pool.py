@@ -0,0 +1,138 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import random
+import time
+
+import logmanager.logmanager
+import bitcoin.handler
+import bitcoin.address_manager
+
+LM = logmanager.logmanager
+AM = bitcoin.address_manager
+
+DEFAULT_TARGET = 8
+
+# Connection attempts which have had no result for this long are forgotten
+PENDING_TIMEOUT = 30
+
+# At most one peer is evicted per interval, and only peers connected for at least MIN_EVICT_AGE are considered
+EVICT_INTERVAL = 600
+MIN_EVICT_AGE = 120
+
+# A peer is only evicted if its score is below this fraction of the median score
+EVICT_RATIO = 0.25
+
+LATENCY_FLOOR = 0.01
+
+# Once a peer has this many latency samples, its 90th percentile is used instead of its average
+MIN_LATENCY_SAMPLES = 10
+
+
+def get_score(peer_handle, t):
+    """Scores a peer by its received bytes per second over its ping latency, higher is better"""
+    age = max(t - peer_handle.connect_time, 1.0)
+    throughput = peer_handle.bytes_received / age
+    latency = peer_handle.latency
+    if len(peer_handle.latency_histogram) >= MIN_LATENCY_SAMPLES:
+        latency = peer_handle.latency_histogram.get_percentile(90)
+    return (throughput + 1.0) / (latency + LATENCY_FLOOR)
+
+
+class ConnectionPool(bitcoin.handler.Handler):
+    """ Keeps target outbound connections open
+
+    Each poll, free slots are filled with addresses from the node's AddressManager, falling back to the protocol's
+    fixed seeds. Only one outbound peer or pending connection is allowed per network group, so the peers are spread
+    over different networks. When the pool is full, the peer with the lowest score, its throughput over its ping
+    latency, is evicted if it falls well below the median. Evictions are limited to one per evict_interval, so the
+    pool does not churn its connections.
+    """
+
+    def __init__(self, node, address_manager, protocol_info, target=DEFAULT_TARGET, evict_interval=EVICT_INTERVAL,
+                 tried_bias=0.5):
+        super(ConnectionPool, self).__init__(node)
+        self.address_manager = address_manager
+        self.protocol_info = protocol_info
+        self.target = target
+        self.evict_interval = evict_interval
+        self.tried_bias = tried_bias
+        self.pending = {}
+        self.outbound = {}
+        self.last_eviction = time.time()
+
+    def required_messages(self):
+        return ()
+
+    def polling_rate(self):
+        return 1
+
+    def on_connect(self, peer_id, peer_handle, hostname, ip, port):
+        if not peer_handle.outgoing:
+            return
+        pending = self.pending.pop((hostname, port), None)
+        self.outbound[peer_id] = pending[1] if pending else AM.get_group(ip)
+
+    def on_disconnect(self, peer_id, peer_handle):
+        self.outbound.pop(peer_id, None)
+
+    def on_connect_failed(self, hostname, port):
+        if self.pending.pop((hostname, port), None) is None:
+            return
+        address = AM.host_to_address(hostname)
+        if address is not None:
+            self.address_manager.mark_attempt(address, port)
+
+    def poll(self):
+        t = time.time()
+        for key, (start, group) in self.pending.items():
+            if t - start > PENDING_TIMEOUT:
+                del self.pending[key]
+        if len(self.outbound) >= self.target:
+            self.__evict(t)
+        groups = set(self.outbound.values())
+        groups.update(group for start, group in self.pending.values())
+        while len(self.outbound) + len(self.pending) < self.target:
+            candidate = self.address_manager.select(self.tried_bias, groups)
+            if candidate is None:
+                candidate = self.__select_seed(groups)
+                if candidate is None:
+                    break
+            host, port, group = candidate
+            if (host, port) in self.pending:
+                break
+            groups.add(group)
+            self.pending[(host, port)] = (t, group)
+            LM.info("Connection pool connecting to %s:%d" % (host, port))
+            self.node.get_peer_manager().connect(host, port)
+
+    def __select_seed(self, groups):
+        port = self.protocol_info.get_default_net_port()
+        seeds = []
+        for host in self.protocol_info.get_fixed_seeds():
+            address = AM.host_to_address(host)
+            # Seeds which are names, such as DNS seeds, are their own group
+            group = host if address is None else AM.get_group(address)
+            if group not in groups and (host, port) not in self.pending:
+                seeds.append((host, port, group))
+        if not seeds:
+            return None
+        return random.choice(seeds)
+
+    def __evict(self, t):
+        if t - self.last_eviction < self.evict_interval:
+            return
+        scores = []
+        for peer_handle in self.node.get_peer_handles():
+            if peer_handle.peer_id in self.outbound and peer_handle.latency is not None and \
+                    t - peer_handle.connect_time >= MIN_EVICT_AGE:
+                scores.append((get_score(peer_handle, t), peer_handle))
+        if len(scores) < 2:
+            return
+        scores.sort(key=lambda score: score[0])
+        median = scores[len(scores) // 2][0]
+        score, peer_handle = scores[0]
+        if score < median * EVICT_RATIO:
+            LM.info("Connection pool evicting %s:%d, latency %.3f" % (peer_handle.hostname, peer_handle.port,
+                                                                      peer_handle.latency))
+            self.last_eviction = t
+            self.node.get_peer_manager().disconnect(peer_handle.peer_id)
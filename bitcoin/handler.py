@@ -18,5 +18,14 @@ class Handler(object):
     def on_connect(self, peer_id, peer_handle, hostname, ip, port):
         pass
 
+    def on_disconnect(self, peer_id, peer_handle):
+        pass
+
+    def on_connect_failed(self, hostname, port):
+        pass
+
     def handle_message(self, peer_id, peer_handle, command, message):
+        pass
+
+    def on_shutdown(self):
         pass
\ No newline at end of file
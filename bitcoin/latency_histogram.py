@@ -0,0 +1,103 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import array
+
+# Values are recorded in microseconds, with SUB_BUCKET_BITS bits of precision, a relative error below 2 ** -4
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_SUB_BUCKETS = SUB_BUCKETS >> 1
+
+# Longer latencies are recorded as the maximum, about 134 seconds
+MAX_VALUE = (1 << 27) - 1
+
+UNITS = 1000000
+
+
+def get_index(value):
+    """Gets the bucket of a value, buckets below SUB_BUCKETS hold one value and each power of 2 above is split in
+    HALF_SUB_BUCKETS buckets"""
+    if value < SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKETS + (shift - 1) * HALF_SUB_BUCKETS + (value >> shift) - HALF_SUB_BUCKETS
+
+
+def get_highest_value(index):
+    """Gets the highest value which is recorded in a bucket"""
+    if index < SUB_BUCKETS:
+        return index
+    shift = (index - SUB_BUCKETS) // HALF_SUB_BUCKETS + 1
+    top = (index - SUB_BUCKETS) % HALF_SUB_BUCKETS + HALF_SUB_BUCKETS
+    return ((top + 1) << shift) - 1
+
+
+BUCKETS = get_index(MAX_VALUE) + 1
+
+
+class LatencyHistogram(object):
+    """ Log-linear histogram of latencies in fixed memory, in the style of HdrHistogram
+
+    Latencies are recorded in seconds and percentiles are returned as the highest latency of the bucket they fall
+    in, so they are at most 1/16, about 6%, above the recorded value.
+    """
+
+    def __init__(self):
+        self.__counts = array.array(b'I', [0]) * BUCKETS
+        self.__count = 0
+        self.__total = 0
+        self.__max = 0
+
+    def __len__(self):
+        return self.__count
+
+    def record(self, latency):
+        value = min(max(int(latency * UNITS), 0), MAX_VALUE)
+        self.__counts[get_index(value)] += 1
+        self.__count += 1
+        self.__total += value
+        if value > self.__max:
+            self.__max = value
+
+    def merge(self, other):
+        for index, count in enumerate(other.__counts):
+            if count:
+                self.__counts[index] += count
+        self.__count += other.__count
+        self.__total += other.__total
+        self.__max = max(self.__max, other.__max)
+
+    def reset(self):
+        self.__counts = array.array(b'I', [0]) * BUCKETS
+        self.__count = 0
+        self.__total = 0
+        self.__max = 0
+
+    def get_mean(self):
+        if not self.__count:
+            return None
+        return self.__total / self.__count / UNITS
+
+    def get_max(self):
+        if not self.__count:
+            return None
+        return self.__max / UNITS
+
+    def get_percentile(self, percentile):
+        """Gets the latency at or below which percentile percent of the recorded latencies are, None if empty"""
+        return self.get_percentiles((percentile, ))[0]
+
+    def get_percentiles(self, percentiles):
+        """Gets the latencies for ascending percentiles in one pass over the buckets"""
+        if not self.__count:
+            return [None] * len(percentiles)
+        results = []
+        targets = [max(1, int(self.__count * percentile / 100 + 0.5)) for percentile in percentiles]
+        total = 0
+        for index, count in enumerate(self.__counts):
+            total += count
+            while targets and total >= targets[0]:
+                results.append(min(get_highest_value(index), self.__max) / UNITS)
+                del targets[0]
+            if not targets:
+                break
+        return results
@@ -1,10 +1,12 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import bitcoin.byte_array_codec
+import bitcoin.message_schema
 import network.network
 import binascii
 
 BAC = bitcoin.byte_array_codec
+MS = bitcoin.message_schema
 NET = network.network
 
 PROTOCOL_VERSION = 70002
@@ -78,7 +80,7 @@ class VarString(object):
 
     def decode(self, version, decoder):
         length = decoder.get_var_int()
-        self.ba = decoder.get_byte_array(length)
+        self.ba = bytearray(decoder.get_byte_array(length))
         self.uni = None
 
     def encode(self, version, encoder):
@@ -113,34 +115,44 @@ class VarString(object):
 
 IP4_PREFIX = bytearray(b"\x00" * 10 + b"\xff" * 2)
 
+# Record formats for BinDecoder.get_records
+INVENTORY_RECORD = "I32s"              # type, hash
+ADDRESS_RECORD = "IQ16s2s"             # timestamp, services, address, big endian port
+HEADER_RECORD = "i32s32sIIIB"          # version, previous, merkle root, timestamp, bits, nonce, tx count (always 0)
+
+INVENTORY_STRUCT = BAC.get_struct(BAC.LE, INVENTORY_RECORD)
+ADDRESS_STRUCT = BAC.get_struct(BAC.LE, ADDRESS_RECORD)
+HEADER_STRUCT = BAC.get_struct(BAC.LE, HEADER_RECORD)
+
+MAX_ADDR_COUNT = 1000
+
+
+def decode_var_string(version, decoder):
+    var_string = VarString()
+    var_string.decode(version, decoder)
+    var_string.decode_string()
+    return var_string
+
+
+def encode_var_string(version, encoder, var_string):
+    var_string.encode(version, encoder)
+
+
+class NetworkAddress(MS.SchemaMessage):
+
+    SCHEMA = MS.Schema(
+        MS.Field("timestamp", "i", version_gate=lambda version: version != 0),
+        MS.Field("services", "Q"),
+        MS.Field("address", "16s"),
+        MS.Field("port", "H", big_endian=True)
+    )
 
-class NetworkAddress(object):
     def __init__(self, timestamp=0, services=0, address=bytearray(16), port=0):
         self.timestamp = timestamp
         self.services = services
         self.address = address
         self.port = port
 
-    def decode(self, version, decoder):
-        if version != 0:
-            self.timestamp = decoder.get_int()
-
-        self.services = decoder.get_ulong()
-        self.address = decoder.get_byte_array(16)
-        decoder.set_endian(BAC.BE)
-        self.port = decoder.get_ushort()
-        decoder.set_endian(BAC.LE)
-
-    def encode(self, version, encoder):
-        if version != 0:
-            encoder.put_int(self.timestamp)
-
-        encoder.put_long(self.services)
-        encoder.put_byte_array(self.address)
-        encoder.set_endian(BAC.BE)
-        encoder.put_short(self.port)
-        encoder.set_endian(BAC.LE)
-
     def get_host_string(self):
         if self.address[0:12] == IP4_PREFIX:
             return (u"%d" + 3 * u".%d") % tuple(self.address[12:16])
@@ -153,22 +165,70 @@ class NetworkAddress(object):
         else:
             return "{%08x, %s, %d}" % (self.services, self.get_host_string(), self.port)
 
-class VerAck(object):
+class VerAck(MS.SchemaMessage):
 
     def __init__(self):
         pass
 
-    def decode(self, version, decoder):
-        pass
+    def __repr__(self):
+        return "{VerAck}"
+
+
+def decode_address_records(version, decoder):
+    count = decoder.get_var_int()
+    if count > MAX_ADDR_COUNT:
+        raise BAC.DecoderError("Address message with %d addresses" % count)
+    return decoder.get_records(count, ADDRESS_STRUCT)
+
+
+def encode_address_records(version, encoder, records):
+    encoder.put_var_int(len(records))
+    for record in records:
+        encoder.put_struct(ADDRESS_STRUCT, *record)
 
-    def encode(self, version, encoder):
-        pass
+
+class Addr(MS.SchemaMessage):
+    """Address gossip, the addresses are ADDRESS_RECORD tuples and are decoded as a single RecordArray"""
+
+    SCHEMA = MS.Schema(
+        MS.Custom("addresses", decode_address_records, encode_address_records)
+    )
+
+    def __init__(self, addresses=()):
+        self.addresses = addresses
+
+    def size_hint(self, version):
+        return 9 + len(self.addresses) * ADDRESS_STRUCT.size
 
     def __repr__(self):
-        return "{VerAck}"
+        return "{Addr: %d addresses}" % len(self.addresses)
+
 
+class GetAddr(MS.SchemaMessage):
 
-class Version(object):
+    def __init__(self):
+        pass
+
+    def __repr__(self):
+        return "{GetAddr}"
+
+
+class Version(MS.SchemaMessage):
+
+    SCHEMA = MS.Schema(
+        MS.Field("version", "i"),
+        MS.StopIf(lambda message: message.version < PROTOCOL_MIN_VERSION),
+        MS.Field("services", "q"),
+        MS.Field("timestamp", "q"),
+        MS.Nested("address_to", NetworkAddress, 0),
+        MS.Nested("address_from", NetworkAddress, 0),
+        MS.Field("connect_id", "Q"),
+        MS.Custom("client_name", decode_var_string, encode_var_string),
+        MS.Field("start_height", "i"),
+        MS.Field("relay", "?", default=True,
+                 encode_gate=lambda version: version == 0 or version >= 70001,
+                 decode_gate=lambda message: message.version >= 70001)
+    )
 
     def __init__(self, version=0, services=0, timestamp=0, address_to=None, address_from=None, connect_id=0,
                  client_name=VarString(CLIENT_NAME), height=0, relay=True):
@@ -188,45 +248,14 @@ class Version(object):
                                         self.address_from, self.connect_id, self.client_name, self.start_height,
                                         self.relay)
 
-    def decode(self, version, decoder):
-        self.version = decoder.get_int()
-
-        if self.version < PROTOCOL_MIN_VERSION:
-            return
-
-        self.services = decoder.get_long()
-        self.timestamp = decoder.get_long()
-
-        self.address_to = NetworkAddress()
-        self.address_to.decode(0, decoder)
-
-        self.address_from = NetworkAddress()
-        self.address_from.decode(0, decoder)
-
-        self.connect_id = decoder.get_ulong()
 
-        self.client_name = VarString()
-        self.client_name.decode(0, decoder)
-        self.client_name.decode_string()
+class Reject(MS.SchemaMessage):
 
-        self.start_height = decoder.get_int()
-
-        self.relay = self.version < 70001 or decoder.get_boolean()
-
-    def encode(self, version, encoder):
-        encoder.put_int(self.version)
-        encoder.put_long(self.services)
-        encoder.put_long(self.timestamp)
-        self.address_to.encode(0, encoder)
-        self.address_from.encode(0, encoder)
-        encoder.put_long(self.connect_id)
-        self.client_name.encode(version, encoder)
-        encoder.put_int(self.start_height)
-        if version == 0 or version >= 70001:
-            encoder.put_boolean(self.relay)
-
-
-class Reject(object):
+    SCHEMA = MS.Schema(
+        MS.Custom("message", decode_var_string, encode_var_string),
+        MS.Field("ccode", "b"),
+        MS.Custom("reason", decode_var_string, encode_var_string)
+    )
 
     def __init__(self, message="", ccode=0, reason=""):
         self.message = message
@@ -236,24 +265,12 @@ class Reject(object):
     def __repr__(self):
         return "{Reject: message=%s, code=%d, reason=%s}" % (self.message, self.ccode, self.reason)
 
-    def decode(self, version, decoder):
-        self.message = VarString()
-        self.message.decode(0, decoder)
-        self.message.decode_string()
-
-        self.ccode = decoder.get_byte()
-
-        self.reason = VarString()
-        self.reason.decode(0, decoder)
-        self.reason.decode_string()
-
-    def encode(self, version, encoder):
-        self.message.encode(version, encoder)
-        encoder.put_byte(self.ccode)
-        self.reason.encode(version, encoder)
 
+class Ping(MS.SchemaMessage):
 
-class Ping(object):
+    SCHEMA = MS.Schema(
+        MS.Field("nonce", "Q", version_gate=lambda version: version > 60000)
+    )
 
     def __init__(self, nonce=0):
         self.nonce = nonce
@@ -261,19 +278,12 @@ class Ping(object):
     def __repr__(self):
         return "{Ping: nonce=%d}" % self.nonce
 
-    def decode(self, version, decoder):
-
-        if version > 60000:
-            self.nonce = decoder.get_ulong()
-        else:
-            self.nonce = 0
-
-    def encode(self, version, encoder):
-        if version > 60000:
-            encoder.put_long(self.nonce)
 
+class Pong(MS.SchemaMessage):
 
-class Pong(object):
+    SCHEMA = MS.Schema(
+        MS.Field("nonce", "Q")
+    )
 
     def __init__(self, nonce=0):
         self.nonce = nonce
@@ -281,18 +291,14 @@ class Pong(object):
     def __repr__(self):
         return "{Pong: nonce=%d}" % self.nonce
 
-    def decode(self, version, decoder):
-        self.nonce = decoder.get_ulong()
-
-    def encode(self, version, encoder):
-        encoder.put_long(self.nonce)
-
 message_map = {
     u"version": Version,
     u"verack": VerAck,
     u"reject": Reject,
     u"ping": Ping,
-    u"pong": Pong
+    u"pong": Pong,
+    u"addr": Addr,
+    u"getaddr": GetAddr
 }
 
 byte_array_message_map = {}
@@ -307,4 +313,16 @@ def get_message(command):
     try:
         return byte_array_message_map[str(command)]
     except KeyError:
-        return None
\ No newline at end of file
+        return None
+
+
+def get_message_by_name(command):
+    return message_map.get(command)
+
+
+def get_size_hint(message, version, default=64):
+    """Gets the expected encoded size of a message, so encoders can preallocate their buffer"""
+    try:
+        return message.size_hint(version)
+    except AttributeError:
+        return default
\ No newline at end of file
@@ -0,0 +1,298 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bitcoin.byte_array_codec
+
+BAC = bitcoin.byte_array_codec
+
+UNSIGNED_CODES = {'b': 'B', 'h': 'H', 'i': 'I', 'q': 'Q'}
+MASKS = {'B': 0xFF, 'H': 0xFFFF, 'I': 0xFFFFFFFF, 'Q': BAC.LONG_MASK}
+
+CUSTOM_SIZE_HINT = 16
+
+
+class Field(object):
+    """A fixed width field, code is a struct format code, such as 'i', 'Q', '?' or '16s'
+
+    version_gate(version) selects the protocol versions where the field is present, encode_gate(version)
+    overrides it when encoding. decode_gate(message) is checked against the fields decoded so far and, if it
+    fails, the attribute is set to default.
+    """
+
+    def __init__(self, name, code, default=None, big_endian=False, version_gate=None, encode_gate=None,
+                 decode_gate=None):
+        self.name = name
+        self.code = code
+        self.default = default
+        self.big_endian = big_endian
+        self.version_gate = version_gate
+        self.encode_gate = encode_gate
+        self.decode_gate = decode_gate
+        self.size = BAC.get_struct(BAC.LE, code).size
+
+        unsigned_code = UNSIGNED_CODES.get(code, code)
+        mask = MASKS.get(unsigned_code)
+        if big_endian:
+            # Packed as raw bytes within the little endian struct and converted separately
+            decode_struct = BAC.get_struct(BAC.BE, code)
+            encode_struct = BAC.get_struct(BAC.BE, unsigned_code)
+            self.decode_code = '%ds' % self.size
+            self.decode_convert = lambda raw: decode_struct.unpack(raw)[0]
+            self.encode_code = self.decode_code
+            self.encode_mask = None
+            self.encode_convert = lambda value: encode_struct.pack(value & mask)
+        else:
+            is_bytes = code.endswith('s')
+            self.decode_code = code
+            self.decode_convert = bytearray if is_bytes else None
+            self.encode_code = unsigned_code
+            self.encode_mask = mask
+            self.encode_convert = bytes if is_bytes else None
+
+    def is_decoded(self, version):
+        return self.version_gate is None or self.version_gate(version)
+
+    def is_encoded(self, version):
+        gate = self.encode_gate or self.version_gate
+        return gate is None or gate(version)
+
+
+class Custom(object):
+    """A variable length field, decode(version, decoder) returns the value and encode(version, encoder, value)
+    writes it"""
+
+    def __init__(self, name, decode, encode):
+        self.name = name
+        self.decode = decode
+        self.encode = encode
+
+
+class Nested(object):
+    """A field holding an object of a class with its own schema, encoded using the given protocol version"""
+
+    def __init__(self, name, cls, version=None):
+        self.name = name
+        self.cls = cls
+        self.version = version
+
+
+class StopIf(object):
+    """Ends decoding early if predicate(message) is true for the fields decoded so far"""
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+
+class _StructStep(object):
+
+    def __init__(self, creates, codes, slots):
+        self.creates = creates
+        self.slots = slots
+        self.struct = BAC.get_struct(BAC.LE, "".join(codes))
+
+    def run_decode(self, decoder, owners):
+        _create(self.creates, owners)
+        values = decoder.get_struct(self.struct)
+        for value, (owner, name, convert) in zip(values, self.slots):
+            if convert:
+                value = convert(value)
+            setattr(owners[owner], name, value)
+
+    def run_encode(self, encoder, version, owners):
+        _resolve(self.creates, owners)
+        values = []
+        for owner, name, mask, convert in self.slots:
+            value = getattr(owners[owner], name)
+            if mask:
+                value &= mask
+            elif convert:
+                value = convert(value)
+            values.append(value)
+        encoder.put_struct(self.struct, *values)
+
+
+class _GatedStep(object):
+
+    def __init__(self, creates, owner, field):
+        self.creates = creates
+        self.owner = owner
+        self.field = field
+        self.struct = BAC.get_struct(BAC.LE, field.decode_code)
+
+    def run_decode(self, decoder, owners):
+        _create(self.creates, owners)
+        owner = owners[self.owner]
+        field = self.field
+        if field.decode_gate(owners[0]):
+            value = decoder.get_struct(self.struct)[0]
+            if field.decode_convert:
+                value = field.decode_convert(value)
+        else:
+            value = field.default
+        setattr(owner, field.name, value)
+
+
+class _CustomStep(object):
+
+    def __init__(self, creates, owner, field, version):
+        self.creates = creates
+        self.owner = owner
+        self.field = field
+        self.version = version
+
+    def run_decode(self, decoder, owners):
+        _create(self.creates, owners)
+        setattr(owners[self.owner], self.field.name, self.field.decode(self.version, decoder))
+
+    def run_encode(self, encoder, version, owners):
+        _resolve(self.creates, owners)
+        self.field.encode(self.version, encoder, getattr(owners[self.owner], self.field.name))
+
+
+class _StopStep(object):
+
+    def __init__(self, creates, predicate):
+        self.creates = creates
+        self.predicate = predicate
+
+    def run_decode(self, decoder, owners):
+        _create(self.creates, owners)
+        return self.predicate(owners[0])
+
+    def run_encode(self, encoder, version, owners):
+        _resolve(self.creates, owners)
+
+
+def _create(creates, owners):
+    for parent, name, cls in creates:
+        obj = cls()
+        setattr(owners[parent], name, obj)
+        owners.append(obj)
+
+
+def _resolve(creates, owners):
+    for parent, name, cls in creates:
+        owners.append(getattr(owners[parent], name))
+
+
+class _Compiler(object):
+    """Flattens a schema for one protocol version and merges each run of fixed width fields into one struct"""
+
+    def __init__(self, encode):
+        self.encode = encode
+        self.steps = []
+        self.creates = []
+        self.codes = []
+        self.slots = []
+        self.owner_count = 1
+        self.fixed_size = 0
+        self.custom_count = 0
+
+    def add_fields(self, fields, owner, version):
+        for field in fields:
+            if isinstance(field, Field):
+                self.add_field(field, owner, version)
+            elif isinstance(field, Nested):
+                nested_version = version if field.version is None else field.version
+                nested_owner = self.owner_count
+                self.owner_count += 1
+                self.creates.append((owner, field.name, field.cls))
+                self.add_fields(field.cls.SCHEMA.fields, nested_owner, nested_version)
+            elif isinstance(field, Custom):
+                self.flush()
+                self.steps.append(_CustomStep(self.take_creates(), owner, field, version))
+                self.custom_count += 1
+            elif isinstance(field, StopIf):
+                if not self.encode:
+                    self.flush()
+                    self.steps.append(_StopStep(self.take_creates(), field.predicate))
+
+    def add_field(self, field, owner, version):
+        if self.encode:
+            if not field.is_encoded(version):
+                return
+            self.codes.append(field.encode_code)
+            self.slots.append((owner, field.name, field.encode_mask, field.encode_convert))
+            self.fixed_size += field.size
+        else:
+            if not field.is_decoded(version):
+                return
+            if field.decode_gate:
+                self.flush()
+                self.steps.append(_GatedStep(self.take_creates(), owner, field))
+            else:
+                self.codes.append(field.decode_code)
+                self.slots.append((owner, field.name, field.decode_convert))
+
+    def take_creates(self):
+        creates = self.creates
+        self.creates = []
+        return creates
+
+    def flush(self):
+        if self.codes:
+            self.steps.append(_StructStep(self.take_creates(), self.codes, self.slots))
+            self.codes = []
+            self.slots = []
+
+    def finish(self):
+        self.flush()
+        if self.creates:
+            self.steps.append(_StopStep(self.take_creates(), lambda message: False))
+        return self.steps
+
+
+class Schema(object):
+    """A declarative list of message fields, compiled on first use for each protocol version"""
+
+    def __init__(self, *fields):
+        self.fields = fields
+        self.__decoders = {}
+        self.__encoders = {}
+
+    def __get_encoder(self, version):
+        compiled = self.__encoders.get(version)
+        if compiled is None:
+            compiler = _Compiler(True)
+            compiler.add_fields(self.fields, 0, version)
+            steps = compiler.finish()
+            compiled = (steps, compiler.fixed_size + compiler.custom_count * CUSTOM_SIZE_HINT)
+            self.__encoders[version] = compiled
+        return compiled
+
+    def __get_decoder(self, version):
+        steps = self.__decoders.get(version)
+        if steps is None:
+            compiler = _Compiler(False)
+            compiler.add_fields(self.fields, 0, version)
+            steps = compiler.finish()
+            self.__decoders[version] = steps
+        return steps
+
+    def decode(self, version, decoder, message):
+        owners = [message]
+        for step in self.__get_decoder(version):
+            if step.run_decode(decoder, owners):
+                return
+
+    def encode(self, version, encoder, message):
+        owners = [message]
+        for step in self.__get_encoder(version)[0]:
+            step.run_encode(encoder, version, owners)
+
+    def get_size_hint(self, version):
+        return self.__get_encoder(version)[1]
+
+
+class SchemaMessage(object):
+    """Base class for messages which are encoded and decoded using the class level SCHEMA"""
+
+    SCHEMA = Schema()
+
+    def decode(self, version, decoder):
+        self.SCHEMA.decode(version, decoder, self)
+
+    def encode(self, version, encoder):
+        self.SCHEMA.encode(version, encoder, self)
+
+    def size_hint(self, version):
+        return self.SCHEMA.get_size_hint(version)
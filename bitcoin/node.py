@@ -1,21 +1,54 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import network.network
+import network.select_manager
+import network.async_manager
+import network.poller
+import network.listener
+import network.peer_shards
+import network.timer_queue
+import bitcoin.address_manager
 import bitcoin.protocols
 import Queue
 import logmanager.logmanager
 import bitcoin.message
 import bitcoin.ping_manager
+import bitcoin.latency_histogram
+import bitcoin.connection_pool
 import bitcoin.bitcoin_codec
 import time
+import random
 import binascii
 
 Net = network.network
+Poller = network.poller
+Listener = network.listener
+Shards = network.peer_shards
+TQ = network.timer_queue
+AddressManager = bitcoin.address_manager
 Messages = bitcoin.message
 Protocols = bitcoin.protocols
+Pool = bitcoin.connection_pool
 LM = logmanager.logmanager
 hexlify = binascii.hexlify
 
+ENGINE_THREAD, ENGINE_SELECT, ENGINE_ASYNC = "thread", "select", "async"
+
+PEER_MANAGER_ENGINES = {
+    ENGINE_THREAD: Net.PeerManager,
+    ENGINE_SELECT: network.select_manager.SelectPeerManager,
+    ENGINE_ASYNC: network.async_manager.AsyncPeerManager
+}
+
+# Commands the node handles itself, other commands are only decoded if a handler requires them
+ALWAYS_HANDLED = frozenset([u"version", u"verack"])
+
+# Peers which have not sent their version by then are disconnected
+HANDSHAKE_TIMEOUT = 60
+
+# A peer's list of timers is pruned of fired and cancelled timers once it is this long
+PEER_TIMERS_PRUNE = 16
+
 
 class PeerHandle(object):
 
@@ -27,10 +60,14 @@ class PeerHandle(object):
         self.peer_id = peer_id
         self.outgoing = outgoing
         self.version = 0
+        self.version_nonce = 0
         self.tolerance = 100
-        self.ping_nonce = 0
-        self.ping_time = None
+        self.pings = {}
         self.latency = None
+        self.latency_histogram = bitcoin.latency_histogram.LatencyHistogram()
+        self.connect_time = time.time()
+        self.bytes_received = 0
+        self.timers = []
 
     def __repr__(self):
         return "{id=%d, %s : %d, outgoing=%r, version=%d}" % \
@@ -49,35 +86,67 @@ class PeerHandle(object):
     def send_message(self, command, message):
         self.node.send_message(self.peer_id, self.version, command, message)
 
+    def call_later(self, delay, callback, *args):
+        """Schedules a timer on the node which is cancelled when the peer disconnects"""
+        if len(self.timers) >= PEER_TIMERS_PRUNE:
+            self.timers = [timer for timer in self.timers if not timer.cancelled]
+        timer = self.node.call_later(delay, callback, *args)
+        self.timers.append(timer)
+        return timer
 
-class QueueElement(object):
-    def __init__(self, handler):
-        self.t = time.time() + handler.polling_rate()
-        self.handler = handler
+    def cancel_timers(self):
+        for timer in self.timers:
+            timer.cancel()
+        self.timers = []
 
 
 class Node(LM.LoggingProcess):
 
     CMD_SHUTDOWN, CMD_CONNECT = range(2)
 
-    def __init__(self, log_queue, port, protocol_info):
+    def __init__(self, log_queue, port, protocol_info, engine=ENGINE_THREAD, ipc=LM.IPC_QUEUE,
+                 listen_backlog=Listener.DEFAULT_BACKLOG, reuse_port=False, shards=1, address_file=None,
+                 outbound_target=0, fast_path=None):
+        self.__port = port
+        self.__outbound_target = outbound_target
+        self.__fast_path = fast_path
+        self.__fast_path_counts = None
+        self.__address_file = address_file
+        self.__address_manager = None
+        self.__shards = shards
+        self.__listen_backlog = listen_backlog
+        self.__reuse_port = reuse_port
         self.__protocol_info = protocol_info
+        self.__engine = engine
+        self.__ipc = ipc
         self.__message_codec = None
         self.__peer_manager = None
         self.__peer_map = None
+        self.__version_nonces = None
         self.__own_ip = None
         self.__own_port = None
         self.__handlers = None
         self.__handlers_map = None
-        self.__handlers_queue = None
+        self.__timers = None
+        self.__buffer_stats = None
         super(Node, self).__init__(log_queue=log_queue, name="Node Manager", target=self._execute, args=())
 
     def get_peer_manager(self):
         return self.__peer_manager
 
+    def get_address_manager(self):
+        return self.__address_manager
+
     def get_peer_handles(self):
         return self.__peer_map.values()
 
+    def call_at(self, deadline, callback, *args):
+        """Schedules a one-shot timer on the node's loop, the returned timer can be cancelled"""
+        return self.__timers.call_at(deadline, callback, *args)
+
+    def call_later(self, delay, callback, *args):
+        return self.__timers.call_later(delay, callback, *args)
+
     def connect(self, hostname, port):
         self.mp_queue_put((self.CMD_CONNECT, hostname, port))
 
@@ -89,55 +158,81 @@ class Node(LM.LoggingProcess):
     def send_message(self, peer_id, version, command, msg):
         self.__peer_manager.send_message(peer_id, version, command, msg)
 
+    def broadcast(self, command, msg, peer_filter=None):
+        """Sends a message to all peers accepted by peer_filter, the network process encodes it once per version
+
+        Peers which have not completed the version exchange are skipped.
+        """
+        targets = [(peer_handle.peer_id, peer_handle.version) for peer_handle in self.__peer_map.values()
+                   if peer_handle.version and (peer_filter is None or peer_filter(peer_handle))]
+        if targets:
+            self.__peer_manager.broadcast(targets, command, msg)
+
     def handle_connect(self, hostname, ip, port, peer_id, outgoing):
         peer_handle = PeerHandle(self, hostname, ip, port, peer_id, outgoing)
         self.__peer_map[peer_id] = peer_handle
         if outgoing:
-            version_message = Messages.Version(
-                version=Messages.PROTOCOL_VERSION,
-                services=Messages.PROTOCOL_SERVICES,
-                timestamp=int(time.time()),
-                address_to=Messages.NetworkAddress(None, 0, ip, port),
-                address_from=Messages.NetworkAddress(None, Messages.PROTOCOL_SERVICES, self.__own_ip, self.__own_port),
-            )
-            self.send_message(peer_id, peer_handle.version, u"version", version_message)
+            self.send_message(peer_id, peer_handle.version, u"version", self.__create_version(peer_handle))
+        peer_handle.call_later(HANDSHAKE_TIMEOUT, self.__handshake_timed_out, peer_handle)
         for handler in self.__handlers:
             handler.on_connect(peer_id, peer_handle, hostname, ip, port)
 
-    def __add_polled_handler(self, new_element):
-        i = len(self.__handlers_queue)
-        for element in reversed(self.__handlers_queue):
-            if element.t >= new_element.t:
-                break
-            i -= 1
-        self.__handlers_queue.insert(i, new_element)
-
-    def __get_polled_handler(self):
-        if len(self.__handlers_queue) == 0:
-            return None
-
+    def __create_version(self, peer_handle):
+        """Creates our version message for a peer, with a nonce of its own which is kept to detect self connections"""
+        self.__version_nonces.discard(peer_handle.version_nonce)
+        nonce = random.randint(1, 0xFFFFFFFFFFFFFFFF)
+        peer_handle.version_nonce = nonce
+        self.__version_nonces.add(nonce)
+        return Messages.Version(
+            version=Messages.PROTOCOL_VERSION,
+            services=Messages.PROTOCOL_SERVICES,
+            timestamp=int(time.time()),
+            address_to=Messages.NetworkAddress(None, 0, peer_handle.ip, peer_handle.port),
+            address_from=Messages.NetworkAddress(None, Messages.PROTOCOL_SERVICES, self.__own_ip, self.__own_port),
+            connect_id=nonce
+        )
+
+    def __handshake_timed_out(self, peer_handle):
+        if peer_handle.version == 0:
+            LM.info("Handshake timeout for peer %r" % peer_handle)
+            self.__peer_manager.disconnect(peer_handle.peer_id)
+
+    def __poll_handler(self, handler, deadline):
+        """Polls a handler and schedules its next poll at its polling rate, without drifting"""
+        handler.poll()
         t = time.time()
-
-        newest = self.__handlers_queue[-1]
-
-        if newest.t < t:
-            handler = newest.handler
-            poll_time = handler.polling_rate()
-            newest.t += poll_time
-            if newest.t < t:
-                newest.t = t + poll_time
-            del self.__handlers_queue[-1]
-            self.__add_polled_handler(newest)
-
-            return newest.handler
-        else:
-            return None
+        poll_time = handler.polling_rate()
+        deadline += poll_time
+        if deadline < t:
+            deadline = t + poll_time
+        self.__timers.call_at(deadline, self.__poll_handler, handler, deadline)
 
     def handle_disconnect(self, hostname, port, peer_id):
         LM.info("Disconnected peer %s:%d (%d)" % (hostname, port, peer_id))
-        del self.__peer_map[peer_id]
+        peer_handle = self.__peer_map.pop(peer_id)
+        peer_handle.cancel_timers()
+        self.__version_nonces.discard(peer_handle.version_nonce)
+        for handler in self.__handlers:
+            handler.on_disconnect(peer_id, peer_handle)
         LM.info("%d peers connected" % len(self.__peer_map))
 
+    def handle_frame(self, peer_id, command, payload):
+        """Decodes a raw payload from the network process, only if something will handle the command"""
+        peer_handle = self.__peer_map.get(peer_id)
+        if not peer_handle:
+            LM.info("Unknown peer with id %d" % peer_id)
+            return
+        peer_handle.bytes_received += bitcoin.bitcoin_codec.HEADER_SIZE + len(payload)
+        if command not in ALWAYS_HANDLED and command not in self.__handlers_map:
+            return
+        try:
+            command, message = self.__message_codec.decode_payload(peer_handle.version, command, payload)
+        except Exception:
+            LM.log_exception()
+            peer_handle.bad_peer("Unable to decode %s message" % command, 100)
+            return
+        self.handle_message(peer_id, command, message)
+
     def handle_message(self, peer_id, command, message):
         peer_handle = self.__peer_map[peer_id]
         if peer_handle:
@@ -145,34 +240,48 @@ class Node(LM.LoggingProcess):
                 self.handle_version(peer_id, peer_handle, command, message)
             elif command == u"verack":
                 self.handle_verack(peer_id, peer_handle, command, message)
-            else:
-                handlers = self.__handlers_map.get(command)
-                if handlers:
-                    for handler in handlers:
-                        handler.handle_message(peer_id, peer_handle, command, message)
+            handlers = self.__handlers_map.get(command)
+            if handlers:
+                for handler in handlers:
+                    handler.handle_message(peer_id, peer_handle, command, message)
         else:
             LM.info("Unknown peer with id %d" % peer_id)
 
+    def handle_buffer_stats(self, send_total, recv_total, usage):
+        self.__buffer_stats = (send_total, recv_total, usage)
+        rejected = sum(peer_usage[2] for peer_usage in usage.values())
+        if rejected:
+            LM.info("Buffers: %d bytes queued to send, %d bytes received, %d sends rejected" %
+                    (send_total, recv_total, rejected))
+
+    def get_buffer_stats(self):
+        """Gets the last (send_total, recv_total, {peer_id: (send, recv, rejected)}) reported by the network"""
+        return self.__buffer_stats
+
+    def handle_fast_path_stats(self, counts):
+        for command, count in counts.items():
+            self.__fast_path_counts[command] = self.__fast_path_counts.get(command, 0) + count
+
+    def get_fast_path_counts(self):
+        """Gets the {command: count} of messages the network answered itself, see network.fast_path"""
+        return self.__fast_path_counts
+
     def handle_version(self, peer_id, peer_handle, command, version_msg):
         if peer_handle.version != 0:
             peer_handle.bad_peer("Received a second version message", 100)
+        elif version_msg.connect_id in self.__version_nonces:
+            # The peer is ourselves, the nonce is one we sent on another connection
+            LM.info("Connected to self through %s:%d, disconnecting" % (peer_handle.hostname, peer_handle.port))
+            self.__peer_manager.disconnect(peer_id)
+            return
         else:
-            peer_version = version_msg.version
-            if peer_version > Messages.PROTOCOL_VERSION:
-                peer_handle.set_version(Messages.PROTOCOL_VERSION)
-            else:
-                peer_handle.set_version(peer_version)
+            version = min(version_msg.version, Messages.PROTOCOL_VERSION)
 
+            # Our version is queued before the network learns the peer's, which releases its held frames, so
+            # replies from the network's fast path can't go out before it
             if not peer_handle.outgoing:
-                version_reply_message = Messages.Version(
-                    version=Messages.PROTOCOL_VERSION,
-                    services=Messages.PROTOCOL_SERVICES,
-                    timestamp=int(time.time()),
-                    address_to=Messages.NetworkAddress(None, 0, peer_handle.ip, peer_handle.port),
-                    address_from=Messages.NetworkAddress(None, Messages.PROTOCOL_SERVICES, self.__own_ip,
-                                                         self.__own_port),
-                    )
-                self.send_message(peer_id, peer_handle.version, "version", version_reply_message)
+                self.send_message(peer_id, version, "version", self.__create_version(peer_handle))
+            peer_handle.set_version(version)
 
         LM.info("Version %d received from %s:%d, using %d" % (version_msg.version, peer_handle.hostname,
                                                               peer_handle.port, peer_handle.version))
@@ -182,8 +291,10 @@ class Node(LM.LoggingProcess):
         pass
 
     def __register_handler(self, handler):
-        if handler.polling_rate():
-            self.__add_polled_handler(QueueElement(handler))
+        poll_time = handler.polling_rate()
+        if poll_time:
+            deadline = time.time() + poll_time
+            self.__timers.call_at(deadline, self.__poll_handler, handler, deadline)
         self.__handlers.append(handler)
         commands = handler.required_messages()
         for command in commands:
@@ -197,16 +308,73 @@ class Node(LM.LoggingProcess):
                 self.__handlers_map[command] = command_handlers
             command_handlers.append(handler)
 
+    def __handle_peer_event(self, peer_event):
+        event_type = peer_event[0]
+
+        if event_type == self.__peer_manager.INFO_CONNECTED:
+            peer_id = peer_event[1]
+            hostname = peer_event[2]
+            ip = peer_event[3]
+            port = peer_event[4]
+            outgoing = peer_event[5]
+            if outgoing:
+                LM.info("Connected to %s:%d (%d)" % (hostname, port, peer_id))
+            else:
+                LM.info("Accepted connection from %s:%d (%d)" % (hostname, port, peer_id))
+            self.handle_connect(hostname, ip, port, peer_id, outgoing)
+        elif event_type == self.__peer_manager.INFO_CONNECT_FAILED:
+            peer_id = peer_event[1]
+            hostname = peer_event[2]
+            port = peer_event[3]
+            LM.info("Connection to %s:%d failed (%d)" % (hostname, port, peer_id))
+            for handler in self.__handlers:
+                handler.on_connect_failed(hostname, port)
+        elif event_type == self.__peer_manager.INFO_MSG_RECEIVED:
+            peer_id = peer_event[1]
+            command = peer_event[2]
+            payload = peer_event[3]
+            self.handle_frame(peer_id, command, payload)
+        elif event_type == self.__peer_manager.INFO_DISCONNECTED:
+            peer_id = peer_event[1]
+            hostname = peer_event[2]
+            port = peer_event[3]
+            self.handle_disconnect(hostname, port, peer_id)
+        elif event_type == self.__peer_manager.INFO_BUFFER_STATS:
+            self.handle_buffer_stats(peer_event[1], peer_event[2], peer_event[3])
+        elif event_type == self.__peer_manager.INFO_FAST_PATH_STATS:
+            self.handle_fast_path_stats(peer_event[1])
+        else:
+            LM.info("Unknown event type %d" % event_type)
+
     def __at_start(self):
         self.__peer_map = {}
+        self.__version_nonces = set()
+        self.__fast_path_counts = {}
         self.__own_ip = bytearray(16)
-        self.__own_port = 0
+        self.__own_port = self.__port or 0
+        self.__message_codec = bitcoin.bitcoin_codec.MessageCodec(self.__protocol_info)
         self.__handlers_map = {}
         self.__handlers = []
-        self.__handlers_queue = []
+        self.__timers = TQ.TimerQueue()
         self.__register_handler(bitcoin.ping_manager.PingManager(self))
-        self.__peer_manager = Net.PeerManager(self.__protocol_info, self.get_log_queue())
+        self.__address_manager = AddressManager.AddressManager()
+        self.__register_handler(AddressManager.AddressHandler(self, self.__address_manager, self.__protocol_info,
+                                                              self.__address_file))
+        if self.__outbound_target:
+            self.__register_handler(Pool.ConnectionPool(self, self.__address_manager, self.__protocol_info,
+                                                        self.__outbound_target))
+        engine = PEER_MANAGER_ENGINES[self.__engine]
+        if self.__shards > 1:
+            self.__peer_manager = Shards.ShardedPeerManager(engine, self.__shards, self.__protocol_info,
+                                                            self.get_log_queue(), ipc=self.__ipc,
+                                                            fast_path=self.__fast_path)
+        else:
+            self.__peer_manager = engine(self.__protocol_info, self.get_log_queue(), ipc=self.__ipc,
+                                         fast_path=self.__fast_path)
         self.__peer_manager.start()
+        self.__peer_manager.set_mp_queue_batching(True)
+        if self.__port:
+            self.__peer_manager.listen(self.__port, backlog=self.__listen_backlog, reuse_port=self.__reuse_port)
 
     def _execute(self):
 
@@ -214,6 +382,12 @@ class Node(LM.LoggingProcess):
 
         self.__at_start()
 
+        poller = Poller.get_poller()
+        if Poller.PIPES_SELECTABLE:
+            poller.register(self._mp_queue_fileno_internal(), Poller.EVENT_READ)
+            for fd in self.__peer_manager.mp_queue_filenos():
+                poller.register(fd, Poller.EVENT_READ)
+
         try:
             while not self._interrupted:
                 while True:
@@ -235,44 +409,20 @@ class Node(LM.LoggingProcess):
                         LM.info("Attempting to connect to %s:%d" % (hostname, port))
                         self.__peer_manager.connect(hostname, port)
 
-                polled_handler = True
-                while polled_handler:
-                    polled_handler = self.__get_polled_handler()
-                    if polled_handler:
-                        polled_handler.poll()
-
-                try:
-                    peer_event = self.__peer_manager.mp_queue_get(True, 0.25)
-                except Queue.Empty:
-                    peer_event = None
-                if not peer_event:
-                    continue
-
-                event_type = peer_event[0]
-
-                if event_type == self.__peer_manager.INFO_CONNECTED:
-                    peer_id = peer_event[1]
-                    hostname = peer_event[2]
-                    ip = peer_event[3]
-                    port = peer_event[4]
-                    LM.info("Connected to %s:%d (%d)" % (hostname, port, peer_id))
-                    self.handle_connect(hostname, ip, port, peer_id, True)
-                elif event_type == self.__peer_manager.INFO_CONNECT_FAILED:
-                    peer_id = peer_event[1]
-                    hostname = peer_event[2]
-                    port = peer_event[3]
-                    LM.info("Connection to %s:%d failed (%d)" % (hostname, port, peer_id))
-                elif event_type == self.__peer_manager.INFO_MSG_RECEIVED:
-                    peer_id = peer_event[1]
-                    decoded = peer_event[2]
-                    self.handle_message(peer_id, decoded[0], decoded[1])
-                elif event_type == self.__peer_manager.INFO_DISCONNECTED:
-                    peer_id = peer_event[1]
-                    hostname = peer_event[2]
-                    port = peer_event[3]
-                    self.handle_disconnect(hostname, port, peer_id)
-                else:
-                    LM.info("Unknown event type %d" % event_type)
+                self.__timers.run_due()
+
+                while True:
+                    try:
+                        peer_event = self.__peer_manager.mp_queue_get(False)
+                    except Queue.Empty:
+                        break
+                    self.__handle_peer_event(peer_event)
+
+                self.__peer_manager.mp_queue_flush()
+                poller.poll(Poller.limit_timeout(self.__timers.get_timeout()))
 
         finally:
-            self.__peer_manager.shutdown()
\ No newline at end of file
+            poller.close()
+            self.__peer_manager.shutdown()
+            for handler in self.__handlers:
+                handler.on_shutdown()
\ No newline at end of file
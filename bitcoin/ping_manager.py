@@ -4,35 +4,60 @@ import bitcoin.node
 import logmanager.logmanager
 import bitcoin.handler
 import bitcoin.message
+import bitcoin.latency_histogram
 import random
 import time
 
 LM = logmanager.logmanager
+Histogram = bitcoin.latency_histogram
+
+PING_RATE = 5
+
+# Each peer's interval is jittered by this fraction, so pings to different peers do not line up
+PING_JITTER = 0.2
+
+# Pings without a pong after this long are forgotten, at most MAX_OUTSTANDING are kept per peer
+PING_TIMEOUT = 30
+MAX_OUTSTANDING = 8
+
+STATS_INTERVAL = 60
+
+PERCENTILES = (50, 90, 99)
 
 
 class PingManager(bitcoin.handler.Handler):
+    """ Measures the latency of every peer with pings on a timer of its own
+
+    The first ping to a peer is at a random point in the ping interval and later pings are jittered, so the pings
+    are spread over time instead of sent in one burst. A peer may have several pings outstanding, each matched to
+    its pong by nonce. Latencies are recorded in the peer's histogram and in a global one, whose percentiles are
+    logged every STATS_INTERVAL.
+
+    Pings from peers are usually answered by the network process, see network.fast_path.PingHandler. Any ping
+    which the network passes on to the node is answered here instead.
+    """
 
     def __init__(self, node):
-        self.ping_rate = 5
+        self.ping_rate = PING_RATE
+        self.histogram = Histogram.LatencyHistogram()
         super(PingManager, self).__init__(node)
 
     def poll(self):
-        peer_handles = self.node.get_peer_handles()
-        t = time.time()
-        for peer_handle in peer_handles:
-            nonce = random.randint(0, 0xFFFFFFFFFFFFFFFF)
-            peer_handle.ping_nonce = nonce
-            peer_handle.ping_time = t
-            peer_handle.send_message("ping", bitcoin.message.Ping(nonce))
+        if len(self.histogram):
+            LM.info("Ping latency p50 %.3f, p90 %.3f, p99 %.3f over %d pongs" %
+                    (tuple(self.histogram.get_percentiles(PERCENTILES)) + (len(self.histogram), )))
 
     def required_messages(self):
         return "ping", "pong"
 
     def polling_rate(self):
-        return self.ping_rate
+        return STATS_INTERVAL
+
+    def get_histogram(self):
+        return self.histogram
 
     def on_connect(self, peer_id, peer_handle, hostname, ip, port):
-        pass
+        peer_handle.call_later(random.uniform(0, self.ping_rate), self.__ping, peer_handle)
 
     def handle_message(self, peer_id, peer_handle, command, message):
         if command == u"ping" and peer_handle.version > 60000:
@@ -40,12 +65,31 @@ class PingManager(bitcoin.handler.Handler):
             peer_handle.send_message("pong", bitcoin.message.Pong(ping.nonce))
         elif command == u"pong":
             pong = message
-            if peer_handle.ping_nonce and peer_handle.ping_time:
-                if peer_handle.ping_nonce != 0 and peer_handle.ping_nonce == pong.nonce:
-                    peer_handle.ping_none = None
-                    delta_t = time.time() - peer_handle.ping_time
-                    if 0 < delta_t < 30:
-                        if not peer_handle.latency:
-                            peer_handle.latency = delta_t
-                        else:
-                            peer_handle.latency = 0.25 * delta_t + 0.75 * peer_handle.latency
\ No newline at end of file
+            ping_time = peer_handle.pings.pop(pong.nonce, None)
+            if ping_time is not None:
+                delta_t = time.time() - ping_time
+                if 0 < delta_t < PING_TIMEOUT:
+                    if not peer_handle.latency:
+                        peer_handle.latency = delta_t
+                    else:
+                        peer_handle.latency = 0.25 * delta_t + 0.75 * peer_handle.latency
+                    peer_handle.latency_histogram.record(delta_t)
+                    self.histogram.record(delta_t)
+
+    def __ping(self, peer_handle):
+        t = time.time()
+        # Pings are only sent once the version is known, peers before BIP 31 get pings without nonces
+        if peer_handle.version > 60000:
+            pings = peer_handle.pings
+            for nonce, ping_time in pings.items():
+                if t - ping_time >= PING_TIMEOUT:
+                    del pings[nonce]
+            if len(pings) >= MAX_OUTSTANDING:
+                del pings[min(pings, key=pings.get)]
+            nonce = random.randint(1, 0xFFFFFFFFFFFFFFFF)
+            pings[nonce] = t
+            peer_handle.send_message("ping", bitcoin.message.Ping(nonce))
+        elif peer_handle.version:
+            peer_handle.send_message("ping", bitcoin.message.Ping())
+        delay = self.ping_rate * random.uniform(1 - PING_JITTER, 1 + PING_JITTER)
+        peer_handle.call_later(delay, self.__ping, peer_handle)
@@ -1,18 +1,61 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import collections
 import logging
 import logging.handlers
 import threading
+import time
 import traceback
 import sys
 import os
 import Queue
 import multiprocessing
+import multiprocessing.queues
 import atexit
 
 MP = multiprocessing
 mpQueue = MP.Queue
 
+IPC_QUEUE, IPC_RING = "queue", "ring"
+
+RING_CAPACITY = 0x100000
+
+BATCH_SIZE = 64
+BATCH_DELAY = 0.005
+
+class ChannelError(Exception): pass
+
+
+def create_channel(ipc):
+    """Creates a channel for passing data to or from a LoggingProcess
+
+    IPC_RING uses a shared memory ring buffer, which avoids the queue's feeder thread and locking. It depends on
+    the child inheriting the mapping on fork, so other platforms fall back to a multiprocessing queue.
+    """
+    if ipc == IPC_RING and sys.platform != 'win32':
+        import logmanager.ring_buffer
+        return logmanager.ring_buffer.RingChannel(RING_CAPACITY)
+    return mpQueue()
+
+
+def get_queue_reader(queue):
+    """Gets the connection a multiprocessing queue is read from, which is readable while the queue has data
+
+    multiprocessing.Queue has no public fileno. CPython builds it on a pipe whose read end is the private _reader,
+    and this is the only place which relies on that. ChannelError is raised where the queue is built differently,
+    IPC_RING channels have a doorbell of their own and do not depend on it.
+    """
+    reader = getattr(queue, '_reader', None)
+    if reader is None or not hasattr(reader, 'fileno'):
+        raise ChannelError("multiprocessing.Queue has no selectable reader, use IPC_RING")
+    return reader
+
+
+def get_channel_fileno(channel):
+    if isinstance(channel, MP.queues.Queue):
+        return get_queue_reader(channel).fileno()
+    return channel.fileno()
+
 
 class QueueHandler(logging.Handler):
     def __init__(self, queue):
@@ -136,15 +179,69 @@ class LoggingThread(threading.Thread):
                 log_exception()
 
 
+class BatchWriter(object):
+    """Collects values into lists which are sent as a single channel item
+
+    A batch is sent when it reaches BATCH_SIZE values, when a value is added after the batch is BATCH_DELAY old,
+    or when flush() is called. The owner must flush before it goes idle.
+    """
+
+    def __init__(self, channel, batched):
+        self.__channel = channel
+        self.__batched = batched
+        self.__batch = []
+        self.__deadline = None
+
+    def set_batched(self, batched):
+        self.__batched = batched
+        if not batched:
+            self.flush()
+
+    def put(self, value):
+        batch = self.__batch
+        batch.append(value)
+        if not self.__batched or len(batch) >= BATCH_SIZE:
+            self.flush()
+        elif len(batch) == 1:
+            self.__deadline = time.time() + BATCH_DELAY
+        elif time.time() >= self.__deadline:
+            self.flush()
+
+    def flush(self):
+        if self.__batch:
+            batch = self.__batch
+            self.__batch = []
+            self.__channel.put(batch)
+
+
+class BatchReader(object):
+    """Unpacks batches sent by a BatchWriter, returning one value at a time"""
+
+    def __init__(self, channel):
+        self.__channel = channel
+        self.__pending = collections.deque()
+
+    def get(self, block=True, timeout=None):
+        if not self.__pending:
+            self.__pending.extend(self.__channel.get(block, timeout))
+        return self.__pending.popleft()
+
+
 class LoggingProcess(MP.Process):
 
-    def __init__(self, log_queue, group=None, target=None, name=None, args=(), kwargs={}):
+    def __init__(self, log_queue, group=None, target=None, name=None, args=(), kwargs={}, ipc=IPC_QUEUE):
         if not name:
             raise Exception
 
         self._interrupted = False
-        self.__mp_in_queue = mpQueue()
-        self.__mp_out_queue = mpQueue()
+        self.__mp_in_queue = create_channel(ipc)
+        self.__mp_out_queue = create_channel(ipc)
+        # Values sent by the parent are batched once it promises to flush, see set_mp_queue_batching
+        self.__mp_in_writer = BatchWriter(self.__mp_in_queue, False)
+        self.__mp_in_reader = BatchReader(self.__mp_in_queue)
+        # The child's loop must call _mp_queue_flush_internal before blocking
+        self.__mp_out_writer = BatchWriter(self.__mp_out_queue, True)
+        self.__mp_out_reader = BatchReader(self.__mp_out_queue)
         self.__name = name
         self.__log_queue = log_queue
         self.__target = target
@@ -154,16 +251,33 @@ class LoggingProcess(MP.Process):
         super(LoggingProcess, self).__init__(group, self._execute_wrapper, name, (), {})
 
     def mp_queue_get(self, block=True, timeout=None):
-        return self.__mp_out_queue.get(block, timeout)
+        return self.__mp_out_reader.get(block, timeout)
 
     def mp_queue_put(self, value):
-        self.__mp_in_queue.put(value)
+        self.__mp_in_writer.put(value)
+
+    def mp_queue_flush(self):
+        self.__mp_in_writer.flush()
+
+    def set_mp_queue_batching(self, batched):
+        """Enables batching of mp_queue_put, the caller must then call mp_queue_flush before going idle"""
+        self.__mp_in_writer.set_batched(batched)
 
     def _mp_queue_get_internal(self, block=True, timeout=None):
-        return self.__mp_in_queue.get(block, timeout)
+        return self.__mp_in_reader.get(block, timeout)
 
     def _mp_queue_put_internal(self, data):
-        self.__mp_out_queue.put(data)
+        self.__mp_out_writer.put(data)
+
+    def _mp_queue_flush_internal(self):
+        self.__mp_out_writer.flush()
+
+    def mp_queue_fileno(self):
+        """Gets a file descriptor which is readable when mp_queue_get has data waiting"""
+        return get_channel_fileno(self.__mp_out_queue)
+
+    def _mp_queue_fileno_internal(self):
+        return get_channel_fileno(self.__mp_in_queue)
 
     def get_log_queue(self):
         return self.__log_queue
@@ -179,6 +293,7 @@ class LoggingProcess(MP.Process):
     def _execute_wrapper(self):
         set_log_queue(self.__log_queue, self.__name)
         self._mp_queue_put_internal(-1)
+        self._mp_queue_flush_internal()
         try:
             if self.__target:
                 self.__target(*self.__args, **self.__kwargs)
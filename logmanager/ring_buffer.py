@@ -0,0 +1,186 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import errno
+import fcntl
+import marshal
+import mmap
+import multiprocessing
+import os
+import select
+import struct
+import time
+import Queue
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+POSITION = struct.Struct(b"<Q")
+LENGTH = struct.Struct(b"<I")
+
+# Producer and consumer positions are kept on separate cache lines
+HEAD_OFFSET = 0
+TAIL_OFFSET = 64
+DATA_OFFSET = 128
+
+# A RingChannel's overflow counts, written by the producer and the consumer respectively
+OVERFLOW_PUT_OFFSET = 0
+OVERFLOW_GET_OFFSET = 64
+OVERFLOW_SIZE = 128
+
+TAG_MARSHAL, TAG_PICKLE = b"m", b"p"
+
+
+def encode_value(value):
+    """Serialises a value with marshal where possible, which is much faster than pickle for plain data"""
+    try:
+        return TAG_MARSHAL + marshal.dumps(value)
+    except ValueError:
+        return TAG_PICKLE + pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def decode_value(data):
+    if data[0:1] == TAG_MARSHAL:
+        return marshal.loads(data[1:])
+    return pickle.loads(data[1:])
+
+
+class RingBuffer(object):
+    """Single producer, single consumer ring buffer of length prefixed records in shared memory
+
+    The buffer must be created before the processes using it are forked. Positions only ever increase and each
+    is written by one side only. After publishing records the producer writes to a doorbell pipe, so the consumer
+    can wait for data with select. The doorbell write also orders the record data before the consumer's reads.
+    """
+
+    def __init__(self, capacity=0x100000):
+        self.__capacity = capacity
+        self.__mm = mmap.mmap(-1, DATA_OFFSET + capacity)
+        self.__doorbell_r, self.__doorbell_w = os.pipe()
+        for fd in (self.__doorbell_r, self.__doorbell_w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        """Gets the doorbell file descriptor, which is readable when records may be waiting"""
+        return self.__doorbell_r
+
+    def __get_position(self, offset):
+        return POSITION.unpack_from(self.__mm, offset)[0]
+
+    def __write_at(self, position, data):
+        i = position % self.__capacity
+        first = min(len(data), self.__capacity - i)
+        self.__mm[DATA_OFFSET + i:DATA_OFFSET + i + first] = data[:first]
+        if first < len(data):
+            self.__mm[DATA_OFFSET:DATA_OFFSET + len(data) - first] = data[first:]
+
+    def __read_at(self, position, length):
+        i = position % self.__capacity
+        first = min(length, self.__capacity - i)
+        data = self.__mm[DATA_OFFSET + i:DATA_OFFSET + i + first]
+        if first < length:
+            data += self.__mm[DATA_OFFSET:DATA_OFFSET + length - first]
+        return data
+
+    def ring_doorbell(self):
+        try:
+            os.write(self.__doorbell_w, b"\x00")
+        except OSError as e:
+            # A full pipe already guarantees the consumer will wake
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def put_record(self, data):
+        """Appends a byte string record without waiting, returns False if there is no space for it"""
+        head = self.__get_position(HEAD_OFFSET)
+        length = LENGTH.size + len(data)
+        if self.__capacity - (head - self.__get_position(TAIL_OFFSET)) < length:
+            return False
+        self.__write_at(head, LENGTH.pack(len(data)))
+        self.__write_at(head + LENGTH.size, data)
+        POSITION.pack_into(self.__mm, HEAD_OFFSET, head + length)
+        self.ring_doorbell()
+        return True
+
+    def get_record(self):
+        """Removes and returns the next record, or None if the buffer is empty"""
+        tail = self.__get_position(TAIL_OFFSET)
+        if tail == self.__get_position(HEAD_OFFSET):
+            return None
+        length = LENGTH.unpack(self.__read_at(tail, LENGTH.size))[0]
+        data = self.__read_at(tail + LENGTH.size, length)
+        POSITION.pack_into(self.__mm, TAIL_OFFSET, tail + LENGTH.size + length)
+        return data
+
+    def clear_doorbell(self):
+        try:
+            while os.read(self.__doorbell_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+
+class RingChannel(object):
+    """Queue-like wrapper around a RingBuffer, matching the parts of multiprocessing.Queue used by
+    LoggingProcess
+
+    Values which do not fit in the ring, because it is full or they are larger than it, go through an overflow
+    multiprocessing.Queue instead, so put never blocks. While the consumer has overflow values to take, later values
+    follow them through the queue. The consumer reads the producer's overflow count before the ring, so records
+    in the ring ahead of the overflow are taken first, and values are received in the order they were put.
+    """
+
+    def __init__(self, capacity=0x100000):
+        self.__ring = RingBuffer(capacity)
+        self.__overflow = multiprocessing.Queue()
+        self.__counts = mmap.mmap(-1, OVERFLOW_SIZE)
+
+    def fileno(self):
+        return self.__ring.fileno()
+
+    def __get_count(self, offset):
+        return POSITION.unpack_from(self.__counts, offset)[0]
+
+    def put(self, value):
+        data = encode_value(value)
+        put_count = self.__get_count(OVERFLOW_PUT_OFFSET)
+        if put_count == self.__get_count(OVERFLOW_GET_OFFSET) and self.__ring.put_record(data):
+            return
+        self.__overflow.put(data)
+        POSITION.pack_into(self.__counts, OVERFLOW_PUT_OFFSET, put_count + 1)
+        self.__ring.ring_doorbell()
+
+    def __get_record(self):
+        put_count = self.__get_count(OVERFLOW_PUT_OFFSET)
+        data = self.__ring.get_record()
+        if data is None:
+            get_count = self.__get_count(OVERFLOW_GET_OFFSET)
+            if get_count < put_count:
+                # The value has been put, so it arrives once the queue's feeder thread has written it
+                data = self.__overflow.get()
+                POSITION.pack_into(self.__counts, OVERFLOW_GET_OFFSET, get_count + 1)
+        return data
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            # The doorbell is cleared before the buffer is checked, so a later record always rings it again
+            self.__ring.clear_doorbell()
+            data = self.__get_record()
+            if data is not None:
+                return decode_value(data)
+            if not block:
+                raise Queue.Empty
+            if deadline is None:
+                wait = None
+            else:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    raise Queue.Empty
+            try:
+                select.select([self.__ring.fileno()], [], [], wait)
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
@@ -0,0 +1,499 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import asyncore
+import collections
+import errno
+import select
+import socket
+import time
+import Queue
+
+import logmanager.logmanager
+import bitcoin.bitcoin_codec
+import network.network
+import network.poller
+import network.timer_queue
+import network.send_lanes
+import network.buffer_accounting
+import network.buffer_pool
+import network.listener
+import network.connector
+
+LM = logmanager.logmanager
+NET = network.network
+Poller = network.poller
+TQ = network.timer_queue
+Lanes = network.send_lanes
+Accounting = network.buffer_accounting
+BufferPool = network.buffer_pool
+Listener = network.listener
+Connector = network.connector
+
+RECV_SIZE = 0x10000
+
+WOULD_BLOCK = (errno.EWOULDBLOCK, errno.EAGAIN, 10035)
+
+WRITE_HIGH_WATER = 0x40000
+WRITE_LOW_WATER = 0x10000
+
+
+class PeerProtocol(asyncore.dispatcher):
+    """ An event loop driven connection to a peer
+
+    Encoded frames are owned by the transport write buffer, which is split into priority lanes. When it grows past
+    the high water mark, pause_writing() is called and further frames wait in the outbound queue until
+    resume_writing() is called once the buffer has drained below the low water mark. Control messages are small
+    and are never held back.
+    """
+
+    def __init__(self, manager, peer_id, host, port, message_codec, socket_map, buffer_pool, lane_quotas=None):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.__manager = manager
+        self.__message_codec = message_codec
+        self.__framer = bitcoin.bitcoin_codec.MessageFramer(message_codec)
+        self.__recv_buffer = BufferPool.ReceiveBuffer(buffer_pool, RECV_SIZE)
+        self.__outbound = collections.deque()
+        self.__outbound_bytes = 0
+        self.__write_lanes = Lanes.SendLanes(lane_quotas)
+        self.__write_frame = None
+        self.__write_offset = 0
+        self.__buffered = 0
+        self.__paused = False
+        self.__established = False
+        self.__closed = False
+        self.peer_id = peer_id
+        self.host = host
+        self.port = port
+        self.ip = None
+        self.outgoing = True
+        self.version = 0
+
+    def connection_made(self, s, outgoing):
+        """Takes over a connected socket, either accepted or established by the connector"""
+        s.setblocking(False)
+        self.ip = NET.convert_ip(s.getpeername())
+        self.set_socket(s)
+        self.connected = True
+        self.outgoing = outgoing
+        self.__established = True
+
+    def is_established(self):
+        return self.__established
+
+    def readable(self):
+        return self.connected and self.__manager._read_allowed(self)
+
+    def writable(self):
+        return self.__write_frame is not None or bool(self.__write_lanes)
+
+    def handle_error(self):
+        LM.log_exception()
+        self.handle_close()
+
+    def handle_close(self):
+        if self.__closed:
+            return
+        self.__closed = True
+        if self.socket is not None:
+            asyncore.dispatcher.close(self)
+        self.__recv_buffer.release()
+        self.__manager._connection_lost(self)
+
+    def handle_read(self):
+        try:
+            received = self.__recv_buffer.recv(self.socket, self.__framer)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            received = 0
+        if not received:
+            self.handle_close()
+            return
+        self.deliver()
+        self.__manager._update_usage(self)
+
+    def deliver(self):
+        for command, payload in self.__framer.frames(self.version):
+            self.__manager._message_received(self, command, payload)
+
+    def set_version(self, version):
+        """Sets the peer's version and delivers the frames which were held back until it was known"""
+        self.version = version
+        try:
+            self.deliver()
+        except Exception:
+            # This runs outside of handle_error, a bad stream must only close its own connection
+            LM.log_exception()
+            self.handle_close()
+
+    def get_send_bytes(self):
+        """Gets the bytes of frames which are waiting to be written"""
+        return self.__buffered + self.__outbound_bytes
+
+    def get_recv_bytes(self):
+        return self.__framer.get_buffered()
+
+    def get_recv_in_progress(self):
+        return self.__framer.get_in_progress()
+
+    def send_message(self, version, command, message, encoded=None):
+        if encoded is None:
+            encoded = self.__message_codec.encode_message(version, command, message)
+        lane = Lanes.get_lane(command)
+        if lane != Lanes.LANE_CONTROL and (self.__paused or self.__outbound):
+            self.__outbound.append((lane, encoded))
+            self.__outbound_bytes += len(encoded)
+        else:
+            self.__write(lane, encoded)
+
+    def __write(self, lane, encoded):
+        self.__write_lanes.put(lane, encoded)
+        self.__buffered += len(encoded)
+        if not self.__paused and self.__buffered > WRITE_HIGH_WATER:
+            self.pause_writing()
+
+    def handle_write(self):
+        while True:
+            frame = self.__write_frame
+            if frame is None:
+                entry = self.__write_lanes.pop()
+                if entry is None:
+                    break
+                lane, frame = entry
+                self.__write_lanes.charge(lane, len(frame))
+                self.__write_frame = frame
+            sent = self.send(memoryview(frame)[self.__write_offset:])
+            if not sent:
+                break
+            self.__write_offset += sent
+            self.__buffered -= sent
+            if self.__write_offset < len(frame):
+                break
+            self.__write_frame = None
+            self.__write_offset = 0
+        if self.__paused and self.__buffered <= WRITE_LOW_WATER:
+            self.resume_writing()
+        self.__manager._update_usage(self)
+
+    def pause_writing(self):
+        self.__paused = True
+
+    def resume_writing(self):
+        self.__paused = False
+        while self.__outbound and not self.__paused:
+            lane, encoded = self.__outbound.popleft()
+            self.__outbound_bytes -= len(encoded)
+            self.__write(lane, encoded)
+
+    def __repr__(self):
+        return "{id=%d, %s : %d}" % (self.peer_id, self.host, self.port)
+
+
+class QueueWaker(asyncore.dispatcher):
+    """ Wakes the event loop when the command queue pipe is readable, the queue itself reads the data """
+
+    def __init__(self, fd, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self._fileno = fd
+        self.add_channel()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read_event(self):
+        pass
+
+    def close(self):
+        self.del_channel()
+
+
+class ListenWaker(asyncore.dispatcher):
+    """ Calls back when a listening socket has connections waiting, the callback accepts them """
+
+    def __init__(self, listen_socket, callback, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.__callback = callback
+        self.set_socket(listen_socket)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read_event(self):
+        self.__callback(self.socket)
+
+
+class ConnectWaker(asyncore.dispatcher):
+    """ Passes the events of a connector file descriptor from the event loop to the connector """
+
+    def __init__(self, fd, events, callback, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self._fileno = fd
+        self.__events = events
+        self.__callback = callback
+        self.__closed = False
+        self.add_channel()
+
+    def readable(self):
+        return bool(self.__events & Poller.EVENT_READ)
+
+    def writable(self):
+        return bool(self.__events & Poller.EVENT_WRITE)
+
+    def handle_read_event(self):
+        self.__event(Poller.EVENT_READ)
+
+    def handle_write_event(self):
+        self.__event(Poller.EVENT_WRITE)
+
+    def handle_expt_event(self):
+        self.__event(self.__events)
+
+    def handle_close(self):
+        self.__event(self.__events)
+
+    def __event(self, events):
+        # The connector may have closed the fd while handling an earlier event from the same poll
+        if not self.__closed:
+            self.__callback(self._fileno, events)
+
+    def close(self):
+        self.__closed = True
+        self.del_channel()
+
+
+class DispatcherPoller(object):
+    """ The poller interface used by the Connector, on top of an asyncore socket map """
+
+    def __init__(self, socket_map):
+        self.__socket_map = socket_map
+        self.__wakers = {}
+        self.__handler = None
+
+    def set_handler(self, handler):
+        self.__handler = handler
+
+    def register(self, fd, events):
+        self.__wakers[fd] = ConnectWaker(fd, events, self.__handle_event, self.__socket_map)
+
+    def unregister(self, fd):
+        self.__wakers.pop(fd).close()
+
+    def __handle_event(self, fd, events):
+        self.__handler(fd, events)
+
+
+class AsyncPeerManager(NET.PeerManager):
+    """ Peer manager running all connections as asyncore protocols on one event loop
+
+    Timers on the loop replace polling. Outbound connections are established by a Connector sharing the loop. While
+    there are connections a periodic timer checks buffer limits and reports usage. Handshake timeouts are left to the
+    node, as for the other engines.
+    """
+
+    def __init__(self, protocol_info, log_queue, connect_timeout=5, ipc=LM.IPC_QUEUE,
+                 lane_quotas=None, shard_ring=None, shard=0, fast_path=None):
+        self.__protocol_info = protocol_info
+        self.__lane_quotas = lane_quotas
+        self.__connect_timeout = connect_timeout
+        self.__message_codec = None
+        self.__socket_map = None
+        self.__connector = None
+        self.__timers = None
+        self.__connections = None
+        self.__listeners = None
+        self.__accounting = None
+        self.__buffer_pool = None
+        self.__buffer_timer = None
+        self.__next_stats = None
+        super(AsyncPeerManager, self).__init__(protocol_info, log_queue, ipc, shard_ring=shard_ring, shard=shard,
+                                               fast_path=fast_path)
+
+    def call_later(self, delay, callback, *args):
+        return self.__timers.call_later(delay, callback, *args)
+
+    def _execute(self):
+        self.__message_codec = bitcoin.bitcoin_codec.MessageCodec(self.__protocol_info)
+        self.__socket_map = {}
+        poller = DispatcherPoller(self.__socket_map)
+        self.__connector = Connector.Connector(poller, timeout=self.__connect_timeout)
+        poller.set_handler(self.__connector.handle_event)
+        self.__timers = TQ.TimerQueue()
+        self.__connections = {}
+        self.__listeners = []
+        self.__accounting = self._create_accounting()
+        self.__buffer_pool = BufferPool.BufferPool()
+        self.__next_stats = time.time() + Accounting.STATS_INTERVAL
+
+        use_poll = hasattr(select, 'poll')
+
+        if Poller.PIPES_SELECTABLE:
+            QueueWaker(self._mp_queue_fileno_internal(), self.__socket_map)
+
+        LM.info("Starting Network Manager (async)")
+
+        try:
+            while not self._interrupted:
+                while True:
+                    try:
+                        mp_data = self._mp_queue_get_internal(False)
+                    except Queue.Empty:
+                        mp_data = None
+                    if not mp_data:
+                        break
+
+                    mp_command = mp_data[0]
+
+                    if mp_command == self.CMD_CONNECT:
+                        self.__connect(self._next_peer_id(), mp_data[1], mp_data[2])
+                    elif mp_command == self.CMD_DISCONNECT:
+                        conn = self.__connections.get(mp_data[1])
+                        if conn:
+                            conn.handle_close()
+                    elif mp_command == self.CMD_LISTEN:
+                        for s in self._open_listeners(mp_data):
+                            self.__listeners.append(ListenWaker(s, self.__accept, self.__socket_map))
+                    elif mp_command == self.CMD_SEND_MESSAGE:
+                        conn = self.__connections.get(mp_data[1])
+                        if conn:
+                            self.__send(conn, mp_data[2], mp_data[3], mp_data[4])
+                    elif mp_command == self.CMD_BROADCAST:
+                        self.__broadcast(mp_data[1], mp_data[2], mp_data[3])
+                    elif mp_command == self.CMD_SET_VERSION:
+                        conn = self.__connections.get(mp_data[1])
+                        if conn:
+                            conn.set_version(mp_data[2])
+                    elif mp_command == self.CMD_SHUTDOWN:
+                        return
+
+                self.__timers.run_due()
+                connect_timeout = self.__connector.check()
+                self.__connected(self.__connector.get_results())
+
+                self._mp_queue_flush_internal()
+
+                timeout = self.__timers.get_timeout()
+                if connect_timeout is not None and (timeout is None or connect_timeout < timeout):
+                    timeout = connect_timeout
+                timeout = Poller.limit_timeout(timeout)
+                if self.__socket_map:
+                    asyncore.loop(timeout, use_poll, self.__socket_map, 1)
+                else:
+                    time.sleep(timeout)
+        finally:
+            for conn in self.__connections.values():
+                conn.handle_close()
+            for listener in self.__listeners:
+                listener.close()
+            self.__connector.close()
+            self._mp_queue_flush_internal()
+
+    def __add_connection(self, peer_id, host, port):
+        conn = PeerProtocol(self, peer_id, host, port, self.__message_codec, self.__socket_map, self.__buffer_pool,
+                            self.__lane_quotas)
+        self.__connections[peer_id] = conn
+        if self.__buffer_timer is None:
+            self.__buffer_timer = self.call_later(Accounting.CHECK_INTERVAL, self.__check_buffers)
+        return conn
+
+    def __accept(self, listen_socket):
+        for s, address in Listener.accept_connections(listen_socket):
+            conn = self.__add_connection(self._next_peer_id(), Listener.get_peer_host(address), address[1])
+            self.__connection_made(conn, s, False)
+
+    def __connect(self, peer_id, host, port):
+        self.__add_connection(peer_id, host, port)
+        self.__connector.connect(peer_id, host, port)
+
+    def __connected(self, results):
+        for peer_id, s in results:
+            conn = self.__connections.get(peer_id)
+            if conn is None:
+                if s:
+                    s.close()
+            elif s is None:
+                conn.handle_close()
+            else:
+                self.__connection_made(conn, s, True)
+
+    def __connection_made(self, conn, s, outgoing):
+        try:
+            conn.connection_made(s, outgoing)
+        except socket.error:
+            s.close()
+            conn.handle_close()
+            return
+        self._mp_queue_put_internal((self.INFO_CONNECTED, conn.peer_id, conn.host, conn.ip, conn.port,
+                                     conn.outgoing))
+
+    def __broadcast(self, targets, command, message):
+        frames = {}
+        for peer_id, version in targets:
+            conn = self.__connections.get(peer_id)
+            if not conn:
+                continue
+            encoded = frames.get(version)
+            if encoded is None:
+                encoded = self.__message_codec.encode_message(version, command, message)
+                frames[version] = encoded
+            self.__send(conn, version, command, message, encoded)
+
+    def __send(self, conn, version, command, message, encoded=None):
+        if Lanes.get_lane(command) != Lanes.LANE_CONTROL and not self.__accounting.send_allowed(conn.peer_id):
+            self.__accounting.reject(conn.peer_id)
+            return
+        conn.send_message(version, command, message, encoded)
+        self._update_usage(conn)
+
+    def __check_buffers(self):
+        t = time.time()
+        for conn in self.__connections.values():
+            if conn.is_established():
+                self.__accounting.update(conn.peer_id, conn.get_send_bytes(), conn.get_recv_bytes(), t,
+                                         conn.get_recv_in_progress())
+        for peer_id in self.__accounting.get_expired(t):
+            conn = self.__connections.get(peer_id)
+            if conn:
+                LM.info("Peer %r over buffer limit, disconnecting" % conn)
+                conn.handle_close()
+        if t >= self.__next_stats:
+            self._put_buffer_stats(self.__accounting)
+            self._put_fast_path_stats()
+            self.__next_stats = t + Accounting.STATS_INTERVAL
+        if self.__connections:
+            self.__buffer_timer = self.call_later(Accounting.CHECK_INTERVAL, self.__check_buffers)
+        else:
+            self.__buffer_timer = None
+
+    def _update_usage(self, conn):
+        if conn.peer_id not in self.__connections:
+            return
+        self.__accounting.update(conn.peer_id, conn.get_send_bytes(), conn.get_recv_bytes(),
+                                 recv_in_progress=conn.get_recv_in_progress())
+
+    def _read_allowed(self, conn):
+        return self.__accounting.read_allowed(conn.peer_id)
+
+    def _connection_lost(self, conn):
+        if self.__connections.pop(conn.peer_id, None) is None:
+            return
+        self.__accounting.remove(conn.peer_id)
+        if conn.is_established():
+            self._mp_queue_put_internal((self.INFO_DISCONNECTED, conn.peer_id, conn.host, conn.port))
+        else:
+            self.__connector.cancel(conn.peer_id)
+            self._mp_queue_put_internal((self.INFO_CONNECT_FAILED, conn.peer_id, conn.host, conn.port))
+
+    def _message_received(self, conn, command, payload):
+        replies = self._get_fast_path().handle(conn.version, command, payload)
+        if replies is None:
+            self._mp_queue_put_internal((self.INFO_MSG_RECEIVED, conn.peer_id, command, payload))
+            return
+        for reply_command, reply in replies:
+            encoded = self.__message_codec.encode_frame(reply_command, reply)
+            self.__send(conn, conn.version, reply_command, None, encoded)
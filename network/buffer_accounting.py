@@ -0,0 +1,103 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+SEND, RECV, REJECTED, IN_PROGRESS = range(4)
+
+PEER_SEND_HIGH_WATER = 0x400000
+PEER_RECV_HIGH_WATER = 0x400000
+GLOBAL_SEND_HIGH_WATER = 0x4000000
+GLOBAL_RECV_HIGH_WATER = 0x8000000
+
+# Peers over a limit for this long are disconnected
+OVER_LIMIT_TIMEOUT = 30
+
+# How often engines re-check limits and how often usage is reported
+CHECK_INTERVAL = 1.0
+STATS_INTERVAL = 10.0
+
+
+class BufferAccounting(object):
+    """ Byte accounting for the queued outbound frames and partially received data of every peer
+
+    A peer is over a limit when its bytes for that direction exceed the per peer high water mark, or when the
+    global total exceeds the global high water mark and the peer holds more than an equal share of it. Sends to
+    a peer over its send limit should be rejected and reading from a peer over its receive limit paused. The
+    time a peer went over a limit is recorded when its usage is updated, peers which stay over for longer than
+    over_limit_timeout are returned by get_expired.
+
+    The received bytes of the one frame a peer is in the middle of sending are not held against its receive high
+    water mark, so a peer may send a message larger than the mark while everything it queues behind it is limited.
+    They are still part of the peer's usage and of the global total.
+    """
+
+    def __init__(self, peer_recv_high_water=PEER_RECV_HIGH_WATER, peer_send_high_water=PEER_SEND_HIGH_WATER,
+                 global_send_high_water=GLOBAL_SEND_HIGH_WATER, global_recv_high_water=GLOBAL_RECV_HIGH_WATER,
+                 over_limit_timeout=OVER_LIMIT_TIMEOUT):
+        self.__peer_limits = (peer_send_high_water, peer_recv_high_water)
+        self.__global_limits = (global_send_high_water, global_recv_high_water)
+        self.__over_limit_timeout = over_limit_timeout
+        self.__usage = {}
+        self.__totals = [0, 0]
+        self.__over_since = {}
+
+    def update(self, peer_id, send_bytes, recv_bytes, t=None, recv_in_progress=0):
+        """Updates a peer's usage, recv_in_progress are the received bytes of the frame being received"""
+        usage = self.__usage.get(peer_id)
+        if usage is None:
+            usage = [0, 0, 0, 0]
+            self.__usage[peer_id] = usage
+        self.__totals[SEND] += send_bytes - usage[SEND]
+        self.__totals[RECV] += recv_bytes - usage[RECV]
+        usage[SEND] = send_bytes
+        usage[RECV] = recv_bytes
+        usage[IN_PROGRESS] = recv_in_progress
+        if self.is_over(peer_id, SEND) or self.is_over(peer_id, RECV):
+            if peer_id not in self.__over_since:
+                self.__over_since[peer_id] = time.time() if t is None else t
+        else:
+            self.__over_since.pop(peer_id, None)
+
+    def remove(self, peer_id):
+        usage = self.__usage.pop(peer_id, None)
+        if usage is not None:
+            self.__totals[SEND] -= usage[SEND]
+            self.__totals[RECV] -= usage[RECV]
+        self.__over_since.pop(peer_id, None)
+
+    def reject(self, peer_id):
+        """Counts a send which was rejected because the peer was over its send limit"""
+        usage = self.__usage.get(peer_id)
+        if usage is not None:
+            usage[REJECTED] += 1
+
+    def is_over(self, peer_id, direction):
+        usage = self.__usage.get(peer_id)
+        if usage is None:
+            return False
+        used = usage[direction]
+        limited = used - usage[IN_PROGRESS] if direction == RECV else used
+        if limited > self.__peer_limits[direction]:
+            return True
+        total = self.__totals[direction]
+        return total > self.__global_limits[direction] and used * len(self.__usage) > total
+
+    def send_allowed(self, peer_id):
+        return not self.is_over(peer_id, SEND)
+
+    def read_allowed(self, peer_id):
+        return not self.is_over(peer_id, RECV)
+
+    def get_expired(self, t=None):
+        """Gets the ids of peers which have been over a limit for longer than the timeout"""
+        if t is None:
+            t = time.time()
+        return [peer_id for peer_id, since in self.__over_since.items() if t - since > self.__over_limit_timeout]
+
+    def get_totals(self):
+        return tuple(self.__totals)
+
+    def get_stats(self):
+        """Gets (send_total, recv_total, {peer_id: (send, recv, rejected)}) for reporting"""
+        usage = dict((peer_id, tuple(u[0:IN_PROGRESS])) for peer_id, u in self.__usage.items())
+        return self.__totals[SEND], self.__totals[RECV], usage
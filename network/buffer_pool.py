@@ -0,0 +1,77 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+
+MIN_RECV_SIZE = 0x4000
+MAX_RECV_SIZE = 0x40000
+
+MAX_POOLED_PER_SIZE = 32
+
+
+def get_recv_size(wanted, minimum=MIN_RECV_SIZE, maximum=MAX_RECV_SIZE):
+    """Gets the power of two read size for a wanted number of bytes, limited to [minimum, maximum]"""
+    size = minimum
+    while size < wanted and size < maximum:
+        size <<= 1
+    return min(size, maximum)
+
+
+class BufferPool(object):
+    """ Thread safe pool of preallocated bytearrays, kept in free lists by size """
+
+    def __init__(self, max_pooled=MAX_POOLED_PER_SIZE):
+        self.__free = {}
+        self.__max_pooled = max_pooled
+        self.__lock = threading.Lock()
+
+    def get(self, size):
+        with self.__lock:
+            free = self.__free.get(size)
+            if free:
+                return free.pop()
+        return bytearray(size)
+
+    def release(self, buf):
+        with self.__lock:
+            free = self.__free.setdefault(len(buf), [])
+            if len(free) < self.__max_pooled:
+                free.append(buf)
+
+    def get_pooled(self):
+        """Gets the number of free buffers held by the pool"""
+        with self.__lock:
+            return sum(len(free) for free in self.__free.values())
+
+
+class ReceiveBuffer(object):
+    """ A connection's receive buffer, taken from a pool
+
+    Data is read with recv_into and fed to the connection's framer. The read size follows the number of bytes
+    the framer is waiting for, so it grows while a large frame is in flight and shrinks again afterwards.
+    """
+
+    def __init__(self, pool, min_size=MIN_RECV_SIZE, max_size=MAX_RECV_SIZE):
+        self.__pool = pool
+        self.__min_size = min_size
+        self.__max_size = max_size
+        self.__buf = None
+        self.__view = None
+
+    def recv(self, s, framer):
+        """Reads from a socket into the framer and returns the number of bytes read, 0 at end of stream"""
+        size = get_recv_size(framer.get_wanted(), self.__min_size, self.__max_size)
+        if self.__buf is None or len(self.__buf) != size:
+            self.release()
+            self.__buf = self.__pool.get(size)
+            self.__view = memoryview(self.__buf)
+        n = s.recv_into(self.__buf, size)
+        if n:
+            framer.feed(self.__view[:n])
+        return n
+
+    def release(self):
+        """Returns the buffer to the pool, it is taken again by the next recv"""
+        if self.__buf is not None:
+            self.__view = None
+            self.__pool.release(self.__buf)
+            self.__buf = None
@@ -0,0 +1,325 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+import errno
+import socket
+import threading
+import time
+import Queue
+
+import logmanager.logmanager
+import network.poller
+
+LM = logmanager.logmanager
+Poller = network.poller
+
+# Dials which may be in progress at once, further connects wait for a free slot
+MAX_DIALS = 32
+
+# Time a dial may take, including name resolution and every address attempt
+CONNECT_TIMEOUT = 5
+
+# Delay before the next address is attempted while earlier attempts are still in progress (RFC 8305)
+ATTEMPT_DELAY = 0.25
+
+RESOLVER_THREADS = 4
+DNS_TTL = 300
+DNS_NEGATIVE_TTL = 30
+
+CONNECT_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN, 10035)
+
+
+def order_addresses(addresses):
+    """Orders getaddrinfo results for Happy Eyeballs, alternating address families starting with the first"""
+    families = collections.OrderedDict()
+    for res in addresses:
+        families.setdefault(res[0], collections.deque()).append(res)
+    ordered = []
+    queues = families.values()
+    while queues:
+        for queue in queues:
+            ordered.append(queue.popleft())
+        queues = [queue for queue in queues if queue]
+    return ordered
+
+
+def get_numeric_addresses(host, port):
+    """Gets the addresses for a numeric host without a lookup, or None if the host is a name"""
+    try:
+        return socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_NUMERICHOST)
+    except socket.error:
+        return None
+
+
+class DNSCache(object):
+    """ Thread safe cache of getaddrinfo results, failed lookups are kept for a shorter time """
+
+    def __init__(self, ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL):
+        self.__ttl = ttl
+        self.__negative_ttl = negative_ttl
+        self.__entries = {}
+        self.__lock = threading.Lock()
+
+    def get(self, host, port, t=None):
+        """Gets the cached addresses for a host, None if they are not cached"""
+        if t is None:
+            t = time.time()
+        with self.__lock:
+            entry = self.__entries.get((host, port))
+            if entry is None:
+                return None
+            if entry[0] < t:
+                del self.__entries[(host, port)]
+                return None
+            return entry[1]
+
+    def put(self, host, port, addresses, t=None):
+        if t is None:
+            t = time.time()
+        ttl = self.__ttl if addresses else self.__negative_ttl
+        with self.__lock:
+            self.__entries[(host, port)] = (t + ttl, addresses)
+
+
+class Resolver(object):
+    """ Pool of threads running getaddrinfo, so a slow lookup does not block the network loop
+
+    Results are cached and queued for get_results(), the wakeup is set when a result is ready.
+    """
+
+    def __init__(self, cache=None, threads=RESOLVER_THREADS):
+        self.__cache = DNSCache() if cache is None else cache
+        self.__requests = Queue.Queue()
+        self.__results = Queue.Queue()
+        self.__wakeup = Poller.Wakeup()
+        self.__threads = []
+        for i in range(threads):
+            thread = LM.LoggingThread(target=self.__execute, name="Resolver %d" % i)
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def fileno(self):
+        return self.__wakeup.fileno()
+
+    def get_cache(self):
+        return self.__cache
+
+    def resolve(self, host, port):
+        self.__requests.put((host, port))
+
+    def get_results(self):
+        """Gets the (host, port, addresses) lookups which have completed"""
+        if Poller.PIPES_SELECTABLE:
+            self.__wakeup.clear()
+        results = []
+        while True:
+            try:
+                results.append(self.__results.get(False))
+            except Queue.Empty:
+                return results
+
+    def close(self):
+        for thread in self.__threads:
+            self.__requests.put(None)
+        self.__wakeup.close()
+
+    def __execute(self):
+        while True:
+            request = self.__requests.get()
+            if request is None:
+                return
+            host, port = request
+            try:
+                addresses = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+            except socket.error:
+                addresses = []
+            self.__cache.put(host, port, addresses)
+            self.__results.put((host, port, addresses))
+            if Poller.PIPES_SELECTABLE:
+                self.__wakeup.set()
+
+
+class Dial(object):
+    """ A connection being established, with a socket for each address attempt in progress """
+
+    def __init__(self, key, host, port, deadline):
+        self.key = key
+        self.host = host
+        self.port = port
+        self.deadline = deadline
+        self.addresses = None
+        self.attempts = {}
+        self.next_attempt = None
+
+
+class Connector(object):
+    """ Non-blocking connection establishment for an event loop
+
+    Dials resolve their host through the Resolver or its cache and then race their addresses using Happy
+    Eyeballs. The first address is tried immediately and, while no attempt has succeeded, the next one is started
+    every ATTEMPT_DELAY seconds or as soon as an attempt fails, alternating between IP6 and IP4. The first socket
+    to connect wins and the other attempts are closed. At most max_dials dials are in progress at once.
+
+    Sockets are registered with the owner's poller, which must pass their events to handle_event. The owner
+    calls check() every loop, which returns the time until the next dial deadline, and collects the
+    (key, socket) results with get_results(). A failed dial gives a socket of None.
+    """
+
+    def __init__(self, poller, resolver=None, max_dials=MAX_DIALS, timeout=CONNECT_TIMEOUT,
+                 attempt_delay=ATTEMPT_DELAY):
+        self.__poller = poller
+        self.__resolver = Resolver() if resolver is None else resolver
+        self.__max_dials = max_dials
+        self.__timeout = timeout
+        self.__attempt_delay = attempt_delay
+        self.__waiting = collections.deque()
+        self.__dials = {}
+        self.__resolving = {}
+        self.__fds = {}
+        self.__results = []
+        if Poller.PIPES_SELECTABLE:
+            self.__poller.register(self.__resolver.fileno(), Poller.EVENT_READ)
+
+    def connect(self, key, host, port):
+        self.__waiting.append((key, host, port))
+        self.__start_waiting()
+
+    def cancel(self, key):
+        dial = self.__dials.get(key)
+        if dial:
+            self.__finish(dial, None, False)
+        else:
+            self.__waiting = collections.deque(entry for entry in self.__waiting if entry[0] != key)
+
+    def get_dial_count(self):
+        return len(self.__dials)
+
+    def handles(self, fd):
+        return fd in self.__fds or fd == self.__resolver.fileno()
+
+    def handle_event(self, fd, events):
+        if fd == self.__resolver.fileno():
+            self.__handle_resolved()
+            return
+        dial = self.__fds.get(fd)
+        if dial is None:
+            return
+        s = dial.attempts[fd]
+        err = s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err == 0:
+            try:
+                s.getpeername()
+            except socket.error:
+                err = errno.ENOTCONN
+        if err == 0:
+            self.__remove_attempt(dial, fd)
+            self.__finish(dial, s)
+            return
+        # A failed attempt lets the next address start without waiting for the attempt delay
+        self.__remove_attempt(dial, fd).close()
+        self.__next_attempt(dial)
+
+    def check(self, t=None):
+        """Handles lookups, attempt delays and deadlines, returns the time until the next of them or None"""
+        if t is None:
+            t = time.time()
+        self.__handle_resolved()
+        next_time = None
+        for dial in self.__dials.values():
+            if dial.deadline <= t:
+                self.__finish(dial, None)
+                continue
+            if dial.next_attempt is not None and dial.next_attempt <= t:
+                self.__next_attempt(dial, t)
+                if dial.key not in self.__dials:
+                    continue
+            for dial_time in (dial.deadline, dial.next_attempt):
+                if dial_time is not None and (next_time is None or dial_time < next_time):
+                    next_time = dial_time
+        if next_time is None:
+            return None
+        return max(0.0, next_time - t)
+
+    def get_results(self):
+        results = self.__results
+        self.__results = []
+        return results
+
+    def close(self):
+        for dial in self.__dials.values():
+            self.__finish(dial, None, False)
+        if Poller.PIPES_SELECTABLE:
+            self.__poller.unregister(self.__resolver.fileno())
+        self.__resolver.close()
+
+    def __start_waiting(self):
+        t = time.time()
+        while self.__waiting and len(self.__dials) < self.__max_dials:
+            key, host, port = self.__waiting.popleft()
+            dial = Dial(key, host, port, t + self.__timeout)
+            self.__dials[key] = dial
+            addresses = get_numeric_addresses(host, port)
+            if addresses is None:
+                addresses = self.__resolver.get_cache().get(host, port, t)
+            if addresses is not None:
+                self.__set_addresses(dial, addresses)
+                continue
+            waiting = self.__resolving.get((host, port))
+            if waiting is None:
+                # Dials to the same host share one lookup
+                self.__resolving[(host, port)] = [dial]
+                self.__resolver.resolve(host, port)
+            else:
+                waiting.append(dial)
+
+    def __handle_resolved(self):
+        for host, port, addresses in self.__resolver.get_results():
+            for dial in self.__resolving.pop((host, port), []):
+                if dial.key in self.__dials:
+                    self.__set_addresses(dial, addresses)
+
+    def __set_addresses(self, dial, addresses):
+        dial.addresses = collections.deque(order_addresses(addresses))
+        self.__next_attempt(dial)
+
+    def __next_attempt(self, dial, t=None):
+        """Starts an attempt on the next address which can be tried, failing the dial if none are left"""
+        dial.next_attempt = None
+        while dial.addresses:
+            af, socket_type, protocol, canonical_name, socket_address = dial.addresses.popleft()
+            try:
+                s = socket.socket(af, socket_type, protocol)
+            except socket.error:
+                continue
+            try:
+                s.setblocking(False)
+                err = s.connect_ex(socket_address)
+            except socket.error:
+                s.close()
+                continue
+            if err != 0 and err not in CONNECT_IN_PROGRESS:
+                s.close()
+                continue
+            fd = s.fileno()
+            dial.attempts[fd] = s
+            self.__fds[fd] = dial
+            self.__poller.register(fd, Poller.EVENT_WRITE)
+            if dial.addresses:
+                dial.next_attempt = (time.time() if t is None else t) + self.__attempt_delay
+            return
+        if not dial.attempts:
+            self.__finish(dial, None)
+
+    def __remove_attempt(self, dial, fd):
+        self.__poller.unregister(fd)
+        del self.__fds[fd]
+        return dial.attempts.pop(fd)
+
+    def __finish(self, dial, s, report=True):
+        del self.__dials[dial.key]
+        for fd in dial.attempts.keys():
+            self.__remove_attempt(dial, fd).close()
+        if report:
+            self.__results.append((dial.key, s))
+        self.__start_waiting()
@@ -0,0 +1,83 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import struct
+import threading
+
+NONCE = struct.Struct(b"<Q")
+
+
+class FastPathHandler(object):
+    """ Answers a stateless message inside the network process, without sending it to the node
+
+    handle() returns a list of (command, payload) replies, which the network frames and sends, or None to pass the
+    message on to the node as usual. Replies are encoded payloads, as the network does not decode messages.
+    """
+
+    def commands(self):
+        return ()
+
+    def handle(self, version, command, payload):
+        return None
+
+
+class PingHandler(FastPathHandler):
+    """ Replies to pings with pongs, so remote peers measure their latency to us without our queues """
+
+    def commands(self):
+        return u"ping",
+
+    def handle(self, version, command, payload):
+        if version == 0:
+            # Pings before the version exchange are the node's business
+            return None
+        if version <= 60000:
+            # Pings before BIP 31 have no nonce and no pong
+            return []
+        if len(payload) < NONCE.size:
+            return None
+        # A pong carries the nonce of its ping, so the ping's payload is the pong's
+        return [(u"pong", payload[0:NONCE.size])]
+
+
+class FastPathTable(object):
+    """ Handlers for the commands which are answered in the network process
+
+    Each command answered with a reply is counted. The counts are reported to the node with INFO_FAST_PATH_STATS instead of the
+    messages themselves. Peer threads share one table, so the counts are locked.
+    """
+
+    def __init__(self, handlers=()):
+        self.__handlers = {}
+        self.__counts = {}
+        self.__lock = threading.Lock()
+        for handler in handlers:
+            self.register(handler)
+
+    def __contains__(self, command):
+        return command in self.__handlers
+
+    def register(self, handler):
+        for command in handler.commands():
+            self.__handlers[command] = handler
+
+    def handle(self, version, command, payload):
+        """Gets the replies for a message, or None if the node handles it"""
+        handler = self.__handlers.get(command)
+        if handler is None:
+            return None
+        replies = handler.handle(version, command, payload)
+        if replies:
+            with self.__lock:
+                self.__counts[command] = self.__counts.get(command, 0) + 1
+        return replies
+
+    def pop_counts(self):
+        """Gets the {command: count} of messages answered since the last call"""
+        with self.__lock:
+            counts = self.__counts
+            self.__counts = {}
+        return counts
+
+
+def get_default_table():
+    return FastPathTable([PingHandler()])
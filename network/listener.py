@@ -0,0 +1,84 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import errno
+import socket
+
+import logmanager.logmanager
+
+LM = logmanager.logmanager
+
+DEFAULT_BACKLOG = 1024
+
+# Connections accepted per listener readiness event, so a connection storm cannot stall the loop
+ACCEPT_BATCH = 64
+
+ACCEPT_WOULD_BLOCK = (errno.EWOULDBLOCK, errno.EAGAIN, 10035)
+
+
+def _open_socket(af, address, backlog, reuse_port):
+    s = socket.socket(af, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise socket.error(errno.ENOPROTOOPT, "SO_REUSEPORT is not supported")
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if af == socket.AF_INET6 and hasattr(socket, 'IPV6_V6ONLY'):
+            # Accept IP4 connections as mapped addresses on the same socket
+            s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        s.bind(address)
+        s.listen(backlog)
+        s.setblocking(False)
+    except socket.error:
+        s.close()
+        raise
+    return s
+
+
+def get_listen_sockets(port, host=None, backlog=DEFAULT_BACKLOG, reuse_port=False):
+    """Gets non-blocking listening sockets for a port
+
+    With no host, a single dual-stack IP6 socket is used where possible, falling back to IP4. With a host, a
+    socket is bound to each of its addresses. If reuse_port is set, SO_REUSEPORT allows several processes to
+    listen on the same port and the kernel shares incoming connections between them.
+    """
+    if host is None:
+        if socket.has_ipv6:
+            try:
+                return [_open_socket(socket.AF_INET6, ("::", port), backlog, reuse_port)]
+            except socket.error:
+                pass
+        return [_open_socket(socket.AF_INET, ("0.0.0.0", port), backlog, reuse_port)]
+
+    sockets = []
+    for res in socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE):
+        af, socket_type, protocol, canonical_name, socket_address = res
+        try:
+            sockets.append(_open_socket(af, socket_address, backlog, reuse_port))
+        except socket.error:
+            continue
+    if not sockets:
+        raise socket.error(errno.EADDRNOTAVAIL, "Unable to listen on %s:%d" % (host, port))
+    return sockets
+
+
+def accept_connections(listen_socket, limit=ACCEPT_BATCH):
+    """Accepts up to limit waiting connections from a non-blocking listening socket, returns (socket, address)
+    pairs"""
+    accepted = []
+    while len(accepted) < limit:
+        try:
+            accepted.append(listen_socket.accept())
+        except socket.error as e:
+            if e.args[0] not in ACCEPT_WOULD_BLOCK:
+                LM.info("Accept failed: %s" % e)
+            break
+    return accepted
+
+
+def get_peer_host(address):
+    """Gets the host string for an accepted connection, IP4 mapped IP6 addresses are shown as IP4"""
+    host = address[0]
+    if host.startswith("::ffff:") and "." in host:
+        return host[7:]
+    return host
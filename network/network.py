@@ -1,12 +1,33 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import socket
+import threading
+import time
 import Queue
 import logmanager.logmanager
 import bitcoin.byte_array_codec
 import bitcoin.bitcoin_codec
+import network.poller
+import network.send_lanes
+import network.buffer_accounting
+import network.buffer_pool
+import network.listener
+import network.connector
+import network.fast_path
 
 LM = logmanager.logmanager
+Poller = network.poller
+Lanes = network.send_lanes
+Accounting = network.buffer_accounting
+BufferPool = network.buffer_pool
+Listener = network.listener
+Connector = network.connector
+FastPath = network.fast_path
+
+SEND_COALESCE_LIMIT = 0x40000
+
+# How long a peer thread waits for the version to be set before reading more data
+VERSION_WAIT = 5
 
 class DecodeError(Exception): pass
 class EncodeError(Exception): pass
@@ -37,7 +58,11 @@ def get_server_socket(port):
 def get_client_socket(host, port, timeout=5):
     """ Gets a client socket"""
     s = None
-    for res in socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM):
+    try:
+        addresses = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+    except socket.error:
+        return None
+    for res in addresses:
         af, socket_type, protocol, canonical_name, socket_address = res
         try:
             s = socket.socket(af, socket_type, protocol)
@@ -56,17 +81,36 @@ def get_client_socket(host, port, timeout=5):
 
 
 class PeerManager(LM.LoggingProcess):
-    """ Container which holds active peers """
+    """ Container which holds active peers
+
+    Queued outbound frames and partially received data are tracked by a BufferAccounting. Reading is paused for
+    peers over the receive limit, sends other than control messages are rejected for peers over the send limit
+    and peers which stay over a limit are disconnected. Usage is reported with INFO_BUFFER_STATS events.
 
-    INFO_CONNECTED, INFO_DISCONNECTED, INFO_CONNECT_FAILED, INFO_MSG_RECEIVED = range(4)
+    Commands in the fast path table, ping by default, are answered without the node and only counted, the counts
+    are reported with INFO_FAST_PATH_STATS events.
+    """
 
-    CMD_CONNECT, CMD_DISCONNECT, CMD_SEND_MESSAGE, CMD_SHUTDOWN, CMD_SET_VERSION = range(5)
+    INFO_CONNECTED, INFO_DISCONNECTED, INFO_CONNECT_FAILED, INFO_MSG_RECEIVED, INFO_BUFFER_STATS, \
+        INFO_FAST_PATH_STATS = range(6)
 
-    def __init__(self, protocol_info, log_queue):
+    CMD_CONNECT, CMD_DISCONNECT, CMD_SEND_MESSAGE, CMD_SHUTDOWN, CMD_SET_VERSION, CMD_BROADCAST, CMD_LISTEN = range(7)
+
+    def __init__(self, protocol_info, log_queue, ipc=LM.IPC_QUEUE, lane_quotas=None, shard_ring=None, shard=0,
+                 fast_path=None):
         self.__peers = {}
+        self.__fast_path = FastPath.get_default_table() if fast_path is None else fast_path
         self.__info_queue = None
+        self.__wakeup = None
         self.__protocol_info = protocol_info
-        super(PeerManager, self).__init__(log_queue=log_queue, name="Network", target=self._execute, args=())
+        self.__lane_quotas = lane_quotas
+        self.__accounting = None
+        self.__buffer_pool = None
+        self.__shard_ring = shard_ring
+        self.__shard = shard
+        self.__peer_id_counter = 0
+        name = "Network" if shard_ring is None else "Network %d" % shard
+        super(PeerManager, self).__init__(log_queue=log_queue, name=name, target=self._execute, args=(), ipc=ipc)
 
     def connect(self, hostname, port):
         self.mp_queue_put((self.CMD_CONNECT, hostname, port))
@@ -74,37 +118,141 @@ class PeerManager(LM.LoggingProcess):
     def disconnect(self, peer_id):
         self.mp_queue_put((self.CMD_DISCONNECT, peer_id))
 
+    def listen(self, port, host=None, backlog=Listener.DEFAULT_BACKLOG, reuse_port=False):
+        """Accepts inbound peers on a port, see network.listener.get_listen_sockets"""
+        self.mp_queue_put((self.CMD_LISTEN, port, host, backlog, reuse_port))
+
     def set_version(self, peer_id, version):
         self.mp_queue_put((self.CMD_SET_VERSION, peer_id, version))
 
     def shutdown(self):
         self.mp_queue_put((self.CMD_SHUTDOWN, ))
+        self.mp_queue_flush()
         self.join()
 
     def send_message(self, peer_id, version, command, message):
         self.mp_queue_put((self.CMD_SEND_MESSAGE, peer_id, version, command, message))
 
+    def broadcast(self, targets, command, message):
+        """Sends a message to a list of (peer_id, version) targets, encoding it once per version"""
+        self.mp_queue_put((self.CMD_BROADCAST, targets, command, message))
+
+    def mp_queue_filenos(self):
+        return [self.mp_queue_fileno()]
+
+    def _next_peer_id(self):
+        """Gets a new peer id, a shard only uses the ids which its shard ring maps to it"""
+        self.__peer_id_counter += 1
+        if self.__shard_ring is not None:
+            while self.__shard_ring.get_shard(self.__peer_id_counter) != self.__shard:
+                self.__peer_id_counter += 1
+        return self.__peer_id_counter
+
+    def _broadcast(self, message_codec, targets, command, message):
+        frames = {}
+        for peer_id, version in targets:
+            p = self.__peers.get(peer_id)
+            if not p:
+                continue
+            encoded = frames.get(version)
+            if encoded is None:
+                encoded = message_codec.encode_message(version, command, message)
+                frames[version] = encoded
+            self.__queue_frame(p, command, encoded)
+
+    def _create_accounting(self):
+        """Creates the buffer accounting, a maximum size message in progress is allowed over the receive limit"""
+        return Accounting.BufferAccounting()
+
+    def _open_listeners(self, mp_data):
+        """Opens the listening sockets for a CMD_LISTEN command, failures are logged"""
+        port, host, backlog, reuse_port = mp_data[1:5]
+        try:
+            sockets = Listener.get_listen_sockets(port, host, backlog, reuse_port)
+        except socket.error as e:
+            LM.info("Unable to listen on port %d: %s" % (port, e))
+            return []
+        LM.info("Listening on port %d" % port)
+        return sockets
+
+    def _put_buffer_stats(self, accounting):
+        send_total, recv_total, usage = accounting.get_stats()
+        self._mp_queue_put_internal((self.INFO_BUFFER_STATS, send_total, recv_total, usage))
+
+    def _put_fast_path_stats(self):
+        counts = self.__fast_path.pop_counts()
+        if counts:
+            self._mp_queue_put_internal((self.INFO_FAST_PATH_STATS, counts))
+
+    def _get_buffer_pool(self):
+        return self.__buffer_pool
+
+    def _get_fast_path(self):
+        return self.__fast_path
+
+    def __update_usage(self, p, t=None):
+        self.__accounting.update(p.get_id(), p.peer_send_thread.get_queued_bytes(), p.get_buffered(), t,
+                                 p.get_in_progress())
+
+    def __queue_frame(self, p, command, encoded):
+        self.__update_usage(p)
+        if Lanes.get_lane(command) != Lanes.LANE_CONTROL and not self.__accounting.send_allowed(p.get_id()):
+            self.__accounting.reject(p.get_id())
+            return
+        p.peer_send_thread.send_encoded(command, encoded)
+
+    def __check_buffers(self, t):
+        accounting = self.__accounting
+        for p in self.__peers.values():
+            self.__update_usage(p, t)
+            if accounting.read_allowed(p.get_id()):
+                p.resume_reading()
+            else:
+                p.pause_reading()
+        for peer_id in accounting.get_expired(t):
+            p = self.__peers.get(peer_id)
+            if p:
+                LM.info("Peer %s:%d (%d) over buffer limit, disconnecting" % (p.get_hostname(), p.get_port(), peer_id))
+                p.interrupt()
+
+    def __put_info(self, info):
+        self.__info_queue.put(info)
+        self.__wakeup.set()
+
     def _add_peer(self, peer):
         assert(isinstance(peer, Peer))
-        self.__info_queue.put((self.INFO_CONNECTED, peer))
+        self.__put_info((self.INFO_CONNECTED, peer))
 
     def _remove_peer(self, peer):
         assert(isinstance(peer, Peer))
-        self.__info_queue.put((self.INFO_DISCONNECTED, peer))
+        self.__put_info((self.INFO_DISCONNECTED, peer))
 
     def _connect_failed(self, peer):
-        self.__info_queue.put((self.INFO_CONNECT_FAILED, peer))
+        self.__put_info((self.INFO_CONNECT_FAILED, peer))
 
-    def _message_received(self, peer, msg):
-        self.__info_queue.put((self.INFO_MSG_RECEIVED, peer, msg))
+    def _message_received(self, peer, command, payload):
+        self.__put_info((self.INFO_MSG_RECEIVED, peer, command, payload))
 
     def _peer_count(self):
         return len(self.__peers)
 
     def _execute(self):
         self.__info_queue = Queue.Queue()
-
-        peer_id_counter = 1
+        self.__wakeup = Poller.Wakeup()
+        message_codec = bitcoin.bitcoin_codec.MessageCodec(self.__protocol_info)
+        self.__accounting = self._create_accounting()
+        self.__buffer_pool = BufferPool.BufferPool()
+        next_check = 0
+        next_stats = time.time() + Accounting.STATS_INTERVAL
+
+        poller = Poller.get_poller()
+        if Poller.PIPES_SELECTABLE:
+            poller.register(self._mp_queue_fileno_internal(), Poller.EVENT_READ)
+            poller.register(self.__wakeup.fileno(), Poller.EVENT_READ)
+
+        listeners = {}
+        connector = Connector.Connector(poller)
+        dialing = {}
 
         LM.info("Starting Network Manager")
 
@@ -123,21 +271,35 @@ class PeerManager(LM.LoggingProcess):
                     if mp_command == self.CMD_CONNECT:
                         host = mp_data[1]
                         port = mp_data[2]
-                        peer_thread = Peer(self, peer_id_counter, self.__protocol_info)
-                        peer_thread.connect(host, port)
-                        peer_thread.start()
+                        peer_id = self._next_peer_id()
+                        dialing[peer_id] = (host, port)
+                        connector.connect(peer_id, host, port)
                     elif mp_command == self.CMD_DISCONNECT:
                         peer_id = mp_data[1]
                         p = self.__peers.get(peer_id)
                         if p:
                             p.interrupt()
+                        elif peer_id in dialing:
+                            connector.cancel(peer_id)
+                            host, port = dialing.pop(peer_id)
+                            self._mp_queue_put_internal((self.INFO_CONNECT_FAILED, peer_id, host, port))
+                    elif mp_command == self.CMD_LISTEN:
+                        for s in self._open_listeners(mp_data):
+                            listeners[s.fileno()] = s
+                            poller.register(s.fileno(), Poller.EVENT_READ)
                     elif mp_command == self.CMD_SEND_MESSAGE:
                         peer_id = mp_data[1]
                         version = mp_data[2]
                         command = mp_data[3]
                         message = mp_data[4]
                         p = self.__peers.get(peer_id)
-                        p.peer_send_thread.send(version, command, message)
+                        if p:
+                            self.__queue_frame(p, command, message_codec.encode_message(version, command, message))
+                    elif mp_command == self.CMD_BROADCAST:
+                        targets = mp_data[1]
+                        command = mp_data[2]
+                        message = mp_data[3]
+                        self._broadcast(message_codec, targets, command, message)
                     elif mp_command == self.CMD_SET_VERSION:
                         peer_id = mp_data[1]
                         version = mp_data[2]
@@ -146,29 +308,75 @@ class PeerManager(LM.LoggingProcess):
                             p.set_version(version)
                     elif mp_command == self.CMD_SHUTDOWN:
                         return
-                try:
-                    data = self.__info_queue.get(True, 0.25)
-                except Queue.Empty:
-                    continue
-                command = data[0]
-                peer = data[1]
-                if command == self.INFO_CONNECTED:
-                    self.__peers[peer_id_counter] = peer
-                    self._mp_queue_put_internal((self.INFO_CONNECTED, peer.get_id(), peer.get_hostname(), peer.get_ip(),
-                                                 peer.get_port()))
-                    peer_id_counter += 1
-                elif command == self.INFO_DISCONNECTED:
-                    del self.__peers[peer.get_id()]
-                    self._mp_queue_put_internal((self.INFO_DISCONNECTED, peer.get_id(), peer.get_hostname(),
-                                                 peer.get_port()))
-                elif command == self.INFO_CONNECT_FAILED:
-                    self._mp_queue_put_internal((self.INFO_CONNECT_FAILED, peer.get_id(), peer.get_hostname(),
-                                                 peer.get_port()))
-                elif command == self.INFO_MSG_RECEIVED:
-                    self._mp_queue_put_internal((self.INFO_MSG_RECEIVED, peer.get_id(), data[2]))
+
+                # Cleared before draining, so info queued after this point sets it again
+                self.__wakeup.clear()
+                while True:
+                    try:
+                        data = self.__info_queue.get(False)
+                    except Queue.Empty:
+                        break
+                    command = data[0]
+                    peer = data[1]
+                    if command == self.INFO_CONNECTED:
+                        self.__peers[peer.get_id()] = peer
+                        self._mp_queue_put_internal((self.INFO_CONNECTED, peer.get_id(), peer.get_hostname(),
+                                                     peer.get_ip(), peer.get_port(), peer.is_outgoing()))
+                    elif command == self.INFO_DISCONNECTED:
+                        del self.__peers[peer.get_id()]
+                        self.__accounting.remove(peer.get_id())
+                        self._mp_queue_put_internal((self.INFO_DISCONNECTED, peer.get_id(), peer.get_hostname(),
+                                                     peer.get_port()))
+                    elif command == self.INFO_CONNECT_FAILED:
+                        self._mp_queue_put_internal((self.INFO_CONNECT_FAILED, peer.get_id(), peer.get_hostname(),
+                                                     peer.get_port()))
+                    elif command == self.INFO_MSG_RECEIVED:
+                        self._mp_queue_put_internal((self.INFO_MSG_RECEIVED, peer.get_id(), data[2], data[3]))
+
+                # Connected sockets are handed to peer threads, which never wait on a connect themselves
+                timeout = connector.check()
+                for peer_id, s in connector.get_results():
+                    host, port = dialing.pop(peer_id)
+                    if s is None:
+                        self._mp_queue_put_internal((self.INFO_CONNECT_FAILED, peer_id, host, port))
+                        continue
+                    s.setblocking(True)
+                    peer_thread = Peer(self, peer_id, self.__protocol_info, self.__lane_quotas)
+                    peer_thread.connect(host, port)
+                    peer_thread.set_socket(s)
+                    peer_thread.start()
+
+                if self.__peers:
+                    t = time.time()
+                    if t >= next_check:
+                        self.__check_buffers(t)
+                        next_check = t + Accounting.CHECK_INTERVAL
+                    if t >= next_stats:
+                        self._put_buffer_stats(self.__accounting)
+                        self._put_fast_path_stats()
+                        next_stats = t + Accounting.STATS_INTERVAL
+                    check_timeout = max(0.0, next_check - t)
+                    if timeout is None or check_timeout < timeout:
+                        timeout = check_timeout
+
+                self._mp_queue_flush_internal()
+                for fd, events in poller.poll(Poller.limit_timeout(timeout)):
+                    listen_socket = listeners.get(fd)
+                    if listen_socket is None:
+                        if connector.handles(fd):
+                            connector.handle_event(fd, events)
+                        continue
+                    for s, address in Listener.accept_connections(listen_socket):
+                        peer_thread = Peer(self, self._next_peer_id(), self.__protocol_info, self.__lane_quotas)
+                        peer_thread.accept(s, address)
+                        peer_thread.start()
         finally:
             for p in self.__peers.values():
                 p.interrupt()
+            for s in listeners.values():
+                s.close()
+            connector.close()
+            poller.close()
 
 
 def convert_ip(peer_name):
@@ -181,6 +389,9 @@ def convert_ip(peer_name):
         ip[12:16] = s
         return ip
     elif len(peer_name) == 4:
+        if "." in peer_name[0]:
+            # IP4 mapped address, as reported by a dual-stack socket
+            return convert_ip((peer_name[0].rsplit(":", 1)[1], peer_name[1]))
         split = peer_name[0].split(":")
         if len(split) > 8:
             return None
@@ -225,7 +436,7 @@ def convert_ip(peer_name):
 class Peer(LM.LoggingThread):
     """ A connection to a peer """
 
-    def __init__(self, peer_holder, peer_id, protocol_info):
+    def __init__(self, peer_holder, peer_id, protocol_info, lane_quotas=None):
         assert(isinstance(peer_holder, PeerManager))
         self.__host = None
         self.__port = None
@@ -237,6 +448,13 @@ class Peer(LM.LoggingThread):
         self.__interrupted = False
         self.__id = peer_id
         self.__version = 0
+        self.__lane_quotas = lane_quotas
+        self.__framer = None
+        self.__read_allowed = threading.Event()
+        self.__read_allowed.set()
+        self.__version_set = threading.Event()
+        self.__version_received = False
+        self.__outgoing = True
         self.peer_send_thread = None
         super(Peer, self).__init__(target=self._execute)
 
@@ -248,11 +466,51 @@ class Peer(LM.LoggingThread):
         assert(isinstance(s, socket.socket))
         self.__s = s
 
+    def accept(self, s, address):
+        """Sets up the peer for an inbound connection accepted from address"""
+        self.set_socket(s)
+        self.__host = Listener.get_peer_host(address)
+        self.__port = address[1]
+        self.__outgoing = False
+
+    def is_outgoing(self):
+        return self.__outgoing
+
     def interrupt(self):
         self.__interrupted = True
+        self.__read_allowed.set()
+        self.__version_set.set()
+        s = self.__s
+        if s is not None:
+            # Wakes the blocking recv in the peer thread
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
 
     def set_version(self, version):
         self.__version = version
+        self.__version_set.set()
+
+    def pause_reading(self):
+        self.__read_allowed.clear()
+
+    def resume_reading(self):
+        self.__read_allowed.set()
+
+    def get_buffered(self):
+        """Gets the number of received bytes which have not yet been delivered as complete messages"""
+        framer = self.__framer
+        if framer is None:
+            return 0
+        return framer.get_buffered()
+
+    def get_in_progress(self):
+        """Gets the received bytes of the frame being received"""
+        framer = self.__framer
+        if framer is None:
+            return 0
+        return framer.get_in_progress()
 
     def get_id(self):
         return self.__id
@@ -266,6 +524,21 @@ class Peer(LM.LoggingThread):
     def get_ip(self):
         return self.__ip
 
+    def __deliver(self, framer):
+        fast_path = self.__peer_holder._get_fast_path()
+        for command, payload in framer.frames(self.__version):
+            if command == b"version":
+                self.__version_received = True
+            replies = fast_path.handle(self.__version, command, payload)
+            if replies is None:
+                self.__peer_holder._message_received(self, command, payload)
+            else:
+                for reply_command, reply in replies:
+                    self.peer_send_thread.send_encoded(reply_command,
+                                                       self.__message_codec.encode_frame(reply_command, reply))
+            if self.__interrupted:
+                break
+
     def _execute(self):
         if self.__s is None:
             self.__s = get_client_socket(self.__host, self.__port)
@@ -274,72 +547,113 @@ class Peer(LM.LoggingThread):
             return
 
         self.__ip = convert_ip(self.__s.getpeername())
+        # The send thread exists before the peer is added, so the node's first messages to it can be queued
+        self.peer_send_thread = PeerSendThread(self.__s, self.__protocol_info, self, self.__lane_quotas)
+        self.peer_send_thread.start()
         self.__peer_holder._add_peer(self)
+        receive_buffer = BufferPool.ReceiveBuffer(self.__peer_holder._get_buffer_pool())
         try:
             try:
-                self.peer_send_thread = PeerSendThread(self.__s, self.__protocol_info, self)
-                self.peer_send_thread.start()
-                self.__s.settimeout(0.25)
-                buf = bytearray()
+                self.__s.settimeout(None)
+                framer = bitcoin.bitcoin_codec.MessageFramer(self.__message_codec)
+                self.__framer = framer
                 while not self.__interrupted:
-                    try:
-                        chunk = self.__s.recv(4096)
-                    except socket.timeout:
-                        continue
-                    if not chunk:
+                    self.__read_allowed.wait()
+                    if self.__interrupted:
+                        break
+                    if not receive_buffer.recv(self.__s, framer):
                         break
-                    buf.extend(chunk)
-                    msg = True
-                    while msg and not self.__interrupted:
-                        msg, buf = self.__message_codec.decode_message(buf, self.__version)
-                        if msg:
-                            self.__peer_holder._message_received(self, msg)
+                    self.__deliver(framer)
+                    if self.__version == 0 and self.__version_received and framer.get_buffered():
+                        # Frames after the version message are held until the node sets the version
+                        self.__version_set.wait(VERSION_WAIT)
+                        self.__deliver(framer)
 
             except socket.error:
                 pass
             finally:
                 try:
                     self.__s.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass
                 finally:
                     self.peer_send_thread.interrupt()
                     self.peer_send_thread.join()
                     self.__s.close()
+                    receive_buffer.release()
         finally:
             self.__peer_holder._remove_peer(self)
 
 
 class PeerSendThread(LM.LoggingThread):
-    """ Peer send thread """
+    """ Peer send thread
 
-    def __init__(self, s, protocol_info, parent_peer):
+    Frames wait in priority lanes, see network.send_lanes. Everything waiting is taken in lane order and written
+    with a single sendall, up to SEND_COALESCE_LIMIT bytes per write. Frames are counted from when they are
+    queued until they have been written, for buffer accounting.
+    """
+
+    def __init__(self, s, protocol_info, parent_peer, lane_quotas=None):
         self.__s = s
         self.__protocol_info = protocol_info
         self.__message_codec = bitcoin.bitcoin_codec.MessageCodec(self.__protocol_info)
-        self.__send_queue = Queue.Queue()
+        self.__lanes = Lanes.SendLanes(lane_quotas)
+        self.__queued_bytes = 0
+        self.__condition = threading.Condition()
         self.__interrupted = False
         self.__parent_peer = parent_peer
         super(PeerSendThread, self).__init__(target=self._execute)
 
     def interrupt(self):
-        self.__interrupted = True
+        with self.__condition:
+            self.__interrupted = True
+            self.__condition.notify()
+
+    def get_queued_bytes(self):
+        with self.__condition:
+            return self.__queued_bytes
 
     def send(self, version, command, message):
-        self.__send_queue.put((version, command, message))
+        self.send_encoded(command, self.__message_codec.encode_message(version, command, message))
+
+    def send_encoded(self, command, encoded):
+        """Queues an already framed message, the buffer may be shared with other peers and must not be modified"""
+        with self.__condition:
+            self.__lanes.put(Lanes.get_lane(command), encoded)
+            self.__queued_bytes += len(encoded)
+            self.__condition.notify()
+
+    def __next_frames(self):
+        """Waits for frames and removes up to SEND_COALESCE_LIMIT bytes of them, returns None if interrupted"""
+        with self.__condition:
+            while not self.__lanes and not self.__interrupted:
+                self.__condition.wait()
+            if self.__interrupted:
+                return None
+            frames = []
+            size = 0
+            while size < SEND_COALESCE_LIMIT:
+                entry = self.__lanes.pop()
+                if entry is None:
+                    break
+                lane, encoded = entry
+                self.__lanes.charge(lane, len(encoded))
+                frames.append(encoded)
+                size += len(encoded)
+            return frames
 
     def _execute(self):
         try:
-            while not self.__interrupted:
-                try:
-                    msg = self.__send_queue.get(True, 0.25)
-                except Queue.Empty:
-                    msg = None
-                    continue
-                version = msg[0]
-                command = msg[1]
-                message = msg[2]
-                encoded = self.__message_codec.encode_message(version, command, message)
-                to_send = len(encoded)
-                while to_send > 0:
-                    to_send -= self.__s.send(encoded)
+            while True:
+                frames = self.__next_frames()
+                if frames is None:
+                    break
+                if len(frames) == 1:
+                    buf = frames[0]
+                else:
+                    buf = bytearray().join(frames)
+                self.__s.sendall(buf)
+                with self.__condition:
+                    self.__queued_bytes -= len(buf)
         finally:
             self.__parent_peer.interrupt()
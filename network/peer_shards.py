@@ -0,0 +1,169 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bisect
+import hashlib
+import socket
+import struct
+import time
+import Queue
+
+import logmanager.logmanager
+import network.network
+import network.listener
+
+LM = logmanager.logmanager
+NET = network.network
+Listener = network.listener
+
+# Points each shard has on the ring, more points give a more even split of peers
+RING_REPLICAS = 64
+
+HASH = struct.Struct(b">I")
+
+
+def get_hash(key):
+    return HASH.unpack_from(hashlib.md5(key.encode("utf-8")).digest())[0]
+
+
+class HashRing(object):
+    """ Consistent hash ring mapping peer ids and addresses to shards
+
+    Each shard is placed on the ring at several points and a key belongs to the first shard point at or after the
+    key's hash. Peer ids are never reassigned, but if the number of shards changes only the ids on the moved points
+    change owner.
+    """
+
+    def __init__(self, shards, replicas=RING_REPLICAS):
+        points = []
+        for shard in range(shards):
+            for replica in range(replicas):
+                points.append((get_hash("shard-%d-%d" % (shard, replica)), shard))
+        points.sort()
+        self.__hashes = [h for h, shard in points]
+        self.__shards = [shard for h, shard in points]
+        self.__count = shards
+
+    def __len__(self):
+        return self.__count
+
+    def get_shard_for_key(self, key):
+        i = bisect.bisect_left(self.__hashes, get_hash(key))
+        if i == len(self.__hashes):
+            i = 0
+        return self.__shards[i]
+
+    def get_shard(self, peer_id):
+        return self.get_shard_for_key("peer-%d" % peer_id)
+
+
+class ShardedPeerManager(object):
+    """ Runs peers on several peer manager processes, so framing and decoding are spread over more cores
+
+    Peer ids are owned by shards through a HashRing, each shard only hands out ids which map to itself, so ids are
+    globally unique and commands for a peer are routed to its shard by hashing its id. New outbound connections
+    have no id yet and are placed by hashing the peer's address. Events from all shards are merged into one
+    stream and the buffer usage reported by each shard is combined into a single INFO_BUFFER_STATS event.
+
+    It has the same interface as a single PeerManager, as used by the Node.
+    """
+
+    INFO_CONNECTED = NET.PeerManager.INFO_CONNECTED
+    INFO_DISCONNECTED = NET.PeerManager.INFO_DISCONNECTED
+    INFO_CONNECT_FAILED = NET.PeerManager.INFO_CONNECT_FAILED
+    INFO_MSG_RECEIVED = NET.PeerManager.INFO_MSG_RECEIVED
+    INFO_BUFFER_STATS = NET.PeerManager.INFO_BUFFER_STATS
+    INFO_FAST_PATH_STATS = NET.PeerManager.INFO_FAST_PATH_STATS
+
+    def __init__(self, engine, shards, protocol_info, log_queue, ipc=LM.IPC_QUEUE, lane_quotas=None,
+                 fast_path=None):
+        self.__ring = HashRing(shards)
+        self.__shards = [engine(protocol_info, log_queue, ipc=ipc, lane_quotas=lane_quotas, shard_ring=self.__ring,
+                                shard=shard, fast_path=fast_path) for shard in range(shards)]
+        self.__next_get = 0
+        self.__buffer_stats = [(0, 0, {})] * shards
+
+    def get_shards(self):
+        return self.__shards
+
+    def get_shard(self, peer_id):
+        return self.__shards[self.__ring.get_shard(peer_id)]
+
+    def start(self):
+        for shard in self.__shards:
+            shard.start()
+
+    def shutdown(self):
+        for shard in self.__shards:
+            shard.mp_queue_put((shard.CMD_SHUTDOWN, ))
+            shard.mp_queue_flush()
+        for shard in self.__shards:
+            shard.join()
+
+    def connect(self, hostname, port):
+        self.__shards[self.__ring.get_shard_for_key("%s:%d" % (hostname, port))].connect(hostname, port)
+
+    def disconnect(self, peer_id):
+        self.get_shard(peer_id).disconnect(peer_id)
+
+    def set_version(self, peer_id, version):
+        self.get_shard(peer_id).set_version(peer_id, version)
+
+    def send_message(self, peer_id, version, command, message):
+        self.get_shard(peer_id).send_message(peer_id, version, command, message)
+
+    def broadcast(self, targets, command, message):
+        shard_targets = {}
+        for target in targets:
+            shard_targets.setdefault(self.__ring.get_shard(target[0]), []).append(target)
+        for shard, targets in shard_targets.items():
+            self.__shards[shard].broadcast(targets, command, message)
+
+    def listen(self, port, host=None, backlog=Listener.DEFAULT_BACKLOG, reuse_port=False):
+        """Listens on every shard if reuse_port is set and SO_REUSEPORT is available, so the kernel shares inbound
+        peers between them, otherwise the first shard accepts all inbound peers"""
+        if reuse_port and hasattr(socket, 'SO_REUSEPORT'):
+            for shard in self.__shards:
+                shard.listen(port, host, backlog, True)
+        else:
+            self.__shards[0].listen(port, host, backlog, False)
+
+    def set_mp_queue_batching(self, batched):
+        for shard in self.__shards:
+            shard.set_mp_queue_batching(batched)
+
+    def mp_queue_flush(self):
+        for shard in self.__shards:
+            shard.mp_queue_flush()
+
+    def mp_queue_filenos(self):
+        return [shard.mp_queue_fileno() for shard in self.__shards]
+
+    def mp_queue_get(self, block=True, timeout=None):
+        """Gets the next event from any shard, shards are read in turn so none can starve the others"""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            count = len(self.__shards)
+            for i in range(count):
+                shard = (self.__next_get + i) % count
+                try:
+                    event = self.__shards[shard].mp_queue_get(False)
+                except Queue.Empty:
+                    continue
+                self.__next_get = (shard + 1) % count
+                if event[0] == self.INFO_BUFFER_STATS:
+                    event = self.__merge_buffer_stats(shard, event)
+                return event
+            if not block or (deadline is not None and time.time() >= deadline):
+                raise Queue.Empty
+            time.sleep(0.001)
+
+    def __merge_buffer_stats(self, shard, event):
+        self.__buffer_stats[shard] = event[1:4]
+        send_total = 0
+        recv_total = 0
+        usage = {}
+        for shard_send, shard_recv, shard_usage in self.__buffer_stats:
+            send_total += shard_send
+            recv_total += shard_recv
+            usage.update(shard_usage)
+        return self.INFO_BUFFER_STATS, send_total, recv_total, usage
@@ -0,0 +1,155 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import select
+import errno
+import os
+import sys
+
+EVENT_READ, EVENT_WRITE = 1, 2
+
+# select() on Windows only accepts sockets, so loops there can't wait on queue pipes and fall back to polling
+PIPES_SELECTABLE = sys.platform != 'win32'
+FALLBACK_TIMEOUT = 0.25
+
+
+def limit_timeout(timeout):
+    """Limits a loop's blocking time when it can't be woken by its queue pipes"""
+    if PIPES_SELECTABLE:
+        return timeout
+    if timeout is None:
+        return FALLBACK_TIMEOUT
+    return min(timeout, FALLBACK_TIMEOUT)
+
+
+class Wakeup(object):
+    """Self-pipe which lets other threads wake a loop blocked on a poller"""
+
+    def __init__(self):
+        self.__r, self.__w = os.pipe()
+        if PIPES_SELECTABLE:
+            import fcntl
+            for fd in (self.__r, self.__w):
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def fileno(self):
+        return self.__r
+
+    def set(self):
+        try:
+            os.write(self.__w, b"\x00")
+        except OSError as e:
+            # A full pipe means a wakeup is already pending
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def clear(self):
+        try:
+            while os.read(self.__r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def close(self):
+        os.close(self.__r)
+        os.close(self.__w)
+
+
+class SelectPoller(object):
+    """Readiness poller using select(), available on all platforms"""
+
+    def __init__(self):
+        self.__read = set()
+        self.__write = set()
+
+    def register(self, fd, events):
+        if events & EVENT_READ:
+            self.__read.add(fd)
+        else:
+            self.__read.discard(fd)
+        if events & EVENT_WRITE:
+            self.__write.add(fd)
+        else:
+            self.__write.discard(fd)
+
+    def modify(self, fd, events):
+        self.register(fd, events)
+
+    def unregister(self, fd):
+        self.__read.discard(fd)
+        self.__write.discard(fd)
+
+    def poll(self, timeout=None):
+        if not self.__read and not self.__write:
+            select.select([], [], [], timeout)
+            return []
+        try:
+            readable, writable, _ = select.select(self.__read, self.__write, [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        events = {}
+        for fd in readable:
+            events[fd] = EVENT_READ
+        for fd in writable:
+            events[fd] = events.get(fd, 0) | EVENT_WRITE
+        return events.items()
+
+    def close(self):
+        pass
+
+
+class EpollPoller(object):
+    """Readiness poller using epoll"""
+
+    def __init__(self):
+        self.__epoll = select.epoll()
+
+    @staticmethod
+    def __to_epoll(events):
+        mask = 0
+        if events & EVENT_READ:
+            mask |= select.EPOLLIN
+        if events & EVENT_WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self.__epoll.register(fd, self.__to_epoll(events))
+
+    def modify(self, fd, events):
+        self.__epoll.modify(fd, self.__to_epoll(events))
+
+    def unregister(self, fd):
+        self.__epoll.unregister(fd)
+
+    def poll(self, timeout=None):
+        if timeout is None:
+            timeout = -1
+        try:
+            ready = self.__epoll.poll(timeout)
+        except IOError as e:
+            if e.errno == errno.EINTR:
+                return []
+            raise
+        events = []
+        for fd, mask in ready:
+            event = 0
+            # Errors and hang ups are reported as readable, so the next read detects them
+            if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                event |= EVENT_READ
+            if mask & select.EPOLLOUT:
+                event |= EVENT_WRITE
+            events.append((fd, event))
+        return events
+
+    def close(self):
+        self.__epoll.close()
+
+
+def get_poller():
+    """Gets the most efficient poller for the platform"""
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    return SelectPoller()
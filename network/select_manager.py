@@ -0,0 +1,348 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import errno
+import socket
+import time
+import Queue
+
+import logmanager.logmanager
+import bitcoin.bitcoin_codec
+import network.network
+import network.poller
+import network.send_lanes
+import network.buffer_accounting
+import network.buffer_pool
+import network.listener
+import network.connector
+
+LM = logmanager.logmanager
+NET = network.network
+Poller = network.poller
+Lanes = network.send_lanes
+Accounting = network.buffer_accounting
+BufferPool = network.buffer_pool
+Listener = network.listener
+Connector = network.connector
+
+RECV_SIZE = 0x10000
+
+WOULD_BLOCK = (errno.EWOULDBLOCK, errno.EAGAIN, 10035)
+
+
+class Connection(object):
+    """ A peer connection owned by the select loop """
+
+    def __init__(self, peer_id, host, port, message_codec, buffer_pool, lane_quotas=None):
+        self.peer_id = peer_id
+        self.host = host
+        self.port = port
+        self.ip = None
+        self.s = None
+        self.fd = None
+        self.connecting = True
+        self.outgoing = True
+        self.framer = bitcoin.bitcoin_codec.MessageFramer(message_codec)
+        self.recv_buffer = BufferPool.ReceiveBuffer(buffer_pool, RECV_SIZE)
+        self.version = 0
+        self.lanes = Lanes.SendLanes(lane_quotas)
+        self.out_frame = None
+        self.out_offset = 0
+        self.send_bytes = 0
+        self.events = 0
+
+    def __repr__(self):
+        return "{id=%d, %s : %d}" % (self.peer_id, self.host, self.port)
+
+
+class SelectPeerManager(NET.PeerManager):
+    """ Peer manager which services all connections from a single thread using non-blocking sockets
+
+    It accepts the same commands and produces the same INFO_* events as the thread per peer PeerManager.
+    """
+
+    def __init__(self, protocol_info, log_queue, connect_timeout=5, ipc=LM.IPC_QUEUE, lane_quotas=None,
+                 shard_ring=None, shard=0, fast_path=None):
+        self.__protocol_info = protocol_info
+        self.__connect_timeout = connect_timeout
+        self.__lane_quotas = lane_quotas
+        self.__message_codec = None
+        self.__poller = None
+        self.__connector = None
+        self.__connections = None
+        self.__fds = None
+        self.__listeners = None
+        self.__accounting = None
+        self.__buffer_pool = None
+        super(SelectPeerManager, self).__init__(protocol_info, log_queue, ipc, shard_ring=shard_ring, shard=shard,
+                                                fast_path=fast_path)
+
+    def _execute(self):
+        self.__message_codec = bitcoin.bitcoin_codec.MessageCodec(self.__protocol_info)
+        self.__poller = Poller.get_poller()
+        self.__connector = Connector.Connector(self.__poller, timeout=self.__connect_timeout)
+        self.__connections = {}
+        self.__fds = {}
+        self.__listeners = {}
+        self.__accounting = self._create_accounting()
+        self.__buffer_pool = BufferPool.BufferPool()
+        next_check = 0
+        next_stats = time.time() + Accounting.STATS_INTERVAL
+
+        if Poller.PIPES_SELECTABLE:
+            self.__poller.register(self._mp_queue_fileno_internal(), Poller.EVENT_READ)
+
+        LM.info("Starting Network Manager (select)")
+
+        try:
+            while not self._interrupted:
+                while True:
+                    try:
+                        mp_data = self._mp_queue_get_internal(False)
+                    except Queue.Empty:
+                        mp_data = None
+                    if not mp_data:
+                        break
+
+                    mp_command = mp_data[0]
+
+                    if mp_command == self.CMD_CONNECT:
+                        self.__connect(self._next_peer_id(), mp_data[1], mp_data[2])
+                    elif mp_command == self.CMD_DISCONNECT:
+                        conn = self.__connections.get(mp_data[1])
+                        if conn:
+                            self.__close(conn)
+                    elif mp_command == self.CMD_LISTEN:
+                        for s in self._open_listeners(mp_data):
+                            self.__listeners[s.fileno()] = s
+                            self.__poller.register(s.fileno(), Poller.EVENT_READ)
+                    elif mp_command == self.CMD_SEND_MESSAGE:
+                        conn = self.__connections.get(mp_data[1])
+                        if conn:
+                            encoded = self.__message_codec.encode_message(mp_data[2], mp_data[3], mp_data[4])
+                            self.__send(conn, mp_data[3], encoded)
+                    elif mp_command == self.CMD_BROADCAST:
+                        self.__broadcast(mp_data[1], mp_data[2], mp_data[3])
+                    elif mp_command == self.CMD_SET_VERSION:
+                        conn = self.__connections.get(mp_data[1])
+                        if conn:
+                            conn.version = mp_data[2]
+                            # Frames held back until the version was known can now be released
+                            self.__deliver(conn)
+                    elif mp_command == self.CMD_SHUTDOWN:
+                        return
+
+                timeout = self.__connector.check()
+                self.__connected(self.__connector.get_results())
+
+                if self.__connections:
+                    t = time.time()
+                    if t >= next_check:
+                        self.__check_buffers(t)
+                        next_check = t + Accounting.CHECK_INTERVAL
+                    if t >= next_stats:
+                        self._put_buffer_stats(self.__accounting)
+                        self._put_fast_path_stats()
+                        next_stats = t + Accounting.STATS_INTERVAL
+                    check_timeout = max(0.0, next_check - t)
+                    if timeout is None or check_timeout < timeout:
+                        timeout = check_timeout
+
+                self._mp_queue_flush_internal()
+
+                for fd, events in self.__poller.poll(Poller.limit_timeout(timeout)):
+                    conn = self.__fds.get(fd)
+                    if not conn:
+                        listen_socket = self.__listeners.get(fd)
+                        if listen_socket:
+                            self.__accept(listen_socket)
+                        elif self.__connector.handles(fd):
+                            self.__connector.handle_event(fd, events)
+                        continue
+                    if events & Poller.EVENT_READ:
+                        self.__read(conn)
+                    if events & Poller.EVENT_WRITE and conn.s:
+                        self.__flush(conn)
+        finally:
+            for conn in self.__connections.values():
+                self.__close(conn)
+            for s in self.__listeners.values():
+                s.close()
+            self.__connector.close()
+            self._mp_queue_flush_internal()
+            self.__poller.close()
+
+    def __accept(self, listen_socket):
+        for s, address in Listener.accept_connections(listen_socket):
+            conn = Connection(self._next_peer_id(), Listener.get_peer_host(address), address[1],
+                              self.__message_codec, self.__buffer_pool, self.__lane_quotas)
+            try:
+                s.setblocking(False)
+                conn.ip = NET.convert_ip(address)
+            except socket.error:
+                s.close()
+                continue
+            conn.outgoing = False
+            self.__connections[conn.peer_id] = conn
+            self.__established(conn, s)
+
+    def __connect(self, peer_id, host, port):
+        conn = Connection(peer_id, host, port, self.__message_codec, self.__buffer_pool, self.__lane_quotas)
+        self.__connections[peer_id] = conn
+        self.__connector.connect(peer_id, host, port)
+
+    def __connected(self, results):
+        for peer_id, s in results:
+            conn = self.__connections.get(peer_id)
+            if conn is None:
+                if s:
+                    s.close()
+                continue
+            if s is None:
+                self.__close(conn)
+                continue
+            try:
+                conn.ip = NET.convert_ip(s.getpeername())
+            except socket.error:
+                s.close()
+                self.__close(conn)
+                continue
+            self.__established(conn, s)
+            # Messages sent while the connection was being established
+            self.__flush(conn)
+
+    def __established(self, conn, s):
+        conn.s = s
+        conn.fd = s.fileno()
+        conn.connecting = False
+        self.__fds[conn.fd] = conn
+        conn.events = Poller.EVENT_READ
+        self.__poller.register(conn.fd, conn.events)
+        self._mp_queue_put_internal((self.INFO_CONNECTED, conn.peer_id, conn.host, conn.ip, conn.port, conn.outgoing))
+
+    def __drop_socket(self, conn):
+        if conn.s:
+            self.__poller.unregister(conn.fd)
+            del self.__fds[conn.fd]
+            conn.s.close()
+            conn.s = None
+            conn.fd = None
+
+    def __check_buffers(self, t):
+        for conn in self.__connections.values():
+            if conn.s and not conn.connecting:
+                self.__account(conn, t)
+                self.__update_events(conn)
+        for peer_id in self.__accounting.get_expired(t):
+            conn = self.__connections.get(peer_id)
+            if conn:
+                LM.info("Peer %r over buffer limit, disconnecting" % conn)
+                self.__close(conn)
+
+    def __account(self, conn, t=None):
+        self.__accounting.update(conn.peer_id, conn.send_bytes, conn.framer.get_buffered(), t,
+                                 conn.framer.get_in_progress())
+
+    def __close(self, conn):
+        if self.__connections.pop(conn.peer_id, None) is None:
+            return
+        self.__accounting.remove(conn.peer_id)
+        self.__drop_socket(conn)
+        conn.recv_buffer.release()
+        if conn.connecting:
+            self.__connector.cancel(conn.peer_id)
+            self._mp_queue_put_internal((self.INFO_CONNECT_FAILED, conn.peer_id, conn.host, conn.port))
+        else:
+            self._mp_queue_put_internal((self.INFO_DISCONNECTED, conn.peer_id, conn.host, conn.port))
+
+    def __update_events(self, conn):
+        events = 0
+        if self.__accounting.read_allowed(conn.peer_id):
+            events |= Poller.EVENT_READ
+        if conn.out_frame is not None or conn.lanes:
+            events |= Poller.EVENT_WRITE
+        if events != conn.events:
+            conn.events = events
+            self.__poller.modify(conn.fd, events)
+
+    def __read(self, conn):
+        try:
+            received = conn.recv_buffer.recv(conn.s, conn.framer)
+        except socket.error as e:
+            if e.args[0] in WOULD_BLOCK:
+                return
+            received = 0
+        if not received:
+            self.__close(conn)
+            return
+        self.__deliver(conn)
+        if conn.s:
+            self.__account(conn)
+            self.__update_events(conn)
+
+    def __deliver(self, conn):
+        fast_path = self._get_fast_path()
+        try:
+            for command, payload in conn.framer.frames(conn.version):
+                replies = fast_path.handle(conn.version, command, payload)
+                if replies is None:
+                    self._mp_queue_put_internal((self.INFO_MSG_RECEIVED, conn.peer_id, command, payload))
+                    continue
+                for reply_command, reply in replies:
+                    self.__send(conn, reply_command, self.__message_codec.encode_frame(reply_command, reply))
+                if conn.s is None:
+                    # Sending the replies failed and closed the connection, the rest of its frames are dropped
+                    break
+        except Exception:
+            # A bad stream only affects its own connection, as it would for a peer thread
+            LM.log_exception()
+            self.__close(conn)
+
+    def __send(self, conn, command, encoded):
+        if conn.s is None:
+            return
+        lane = Lanes.get_lane(command)
+        if lane != Lanes.LANE_CONTROL and not self.__accounting.send_allowed(conn.peer_id):
+            self.__accounting.reject(conn.peer_id)
+            return
+        conn.lanes.put(lane, encoded)
+        conn.send_bytes += len(encoded)
+        if not conn.connecting:
+            self.__flush(conn)
+
+    def __broadcast(self, targets, command, message):
+        frames = {}
+        for peer_id, version in targets:
+            conn = self.__connections.get(peer_id)
+            if not conn:
+                continue
+            encoded = frames.get(version)
+            if encoded is None:
+                encoded = self.__message_codec.encode_message(version, command, message)
+                frames[version] = encoded
+            self.__send(conn, command, encoded)
+
+    def __flush(self, conn):
+        while True:
+            frame = conn.out_frame
+            if frame is None:
+                entry = conn.lanes.pop()
+                if entry is None:
+                    break
+                lane, frame = entry
+                conn.lanes.charge(lane, len(frame))
+                conn.out_frame = frame
+            try:
+                sent = conn.s.send(memoryview(frame)[conn.out_offset:])
+            except socket.error as e:
+                if e.args[0] in WOULD_BLOCK:
+                    break
+                self.__close(conn)
+                return
+            conn.out_offset += sent
+            conn.send_bytes -= sent
+            if conn.out_offset < len(frame):
+                break
+            conn.out_frame = None
+            conn.out_offset = 0
+        self.__account(conn)
+        self.__update_events(conn)
@@ -0,0 +1,84 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import collections
+
+LANE_CONTROL, LANE_ANNOUNCE, LANE_BULK = range(3)
+
+LANES = (LANE_CONTROL, LANE_ANNOUNCE, LANE_BULK)
+
+COMMAND_LANES = {
+    "version": LANE_CONTROL,
+    "verack": LANE_CONTROL,
+    "ping": LANE_CONTROL,
+    "pong": LANE_CONTROL,
+    "reject": LANE_CONTROL,
+    "inv": LANE_ANNOUNCE,
+    "addr": LANE_ANNOUNCE,
+    "getaddr": LANE_ANNOUNCE,
+    "getdata": LANE_ANNOUNCE,
+    "getblocks": LANE_ANNOUNCE,
+    "getheaders": LANE_ANNOUNCE,
+    "notfound": LANE_ANNOUNCE,
+    "mempool": LANE_ANNOUNCE
+}
+
+# Bytes each lane may send per round before lower priority lanes get a turn
+DEFAULT_QUOTAS = {
+    LANE_CONTROL: 0x4000,
+    LANE_ANNOUNCE: 0x10000,
+    LANE_BULK: 0x10000
+}
+
+
+def get_lane(command):
+    """Gets the lane for a command, commands which are not listed are bulk data"""
+    return COMMAND_LANES.get(command, LANE_BULK)
+
+
+class SendLanes(object):
+    """ Outbound queue for one peer, split into priority lanes
+
+    Lanes are served in priority order using deficit round robin. Each round a lane which has data waiting gains
+    its quota of bytes and it is served while its allowance is positive. The sender reports the encoded size of
+    each item with charge(), so a large bulk message uses up several rounds of allowance and control messages
+    are never stuck behind more than one bulk message. Quotas must be positive, or a lane would never be served.
+    """
+
+    def __init__(self, quotas=None):
+        if quotas is None:
+            quotas = DEFAULT_QUOTAS
+        self.__quotas = [quotas[lane] for lane in LANES]
+        for lane, quota in enumerate(self.__quotas):
+            if quota <= 0:
+                raise ValueError("Lane %d has a quota of %d bytes, quotas must be positive" % (lane, quota))
+        self.__queues = [collections.deque() for lane in LANES]
+        self.__deficits = [0] * len(LANES)
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def put(self, lane, item):
+        self.__queues[lane].append(item)
+        self.__count += 1
+
+    def pop(self):
+        """Removes the next item to send, returning (lane, item), or None if all lanes are empty"""
+        if not self.__count:
+            return None
+        queues = self.__queues
+        deficits = self.__deficits
+        while True:
+            for lane in LANES:
+                if queues[lane] and deficits[lane] > 0:
+                    self.__count -= 1
+                    return lane, queues[lane].popleft()
+            for lane in LANES:
+                if queues[lane]:
+                    deficits[lane] += self.__quotas[lane]
+                else:
+                    deficits[lane] = 0
+
+    def charge(self, lane, size):
+        """Charges the bytes sent for an item to its lane's allowance"""
+        self.__deficits[lane] -= size
@@ -0,0 +1,104 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import heapq
+import itertools
+import time
+
+# The heap is rebuilt without cancelled timers once they are more than half of it and at least this many
+COMPACT_MINIMUM = 64
+
+
+class Timer(object):
+    """ A scheduled callback, returned by TimerQueue.call_later so it can be cancelled """
+
+    def __init__(self, deadline, callback, args, queue=None):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+        self.queue = queue
+
+    def cancel(self):
+        if not self.cancelled:
+            self.cancelled = True
+            if self.queue is not None:
+                self.queue.discard(self)
+
+
+class TimerQueue(object):
+    """ Heap of one-shot timers, cancelled timers are discarded lazily when they reach the top
+
+    Scheduling and cancelling are O(log n). So that many cancelled timers do not fill the heap, it is compacted
+    when most of it is cancelled.
+    """
+
+    def __init__(self):
+        self.__heap = []
+        self.__counter = itertools.count()
+        self.__cancelled = 0
+
+    def __len__(self):
+        """Gets the number of live timers"""
+        return len(self.__heap) - self.__cancelled
+
+    def call_at(self, deadline, callback, *args):
+        timer = Timer(deadline, callback, args, self)
+        heapq.heappush(self.__heap, (deadline, next(self.__counter), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def discard(self, timer):
+        """Called by a timer when it is cancelled"""
+        self.__cancelled += 1
+        if self.__cancelled >= COMPACT_MINIMUM and self.__cancelled * 2 > len(self.__heap):
+            self.__heap = [entry for entry in self.__heap if not entry[2].cancelled]
+            heapq.heapify(self.__heap)
+            self.__cancelled = 0
+
+    def get_deadline(self):
+        """Gets the deadline of the next live timer, or None if there are none"""
+        heap = self.__heap
+        while heap and heap[0][2].cancelled:
+            heapq.heappop(heap)
+            self.__cancelled -= 1
+        if heap:
+            return heap[0][0]
+        return None
+
+    def get_timeout(self, maximum=None):
+        """Gets how long a loop may block before the next timer is due, limited to maximum"""
+        deadline = self.get_deadline()
+        if deadline is None:
+            return maximum
+        timeout = max(0.0, deadline - time.time())
+        if maximum is not None:
+            timeout = min(timeout, maximum)
+        return timeout
+
+    def run_due(self, t=None):
+        """Runs all timers with a deadline at or before t and returns the number run
+
+        Timers scheduled by the callbacks run on a later call, even if they are already due, so a timer which
+        reschedules itself can't keep the loop here.
+        """
+        if t is None:
+            t = time.time()
+        heap = self.__heap
+        due = []
+        while heap and heap[0][0] <= t:
+            timer = heapq.heappop(heap)[2]
+            if timer.cancelled:
+                self.__cancelled -= 1
+            else:
+                timer.queue = None
+                due.append(timer)
+        count = 0
+        for timer in due:
+            # An earlier callback may have cancelled it
+            if not timer.cancelled:
+                timer.cancelled = True
+                timer.callback(*timer.args)
+                count += 1
+        return count
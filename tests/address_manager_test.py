@@ -0,0 +1,122 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+import bitcoin.protocols
+import bitcoin.bitcoin_codec
+import bitcoin.message
+import bitcoin.address_manager
+
+Messages = bitcoin.message
+AM = bitcoin.address_manager
+
+PORT = struct.Struct(b">H")
+
+
+def get_record(i, port=8333, timestamp=None):
+    if timestamp is None:
+        timestamp = int(time.time())
+    address = AM.IP4_PREFIX + struct.pack(b">I", 0x0A000000 + i * 0x10001)
+    return timestamp, 1, address, PORT.pack(port)
+
+
+def test_add():
+    manager = AM.AddressManager()
+    records = [get_record(i) for i in range(100)]
+    assert manager.add(records + records[0:10]) == 100, u"Incorrect number of addresses added"
+    assert manager.add(records) == 0, u"Known addresses added again"
+    assert manager.add([get_record(100, timestamp=1)]) == 0, u"Address older than the horizon added"
+    assert manager.get_counts() == (100, 0), u"Incorrect table counts"
+
+    services, last_seen = manager.get(records[5][2], 8333)[0:2]
+    manager.add([(last_seen + 10, 4, records[5][2], records[5][3])], t=last_seen + 20)
+    assert manager.get(records[5][2], 8333)[0:2] == (5, last_seen + 10), u"Known address not updated"
+
+    host, port, group = manager.select()
+    assert AM.host_to_address(host) in [record[2] for record in records], u"Unknown address selected"
+    assert manager.select(exclude_groups=set([AM.get_group(record[2]) for record in records])) is None, \
+        u"Excluded group selected"
+    assert len(manager.get_addresses(10)) == 10, u"Incorrect number of addresses for getaddr"
+
+
+def test_tables():
+    manager = AM.AddressManager()
+    records = [get_record(i) for i in range(2000)]
+    manager.add(records)
+    manager.mark_good(records[7][2], 8333)
+    assert manager.get(records[7][2], 8333)[5] == AM.TRIED, u"Good address not moved to tried"
+    assert manager.select(tried_bias=1.0)[0] == AM.address_to_host(records[7][2]), u"Tried address not selected"
+
+    # Removing addresses shifts index entries back, every remaining address must still be found
+    for record in records[0:1000]:
+        for i in range(AM.MAX_FAILURES):
+            manager.mark_attempt(record[2], 8333)
+    assert manager.get_counts() == (1000, 0), u"Failing addresses not removed"
+    assert all(manager.get(record[2], 8333) for record in records[1000:]), u"Address lost from index"
+    assert manager.add(records[0:500]) == 500, u"Removed addresses not added again"
+    assert len(manager) == 1500, u"Incorrect address count"
+
+
+def test_buckets():
+    manager = AM.AddressManager(bucket_size=2)
+    base = get_record(1)
+    records = [(base[0], 1, base[2][0:15] + chr(i), base[3]) for i in range(5)]
+    assert manager.add(records) == 2, u"Bucket limit not applied"
+
+
+def test_snapshot():
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, "addresses.dat")
+        manager = AM.AddressManager()
+        records = [get_record(i) for i in range(3000)]
+        manager.add(records)
+        manager.mark_good(records[3][2], 8333)
+        manager.mark_attempt(records[4][2], 8333)
+        manager.save(path)
+
+        loaded = AM.AddressManager()
+        loaded.load(path)
+        assert loaded.get_counts() == manager.get_counts(), u"Incorrect counts after load"
+        assert loaded.get(records[4][2], 8333) == manager.get(records[4][2], 8333), u"Address not restored"
+        assert loaded.add(records) == 0, u"Index not restored"
+
+        with open(path, "r+b") as f:
+            f.truncate(100)
+        try:
+            AM.AddressManager().load(path)
+            assert False, u"Truncated snapshot loaded"
+        except AM.AddressFileError:
+            pass
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_addr_message():
+    codec = bitcoin.bitcoin_codec.MessageCodec(bitcoin.protocols.TEST_NET_INFO)
+    records = [get_record(i) for i in range(20)]
+    encoded = codec.encode_message(Messages.PROTOCOL_VERSION, "addr", Messages.Addr(records))
+    framer = bitcoin.bitcoin_codec.MessageFramer(codec)
+    framer.feed(encoded)
+    messages = list(framer.messages(Messages.PROTOCOL_VERSION))
+    assert messages[0][0] == "addr", u"Incorrect command"
+    decoded = [tuple(record) for record in messages[0][1].addresses]
+    assert decoded == records, u"Addresses not decoded"
+
+
+def get_tests():
+    return [
+        ("Add Test", test_add),
+        ("Table Test", test_tables),
+        ("Bucket Test", test_buckets),
+        ("Snapshot Test", test_snapshot),
+        ("Addr Message Test", test_addr_message)
+    ]
+
+
+def get_name():
+    return "Address Manager Tests"
@@ -0,0 +1,64 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+
+import bitcoin.protocols
+import bitcoin.bitcoin_codec
+import bitcoin.message
+import network.async_manager
+import network.buffer_pool
+
+Messages = bitcoin.message
+Async = network.async_manager
+
+
+class FakeManager(object):
+
+    def __init__(self):
+        self.received = []
+        self.lost = False
+
+    def _read_allowed(self, conn):
+        return True
+
+    def _update_usage(self, conn):
+        pass
+
+    def _message_received(self, conn, command, payload):
+        self.received.append(command)
+
+    def _connection_lost(self, conn):
+        self.lost = True
+
+
+def test_bad_frame_after_version():
+    codec = bitcoin.bitcoin_codec.MessageCodec(bitcoin.protocols.TEST_NET_INFO)
+    manager = FakeManager()
+    a, b = socket.socketpair()
+    conn = Async.PeerProtocol(manager, 1, "127.0.0.1", 8333, codec, {}, network.buffer_pool.BufferPool())
+    conn.connection_made(a, False)
+    version = Messages.Version(version=Messages.PROTOCOL_VERSION, services=0, timestamp=0,
+                               address_to=Messages.NetworkAddress(None, 0, bytearray(16), 0),
+                               address_from=Messages.NetworkAddress(None, 0, bytearray(16), 0))
+    # Frames after the version are held until it is set, so a bad header behind them is only decoded then
+    b.sendall(bytes(codec.encode_message(0, "version", version)) +
+              bytes(codec.encode_message(Messages.PROTOCOL_VERSION, "ping", Messages.Ping(1))) +
+              b"\0" * bitcoin.bitcoin_codec.HEADER_SIZE)
+    conn.handle_read()
+    assert manager.received == ["version"], u"Version not delivered"
+    assert not manager.lost, u"Connection closed before the version was set"
+
+    conn.set_version(Messages.PROTOCOL_VERSION)
+    assert manager.received == ["version", "ping"], u"Held frame not delivered"
+    assert manager.lost, u"Connection with a bad frame not closed"
+    b.close()
+
+
+def get_tests():
+    return [
+        ("Bad Frame After Version Test", test_bad_frame_after_version)
+    ]
+
+
+def get_name():
+    return "Async Manager Tests"
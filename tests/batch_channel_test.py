@@ -0,0 +1,76 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import select
+import time
+import Queue
+
+import logmanager.logmanager
+
+LM = logmanager.logmanager
+
+
+def test_batch_size_flush():
+    channel = Queue.Queue()
+    writer = LM.BatchWriter(channel, True)
+    for i in range(LM.BATCH_SIZE + 1):
+        writer.put(i)
+    assert channel.qsize() == 1, u"Full batch not flushed"
+    writer.flush()
+    assert channel.qsize() == 2, u"Partial batch not flushed"
+
+    reader = LM.BatchReader(channel)
+    values = [reader.get(False) for i in range(LM.BATCH_SIZE + 1)]
+    assert values == list(range(LM.BATCH_SIZE + 1)), u"Batched values lost or reordered"
+    try:
+        reader.get(False)
+        assert False, u"Value returned from empty reader"
+    except Queue.Empty:
+        pass
+
+
+def test_batch_deadline_flush():
+    channel = Queue.Queue()
+    writer = LM.BatchWriter(channel, True)
+    writer.put(1)
+    time.sleep(LM.BATCH_DELAY * 2)
+    writer.put(2)
+    assert channel.qsize() == 1, u"Expired batch not flushed"
+    writer.flush()
+    assert channel.qsize() == 1, u"Empty batch sent"
+
+
+def test_unbatched():
+    channel = Queue.Queue()
+    writer = LM.BatchWriter(channel, False)
+    writer.put(1)
+    writer.put(2)
+    assert channel.qsize() == 2, u"Values batched when batching is disabled"
+
+
+def test_queue_fileno():
+    channel = LM.create_channel(LM.IPC_QUEUE)
+    fileno = LM.get_channel_fileno(channel)
+    assert select.select([fileno], [], [], 0)[0] == [], u"Empty queue is readable"
+    channel.put(1)
+    assert select.select([fileno], [], [], 5)[0] == [fileno], u"Queue with data is not readable"
+    assert channel.get(False) == 1, u"Value lost"
+
+    del channel._reader
+    try:
+        LM.get_channel_fileno(channel)
+        assert False, u"Queue without a reader returned a fileno"
+    except LM.ChannelError:
+        pass
+
+
+def get_tests():
+    return [
+        ("Batch Size Flush Test", test_batch_size_flush),
+        ("Batch Deadline Flush Test", test_batch_deadline_flush),
+        ("Unbatched Writer Test", test_unbatched),
+        ("Queue Fileno Test", test_queue_fileno)
+    ]
+
+
+def get_name():
+    return "Batch Channel Tests"
@@ -0,0 +1,151 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bitcoin.bitcoin_codec
+import bitcoin.byte_array_codec
+import bitcoin.message
+import bitcoin.protocols
+
+BCodec = bitcoin.bitcoin_codec
+BAC = bitcoin.byte_array_codec
+Messages = bitcoin.message
+Protocols = bitcoin.protocols
+
+VERSION = Messages.PROTOCOL_VERSION
+
+
+def get_codec():
+    return BCodec.MessageCodec(Protocols.TEST_NET_INFO)
+
+
+def get_version_message():
+    return Messages.Version(
+        version=VERSION,
+        services=1,
+        timestamp=1234,
+        address_to=Messages.NetworkAddress(None, 0, bytearray(16), 18333),
+        address_from=Messages.NetworkAddress(None, 0, bytearray(16), 18333)
+    )
+
+
+def test_round_trip():
+    codec = get_codec()
+    buf = codec.encode_message(0, "version", get_version_message())
+    buf += codec.encode_message(VERSION, "ping", Messages.Ping(0x1234))
+
+    msg, buf = codec.decode_message(buf, 0)
+    assert msg[0] == "version", u"Misread version command"
+    assert msg[1].version == VERSION, u"Misread version"
+
+    msg, buf = codec.decode_message(buf, VERSION)
+    assert msg[0] == "ping", u"Misread ping command"
+    assert msg[1].nonce == 0x1234, u"Misread ping nonce"
+    assert len(buf) == 0, u"Trailing data after decode"
+
+
+def test_schema_encoding():
+    ip = bytearray(b"\x00" * 10 + b"\xff\xff\x7f\x00\x00\x01")
+    address = Messages.NetworkAddress(0x12345678, 1, ip, 8333)
+
+    expected = BAC.BinEncoder()
+    expected.put_int(0x12345678)
+    expected.put_long(1)
+    expected.put_byte_array(ip)
+    expected.set_endian(BAC.BE)
+    expected.put_short(8333)
+
+    for version, expected_bytes in ((VERSION, expected.as_byte_array()), (0, expected.as_byte_array()[4:])):
+        enc = BAC.BinEncoder()
+        address.encode(version, enc)
+        assert enc.as_byte_array() == expected_bytes, u"Schema encoding mismatch for version %d" % version
+        assert address.size_hint(version) == len(expected_bytes), u"Incorrect size hint for version %d" % version
+
+        decoded = Messages.NetworkAddress()
+        decoded.decode(version, BAC.BinDecoder(enc.as_byte_array()))
+        assert decoded.services == 1 and decoded.port == 8333, u"Misread network address"
+        assert decoded.address == ip, u"Misread address bytes"
+        assert decoded.get_host_string() == "127.0.0.1", u"Misread host string"
+
+
+def test_framer_split():
+    codec = get_codec()
+    stream = bytearray()
+    for i in range(0, 50):
+        stream += codec.encode_message(VERSION, "ping", Messages.Ping(i))
+
+    framer = BCodec.MessageFramer(codec, compact_threshold=100)
+    received = []
+    for i in range(0, len(stream), 7):
+        framer.feed(stream[i:i + 7])
+        for command, message in framer.messages(VERSION):
+            assert command == "ping", u"Misread ping command"
+            received.append(message.nonce)
+
+    assert received == list(range(0, 50)), u"Frames lost or reordered"
+    assert framer.get_buffered() == 0, u"Data left in framer"
+
+
+def test_framer_version_gate():
+    codec = get_codec()
+    framer = BCodec.MessageFramer(codec)
+    framer.feed(codec.encode_message(0, "version", get_version_message()))
+    framer.feed(codec.encode_message(VERSION, "verack", Messages.VerAck()))
+
+    commands = [command for command, message in framer.messages(0)]
+    assert commands == ["version"], u"Only the version message should be accepted at version 0"
+
+    commands = [command for command, message in framer.messages(VERSION)]
+    assert commands == ["verack"], u"Verack not released after version was set"
+
+
+def test_framer_bad_checksum():
+    codec = get_codec()
+    bad = codec.encode_message(VERSION, "ping", Messages.Ping(1))
+    bad[-1] ^= 0xFF
+
+    framer = BCodec.MessageFramer(codec)
+    framer.feed(bad)
+    framer.feed(codec.encode_message(VERSION, "ping", Messages.Ping(2)))
+
+    nonces = [message.nonce for command, message in framer.messages(VERSION)]
+    assert nonces == [2], u"Frame with bad checksum was not dropped"
+
+
+def test_raw_frames():
+    codec = get_codec()
+    framer = BCodec.MessageFramer(codec)
+    framer.feed(codec.encode_message(VERSION, "ping", Messages.Ping(7)))
+
+    frames = list(framer.frames(VERSION))
+    assert len(frames) == 1, u"Incorrect number of frames"
+    command, payload = frames[0]
+    assert isinstance(payload, bytes), u"Payload is not a byte string"
+
+    command, message = codec.decode_payload(VERSION, command, payload)
+    assert message.nonce == 7, u"Misread ping nonce from raw payload"
+
+
+def test_zero_copy_payload():
+    codec = get_codec()
+    addresses = [(1234 + i, 1, bytes(bytearray([i]) * 16), b"\x20\x8d") for i in range(10)]
+    framer = BCodec.MessageFramer(codec)
+    framer.feed(codec.encode_message(VERSION, "addr", Messages.Addr(addresses)))
+
+    command, message = list(framer.messages(VERSION))[0]
+    assert isinstance(message.addresses.get_buffer(), memoryview), u"Address records were copied"
+    assert list(message.addresses) == addresses, u"Misread address records"
+
+
+def get_tests():
+    return [
+        ("Message Round Trip Test", test_round_trip),
+        ("Schema Encoding Test", test_schema_encoding),
+        ("Framer Split Stream Test", test_framer_split),
+        ("Framer Version Gate Test", test_framer_version_gate),
+        ("Framer Bad Checksum Test", test_framer_bad_checksum),
+        ("Raw Frames Test", test_raw_frames),
+        ("Zero Copy Payload Test", test_zero_copy_payload)
+    ]
+
+
+def get_name():
+    return "Bitcoin Codec Tests"
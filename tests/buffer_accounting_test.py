@@ -0,0 +1,73 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import network.buffer_accounting
+
+Accounting = network.buffer_accounting
+
+
+def get_accounting():
+    return Accounting.BufferAccounting(1000, peer_send_high_water=1000, global_send_high_water=1500,
+                                       global_recv_high_water=1500, over_limit_timeout=30)
+
+
+def test_peer_limits():
+    accounting = get_accounting()
+    accounting.update(1, 500, 500, t=0)
+    assert accounting.send_allowed(1) and accounting.read_allowed(1), u"Peer under limits restricted"
+
+    accounting.update(1, 1001, 500, t=0)
+    assert not accounting.send_allowed(1), u"Sends allowed over the peer high water mark"
+    assert accounting.read_allowed(1), u"Reading paused under the receive high water mark"
+    accounting.reject(1)
+
+    accounting.update(1, 0, 0, t=10)
+    assert accounting.send_allowed(1), u"Sends not allowed after buffer drained"
+    assert accounting.get_stats() == (0, 0, {1: (0, 0, 1)}), u"Incorrect stats"
+
+
+def test_global_limits():
+    accounting = get_accounting()
+    accounting.update(1, 900, 0)
+    accounting.update(2, 400, 0)
+    accounting.update(3, 300, 0)
+    assert accounting.get_totals() == (1600, 0), u"Incorrect totals"
+    assert not accounting.send_allowed(1), u"Heaviest peer allowed to send over the global limit"
+    assert accounting.send_allowed(2) and accounting.send_allowed(3), u"Light peers restricted"
+
+    accounting.remove(1)
+    assert accounting.get_totals() == (700, 0), u"Removed peer still counted"
+    assert accounting.send_allowed(2), u"Peer restricted after global usage dropped"
+
+
+def test_expiry():
+    accounting = get_accounting()
+    accounting.update(1, 0, 2000, t=100)
+    accounting.update(2, 0, 10, t=100)
+    assert not accounting.read_allowed(1), u"Reading allowed over the receive high water mark"
+    assert accounting.get_expired(120) == [], u"Peer expired early"
+    accounting.update(1, 0, 1500, t=120)
+    assert accounting.get_expired(131) == [1], u"Peer over the limit not expired"
+    accounting.update(1, 0, 0, t=135)
+    assert accounting.get_expired(200) == [], u"Peer expired after returning under the limit"
+
+
+def test_in_progress():
+    accounting = Accounting.BufferAccounting(1000)
+    accounting.update(1, 0, 5000, recv_in_progress=4500)
+    assert accounting.read_allowed(1), u"Reading paused for a large frame in progress"
+    accounting.update(1, 0, 6000, recv_in_progress=4500)
+    assert not accounting.read_allowed(1), u"Reading allowed for data behind a large frame"
+    assert accounting.get_stats() == (0, 6000, {1: (0, 6000, 0)}), u"Frame in progress not counted in the stats"
+
+
+def get_tests():
+    return [
+        ("Peer Limits Test", test_peer_limits),
+        ("Global Limits Test", test_global_limits),
+        ("Over Limit Expiry Test", test_expiry),
+        ("Frame In Progress Test", test_in_progress)
+    ]
+
+
+def get_name():
+    return "Buffer Accounting Tests"
@@ -0,0 +1,75 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+
+import bitcoin.bitcoin_codec
+import bitcoin.message
+import bitcoin.protocols
+import network.buffer_pool
+
+BCodec = bitcoin.bitcoin_codec
+Messages = bitcoin.message
+BufferPool = network.buffer_pool
+
+VERSION = Messages.PROTOCOL_VERSION
+
+
+def test_recv_size():
+    assert BufferPool.get_recv_size(0) == BufferPool.MIN_RECV_SIZE, u"Small reads not raised to the minimum"
+    assert BufferPool.get_recv_size(0x5000) == 0x8000, u"Read size not rounded to a power of two"
+    assert BufferPool.get_recv_size(0x1000000) == BufferPool.MAX_RECV_SIZE, u"Read size not limited"
+
+
+def test_pool_reuse():
+    pool = BufferPool.BufferPool(max_pooled=1)
+    first = pool.get(0x1000)
+    second = pool.get(0x1000)
+    pool.release(first)
+    pool.release(second)
+    assert pool.get_pooled() == 1, u"Pool kept more buffers than its limit"
+    assert pool.get(0x1000) is first, u"Released buffer not reused"
+    assert len(pool.get(0x2000)) == 0x2000, u"Incorrect buffer size"
+
+
+def test_receive_buffer():
+    codec = BCodec.MessageCodec(bitcoin.protocols.TEST_NET_INFO)
+    pool = BufferPool.BufferPool()
+    framer = BCodec.MessageFramer(codec)
+    receive_buffer = BufferPool.ReceiveBuffer(pool)
+
+    a, b = socket.socketpair()
+    b.settimeout(5)
+    a.sendall(codec.encode_message(VERSION, "ping", Messages.Ping(3)))
+    assert receive_buffer.recv(b, framer) == 32, u"Incorrect number of bytes received"
+    nonces = [message.nonce for command, message in framer.messages(VERSION)]
+    assert nonces == [3], u"Ping not received"
+
+    # Only the header of a large frame has arrived, so the framer wants the rest of it
+    frame = codec.encode_message(VERSION, "ping", Messages.Ping(4))
+    frame[16:20] = bytearray(b"\x00\x00\x01\x00")
+    framer.feed(frame[:24])
+    list(framer.frames(VERSION))
+    assert framer.get_wanted() == 0x10000, u"Incorrect bytes wanted for large frame"
+    a.sendall(b"\x00" * 100)
+    receive_buffer.recv(b, framer)
+    assert framer.get_buffered() == 124, u"Data lost"
+    assert framer.get_in_progress() == 124, u"Incorrect bytes of the frame in progress"
+
+    receive_buffer.release()
+    # Both the initial buffer and the larger one which replaced it are back in the pool
+    assert pool.get_pooled() == 2, u"Buffers not returned to the pool"
+    assert len(pool.get(0x10000)) == 0x10000, u"Receive buffer did not grow for large frame"
+    a.close()
+    b.close()
+
+
+def get_tests():
+    return [
+        ("Receive Size Test", test_recv_size),
+        ("Buffer Pool Reuse Test", test_pool_reuse),
+        ("Receive Buffer Test", test_receive_buffer)
+    ]
+
+
+def get_name():
+    return "Buffer Pool Tests"
@@ -125,6 +125,79 @@ def test_endian():
                                                    (enc.as_byte_array(), exp)
 
 
+def test_zero_copy():
+    enc = BAC.BinEncoder()
+    enc.put_int(0x12345678)
+    b = bytearray(b'\x11\x22\x33\x44')
+    enc.put_byte_array(b)
+    enc.set_endian(BAC.BE)
+    enc.put_short(0x1234)
+    enc.put_byte_array(b"abc")
+
+    buf = enc.as_byte_array()
+    dec = BAC.BinDecoder(buf, zero_copy=True)
+    assert dec.get_int() == 0x12345678, u"Misread int"
+    view = dec.get_byte_array(len(b))
+    assert isinstance(view, memoryview), u"Byte array was copied"
+    assert view == b, u"Misread byte array"
+    dec.set_endian(BAC.BE)
+    assert dec.get_short() == 0x1234, u"Misread big endian short"
+    assert dec.get_remaining() == 3, u"Incorrect remaining count"
+    assert dec.get_string(3) == b"abc", u"Misread string"
+
+    buf[4] = 0x55
+    assert view[0] == b"\x55", u"View does not share the buffer"
+
+    dec = BAC.BinDecoder(memoryview(bytearray(b"abc")))
+    assert dec.get_string(3) == b"abc", u"Misread string from a view without zero copy"
+
+
+def test_encoder_growth():
+    enc = BAC.BinEncoder(size_hint=1)
+    b = bytearray(range(256)) * 4
+    for i in range(0, 100):
+        enc.put_int(i)
+        enc.put_byte_array(b)
+    assert enc.get_size() == 100 * (4 + len(b)), u"Incorrect encoded size"
+
+    copied = enc.as_byte_array()
+    direct = enc.as_byte_array(False)
+    assert copied == direct, u"Copied and direct buffers differ"
+
+    dec = BAC.BinDecoder(direct)
+    for i in range(0, 100):
+        assert dec.get_int() == i, u"Misread int"
+        assert dec.get_byte_array(len(b)) == b, u"Misread byte array"
+    assert dec.get_remaining() == 0, u"Trailing data after decode"
+
+
+def test_records():
+    enc = BAC.BinEncoder()
+    expected = []
+    for i in range(0, 1000):
+        h = bytes(bytearray([i % 256]) * 32)
+        expected.append((i, h))
+        enc.put_int(i)
+        enc.put_byte_array(h)
+    enc.put_short(0x1234)
+
+    dec = BAC.BinDecoder(enc.as_byte_array())
+    records = dec.get_records(len(expected), "I32s")
+    assert len(records) == len(expected), u"Incorrect record count"
+    assert records[5] == expected[5], u"Misread indexed record"
+    assert records[-1] == expected[-1], u"Misread negative indexed record"
+    assert list(records) == expected, u"Misread record array"
+    assert records.to_list() is records.to_list(), u"Record array unpacked twice"
+    assert dec.get_short() == 0x1234, u"Misread value after records"
+
+    dec = BAC.BinDecoder(bytearray(10))
+    try:
+        dec.get_records(2, "IH")
+        assert False, u"Short buffer not detected"
+    except BAC.DecoderEOF:
+        pass
+
+
 def get_tests():
     return [
         ("Byte Encode/Decode Test", test_byte_codec),
@@ -133,7 +206,10 @@ def get_tests():
         ("Var Int Encode/Decode Test", test_var_int),
         ("Long Encode/Decode Test", test_long_codec),
         ("Mixed Encode/Decode Test", test_mixed_types),
-        ("Endian Test", test_endian)
+        ("Endian Test", test_endian),
+        ("Zero Copy Decode Test", test_zero_copy),
+        ("Encoder Growth Test", test_encoder_growth),
+        ("Record Array Decode Test", test_records)
     ]
 
 
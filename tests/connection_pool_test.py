@@ -0,0 +1,113 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+import bitcoin.protocols
+import bitcoin.node
+import bitcoin.address_manager
+import bitcoin.connection_pool
+
+AM = bitcoin.address_manager
+Pool = bitcoin.connection_pool
+
+
+class FakePeerManager(object):
+
+    def __init__(self):
+        self.connects = []
+        self.disconnects = []
+
+    def connect(self, host, port):
+        self.connects.append((host, port))
+
+    def disconnect(self, peer_id):
+        self.disconnects.append(peer_id)
+
+
+class FakeNode(object):
+
+    def __init__(self):
+        self.peer_manager = FakePeerManager()
+        self.peer_handles = {}
+
+    def get_peer_manager(self):
+        return self.peer_manager
+
+    def get_peer_handles(self):
+        return self.peer_handles.values()
+
+
+def get_manager(count, hosts_per_group=1):
+    manager = AM.AddressManager()
+    for i in range(count):
+        manager.add_host("10.%d.0.%d" % (i // hosts_per_group, i % hosts_per_group + 1), 8333)
+    return manager
+
+
+def connect_peer(pool, node, peer_id, host, port):
+    peer_handle = bitcoin.node.PeerHandle(node, host, AM.host_to_address(host), port, peer_id, True)
+    node.peer_handles[peer_id] = peer_handle
+    pool.on_connect(peer_id, peer_handle, host, peer_handle.ip, port)
+    return peer_handle
+
+
+def test_refill():
+    node = FakeNode()
+    pool = Pool.ConnectionPool(node, get_manager(20, 2), bitcoin.protocols.TEST_NET_INFO, target=4)
+    pool.poll()
+    connects = node.peer_manager.connects
+    assert len(connects) == 4, u"Pool not filled to its target"
+    groups = set(AM.get_group(AM.host_to_address(host)) for host, port in connects)
+    assert len(groups) == 4, u"More than one connection per network group"
+
+    pool.on_connect_failed(connects[0][0], connects[0][1])
+    for i, (host, port) in enumerate(connects[1:]):
+        connect_peer(pool, node, i, host, port)
+    pool.poll()
+    assert len(connects) == 5, u"Failed connection not replaced"
+    pool.on_disconnect(0, node.peer_handles.pop(0))
+    pool.poll()
+    assert len(connects) == 6, u"Disconnected peer not replaced"
+
+
+def test_seeds():
+    node = FakeNode()
+    pool = Pool.ConnectionPool(node, AM.AddressManager(), bitcoin.protocols.TEST_NET_INFO, target=2)
+    pool.poll()
+    seeds = bitcoin.protocols.TEST_NET_INFO.get_fixed_seeds()
+    assert node.peer_manager.connects, u"No seeds connected"
+    assert all(host in seeds for host, port in node.peer_manager.connects), u"Unknown address connected"
+
+
+def test_evict():
+    node = FakeNode()
+    pool = Pool.ConnectionPool(node, get_manager(10), bitcoin.protocols.TEST_NET_INFO, target=3, evict_interval=60)
+    pool.poll()
+    t = time.time()
+    for i, (host, port) in enumerate(node.peer_manager.connects):
+        peer_handle = connect_peer(pool, node, i, host, port)
+        peer_handle.connect_time = t - Pool.MIN_EVICT_AGE
+        peer_handle.latency = 0.05
+        peer_handle.bytes_received = 100000
+    node.peer_handles[1].latency = 2.0
+    node.peer_handles[1].bytes_received = 1000
+
+    pool.poll()
+    assert node.peer_manager.disconnects == [], u"Peer evicted before the evict interval"
+    pool.last_eviction = t - 60
+    pool.poll()
+    assert node.peer_manager.disconnects == [1], u"Slowest peer not evicted"
+    pool.poll()
+    assert node.peer_manager.disconnects == [1], u"Churn budget not applied"
+
+
+def get_tests():
+    return [
+        ("Refill Test", test_refill),
+        ("Seed Test", test_seeds),
+        ("Evict Test", test_evict)
+    ]
+
+
+def get_name():
+    return "Connection Pool Tests"
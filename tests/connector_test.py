@@ -0,0 +1,97 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+import time
+
+import network.poller
+import network.connector
+
+Poller = network.poller
+Connector = network.connector
+
+
+def get_address(port, af=socket.AF_INET, host="127.0.0.1"):
+    return af, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (host, port)
+
+
+def get_closed_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def run_connector(connector, poller, count, timeout=5):
+    results = []
+    deadline = time.time() + timeout
+    while len(results) < count and time.time() < deadline:
+        wait = connector.check()
+        results.extend(connector.get_results())
+        if len(results) >= count:
+            break
+        for fd, events in poller.poll(0.1 if wait is None else min(wait, 0.1)):
+            if connector.handles(fd):
+                connector.handle_event(fd, events)
+        results.extend(connector.get_results())
+    return dict(results)
+
+
+def test_order_addresses():
+    addresses = [get_address(1, socket.AF_INET6, "::1"), get_address(2, socket.AF_INET6, "::1"),
+                 get_address(3), get_address(4)]
+    ports = [address[4][1] for address in Connector.order_addresses(addresses)]
+    assert ports == [1, 3, 2, 4], u"Address families not interleaved"
+
+
+def test_dns_cache():
+    cache = Connector.DNSCache(ttl=10, negative_ttl=1)
+    cache.put("a", 1, [get_address(1)], t=100)
+    cache.put("b", 1, [], t=100)
+    assert cache.get("a", 1, t=105) == [get_address(1)], u"Cached lookup not returned"
+    assert cache.get("b", 1, t=100.5) == [], u"Failed lookup not cached"
+    assert cache.get("b", 1, t=102) is None, u"Failed lookup kept past its ttl"
+    assert cache.get("a", 1, t=111) is None, u"Lookup kept past its ttl"
+
+
+def test_connect():
+    listen_socket = socket.socket()
+    listen_socket.bind(("127.0.0.1", 0))
+    listen_socket.listen(5)
+    port = listen_socket.getsockname()[1]
+    closed_port = get_closed_port()
+
+    poller = Poller.get_poller()
+    resolver = Connector.Resolver()
+    connector = Connector.Connector(poller, resolver, max_dials=1)
+    # The first address of a name is refused, so the next is tried without waiting for the attempt delay
+    resolver.get_cache().put("peer.test", port, [get_address(closed_port), get_address(port)])
+    connector.connect(1, "peer.test", port)
+    connector.connect(2, "127.0.0.1", closed_port)
+    assert connector.get_dial_count() == 1, u"Dial limit not applied"
+
+    t = time.time()
+    results = run_connector(connector, poller, 2)
+    assert time.time() - t < Connector.ATTEMPT_DELAY, u"Next address not tried after a failure"
+    assert results[1] is not None, u"Connection not established"
+    assert results[1].getpeername()[1] == port, u"Connected to incorrect address"
+    assert results[2] is None, u"Refused connection not reported"
+    results[1].close()
+
+    connector.connect(3, "nonexistent.invalid", port)
+    assert run_connector(connector, poller, 1) == {3: None}, u"Failed lookup not reported"
+    connector.close()
+    poller.close()
+    listen_socket.close()
+
+
+def get_tests():
+    return [
+        ("Address Order Test", test_order_addresses),
+        ("DNS Cache Test", test_dns_cache),
+        ("Connect Test", test_connect)
+    ]
+
+
+def get_name():
+    return "Connector Tests"
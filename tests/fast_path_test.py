@@ -0,0 +1,37 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bitcoin.protocols
+import bitcoin.bitcoin_codec
+import bitcoin.message
+import network.fast_path
+
+FastPath = network.fast_path
+
+
+def get_payload(command, message, version=70002):
+    codec = bitcoin.bitcoin_codec.MessageCodec(bitcoin.protocols.TEST_NET_INFO)
+    return bytes(codec.encode_message(version, command, message)[bitcoin.bitcoin_codec.HEADER_SIZE:])
+
+
+def test_ping():
+    table = FastPath.get_default_table()
+    payload = get_payload("ping", bitcoin.message.Ping(0xFEDCBA9876543210))
+    replies = table.handle(70002, b"ping", payload)
+    assert [command for command, reply in replies] == ["pong"], u"Ping not answered with pong"
+    assert replies[0][1] == get_payload("pong", bitcoin.message.Pong(0xFEDCBA9876543210)), u"Incorrect pong"
+    assert table.handle(0, b"ping", payload) is None, u"Ping before the version answered"
+    assert table.handle(60000, b"ping", b"") == [], u"Ping without nonce answered"
+    assert table.handle(70002, b"pong", payload) is None, u"Pong not passed to the node"
+    assert b"ping" in table and b"inv" not in table, u"Incorrect table commands"
+    assert table.pop_counts() == {"ping": 1}, u"Incorrect counts"
+    assert table.pop_counts() == {}, u"Counts not reset"
+
+
+def get_tests():
+    return [
+        ("Ping Test", test_ping)
+    ]
+
+
+def get_name():
+    return "Fast Path Tests"
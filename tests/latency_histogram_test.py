@@ -0,0 +1,48 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import bitcoin.latency_histogram
+
+Histogram = bitcoin.latency_histogram
+
+
+def test_buckets():
+    previous = -1
+    for value in list(range(0, 5000)) + [Histogram.MAX_VALUE - 1, Histogram.MAX_VALUE]:
+        index = Histogram.get_index(value)
+        assert index < Histogram.BUCKETS, u"Bucket out of range"
+        assert index >= previous, u"Buckets not in order"
+        highest = Histogram.get_highest_value(index)
+        assert value <= highest <= value + value // Histogram.HALF_SUB_BUCKETS, u"Bucket precision too low"
+        previous = index
+
+
+def test_percentiles():
+    histogram = Histogram.LatencyHistogram()
+    assert histogram.get_percentile(50) is None, u"Percentile reported for empty histogram"
+    for i in range(1, 1001):
+        histogram.record(i / 1000)
+    p50, p90, p99 = histogram.get_percentiles((50, 90, 99))
+    assert 0.5 <= p50 <= 0.5 * 1.07, u"Incorrect 50th percentile"
+    assert 0.9 <= p90 <= 0.9 * 1.07, u"Incorrect 90th percentile"
+    assert 0.99 <= p99 <= 0.99 * 1.07, u"Incorrect 99th percentile"
+    assert histogram.get_percentile(100) == 1.0, u"Maximum not returned for 100th percentile"
+    assert abs(histogram.get_mean() - 0.5005) < 0.001, u"Incorrect mean"
+
+    other = Histogram.LatencyHistogram()
+    other.record(1000)
+    histogram.merge(other)
+    assert len(histogram) == 1001, u"Counts not merged"
+    assert histogram.get_max() == Histogram.MAX_VALUE / Histogram.UNITS, u"Latency not limited to the maximum"
+    histogram.reset()
+    assert len(histogram) == 0, u"Histogram not reset"
+
+
+def get_tests():
+    return [
+        ("Bucket Test", test_buckets),
+        ("Percentile Test", test_percentiles)
+    ]
+
+
+def get_name():
+    return "Latency Histogram Tests"
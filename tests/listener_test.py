@@ -0,0 +1,54 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import select
+import socket
+
+import bitcoin.protocols
+import network.network
+import network.listener
+
+NET = network.network
+Listener = network.listener
+
+
+def test_accept():
+    sockets = Listener.get_listen_sockets(0, backlog=16)
+    listen_socket = sockets[0]
+    port = listen_socket.getsockname()[1]
+    assert Listener.accept_connections(listen_socket) == [], u"Accept blocked or returned a connection"
+
+    clients = [socket.create_connection(("127.0.0.1", port), 5)]
+    if listen_socket.family == socket.AF_INET6:
+        clients.append(socket.create_connection(("::1", port), 5))
+
+    accepted = []
+    while len(accepted) < len(clients):
+        select.select([listen_socket], [], [], 5)
+        accepted.extend(Listener.accept_connections(listen_socket, limit=1))
+    hosts = [Listener.get_peer_host(address) for s, address in accepted]
+    assert "127.0.0.1" in hosts, u"IP4 connection not accepted"
+    if len(clients) > 1:
+        assert "::1" in hosts, u"IP6 connection not accepted"
+
+    for s, address in accepted:
+        s.close()
+    for s in clients + sockets:
+        s.close()
+
+
+def test_mapped_address():
+    assert Listener.get_peer_host(("::ffff:10.1.2.3", 8333, 0, 0)) == "10.1.2.3", u"Mapped host not converted"
+    assert Listener.get_peer_host(("::ffff:1", 8333, 0, 0)) == "::ffff:1", u"IP6 host incorrectly converted"
+    ip = NET.convert_ip(("::ffff:10.1.2.3", 8333, 0, 0))
+    assert ip == NET.convert_ip(("10.1.2.3", 8333)), u"Mapped address not converted to an IP4 address"
+
+
+def get_tests():
+    return [
+        ("Accept Test", test_accept),
+        ("Mapped Address Test", test_mapped_address)
+    ]
+
+
+def get_name():
+    return "Listener Tests"
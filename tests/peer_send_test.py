@@ -0,0 +1,75 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+
+import bitcoin.bitcoin_codec
+import bitcoin.message
+import bitcoin.protocols
+import network.network
+
+BCodec = bitcoin.bitcoin_codec
+Messages = bitcoin.message
+NET = network.network
+
+VERSION = Messages.PROTOCOL_VERSION
+
+
+class DummyPeer(object):
+    def interrupt(self):
+        pass
+
+
+class Blob(object):
+    def __init__(self, size):
+        self.size = size
+
+    def encode(self, version, encoder):
+        encoder.put_byte_array(bytearray(self.size))
+
+
+def test_coalesced_send():
+    codec = BCodec.MessageCodec(bitcoin.protocols.TEST_NET_INFO)
+    a, b = socket.socketpair()
+    # A socket with a timeout returns partial writes once its buffer is full
+    a.settimeout(5)
+    send_thread = NET.PeerSendThread(a, bitcoin.protocols.TEST_NET_INFO, DummyPeer())
+
+    # Enough data to fill the socket buffer, so writes are partial
+    count = 20000
+    for i in range(1, count):
+        send_thread.send(VERSION, "ping", Messages.Ping(i))
+    send_thread.send(VERSION, "blob", Blob(0x100000))
+    send_thread.send_encoded("ping", codec.encode_message(VERSION, "ping", Messages.Ping(count)))
+    send_thread.start()
+
+    framer = BCodec.MessageFramer(codec)
+    nonces = []
+    b.settimeout(5)
+    blobs = 0
+    while len(nonces) < count:
+        framer.feed(b.recv(0x10000))
+        for command, payload in framer.frames(VERSION):
+            if command == "blob":
+                assert len(payload) == 0x100000, u"Blob payload corrupted"
+                blobs += 1
+            else:
+                nonces.append(codec.decode_payload(VERSION, command, payload)[1].nonce)
+
+    send_thread.interrupt()
+    send_thread.join()
+    a.close()
+    b.close()
+
+    assert nonces == list(range(1, count + 1)), u"Messages lost, repeated or reordered"
+    assert blobs == 1, u"Large message lost or repeated"
+    assert framer.get_buffered() == 0, u"Unexpected trailing data"
+
+
+def get_tests():
+    return [
+        ("Coalesced Send Test", test_coalesced_send)
+    ]
+
+
+def get_name():
+    return "Peer Send Tests"
@@ -0,0 +1,71 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import socket
+
+import bitcoin.protocols
+import network.select_manager
+import network.peer_shards
+
+Shards = network.peer_shards
+
+
+def test_ring():
+    ring = Shards.HashRing(4)
+    counts = [0] * 4
+    for peer_id in range(1, 4001):
+        counts[ring.get_shard(peer_id)] += 1
+    assert min(counts) > 500, u"Peers not spread over shards"
+    assert Shards.HashRing(4).get_shard(17) == ring.get_shard(17), u"Ring not deterministic"
+
+    # Adding a shard only moves peers to the new shard
+    larger = Shards.HashRing(5)
+    moved = [peer_id for peer_id in range(1, 4001) if larger.get_shard(peer_id) != ring.get_shard(peer_id)]
+    assert all(larger.get_shard(peer_id) == 4 for peer_id in moved), u"Peers moved between existing shards"
+    assert len(moved) < 1600, u"Too many peers moved"
+
+
+def test_peer_ids():
+    ring = Shards.HashRing(3)
+    ids = set()
+    for shard in range(3):
+        manager = network.select_manager.SelectPeerManager(bitcoin.protocols.TEST_NET_INFO, None,
+                                                           shard_ring=ring, shard=shard)
+        for i in range(50):
+            peer_id = manager._next_peer_id()
+            assert ring.get_shard(peer_id) == shard, u"Peer id not owned by its shard"
+            ids.add(peer_id)
+    assert len(ids) == 150, u"Peer ids not unique"
+
+
+class FakeEngine(object):
+
+    def __init__(self, protocol_info, log_queue, ipc=None, lane_quotas=None, shard_ring=None, shard=0,
+                 fast_path=None):
+        self.listens = []
+
+    def listen(self, port, host=None, backlog=None, reuse_port=False):
+        self.listens.append(reuse_port)
+
+
+def test_listen():
+    manager = Shards.ShardedPeerManager(FakeEngine, 3, bitcoin.protocols.TEST_NET_INFO, None)
+    manager.listen(8333, reuse_port=False)
+    assert [shard.listens for shard in manager.get_shards()] == [[False], [], []], \
+        u"Shards listening without reuse_port"
+
+    manager = Shards.ShardedPeerManager(FakeEngine, 3, bitcoin.protocols.TEST_NET_INFO, None)
+    manager.listen(8333, reuse_port=True)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        assert [shard.listens for shard in manager.get_shards()] == [[True]] * 3, u"Shards not sharing the port"
+
+
+def get_tests():
+    return [
+        ("Hash Ring Test", test_ring),
+        ("Peer Id Test", test_peer_ids),
+        ("Listen Test", test_listen)
+    ]
+
+
+def get_name():
+    return "Peer Shard Tests"
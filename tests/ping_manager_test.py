@@ -0,0 +1,75 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import network.timer_queue
+import bitcoin.protocols
+import bitcoin.node
+import bitcoin.ping_manager
+
+TQ = network.timer_queue
+PM = bitcoin.ping_manager
+
+
+class FakeNode(object):
+
+    def __init__(self):
+        self.timers = TQ.TimerQueue()
+        self.sent = []
+
+    def call_later(self, delay, callback, *args):
+        return self.timers.call_later(delay, callback, *args)
+
+    def send_message(self, peer_id, version, command, message):
+        self.sent.append((peer_id, command, message))
+
+
+def test_ping():
+    node = FakeNode()
+    manager = PM.PingManager(node)
+    peer_handles = []
+    for peer_id in range(20):
+        peer_handle = bitcoin.node.PeerHandle(node, "127.0.0.1", None, 8333, peer_id, True)
+        peer_handle.version = 70002
+        manager.on_connect(peer_id, peer_handle, "127.0.0.1", None, 8333)
+        peer_handles.append(peer_handle)
+    deadlines = sorted(timer.deadline for peer_handle in peer_handles for timer in peer_handle.timers)
+    assert deadlines[-1] - deadlines[0] > manager.ping_rate / 10, u"First pings not staggered"
+
+    # Every peer pings twice without a pong, both nonces are outstanding
+    node.timers.run_due(deadlines[-1])
+    node.timers.run_due(deadlines[-1] + manager.ping_rate * (1 + PM.PING_JITTER))
+    assert all(len(peer_handle.pings) == 2 for peer_handle in peer_handles), u"Outstanding pings not kept"
+
+    peer_handle = peer_handles[0]
+    pings = [message.nonce for peer_id, command, message in node.sent if peer_id == 0 and command == "ping"]
+    manager.handle_message(0, peer_handle, u"pong", bitcoin.message.Pong(pings[0]))
+    manager.handle_message(0, peer_handle, u"pong", bitcoin.message.Pong(pings[0]))
+    assert pings[0] not in peer_handle.pings and pings[1] in peer_handle.pings, u"Pong not matched to its nonce"
+    assert len(peer_handle.latency_histogram) == 1, u"Latency not recorded for peer"
+    assert len(manager.get_histogram()) == 1, u"Latency not recorded globally"
+    assert peer_handle.latency is not None, u"Average latency not updated"
+
+    for i in range(PM.MAX_OUTSTANDING * 2):
+        node.timers.run_due(node.timers.get_deadline())
+    assert all(len(peer_handle.pings) <= PM.MAX_OUTSTANDING for peer_handle in peer_handles), \
+        u"Outstanding pings not limited"
+
+
+def test_ping_reply():
+    node = FakeNode()
+    manager = PM.PingManager(node)
+    peer_handle = bitcoin.node.PeerHandle(node, "127.0.0.1", None, 8333, 0, False)
+    peer_handle.version = 70002
+    manager.handle_message(0, peer_handle, u"ping", bitcoin.message.Ping(1234))
+    assert [(command, message.nonce) for peer_id, command, message in node.sent] == [(u"pong", 1234)], \
+        u"Ping passed on by the network not answered"
+
+
+def get_tests():
+    return [
+        ("Ping Test", test_ping),
+        ("Ping Reply Test", test_ping_reply)
+    ]
+
+
+def get_name():
+    return "Ping Manager Tests"
@@ -0,0 +1,83 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import multiprocessing
+import Queue
+
+import logmanager.ring_buffer
+import bitcoin.message
+
+RB = logmanager.ring_buffer
+
+
+def test_wrap_around():
+    ring = RB.RingBuffer(64)
+    for i in range(50):
+        record = bytes(bytearray([i]) * (i % 20))
+        assert ring.put_record(record), u"Record rejected by empty ring"
+        assert ring.get_record() == record, u"Record corrupted at position %d" % i
+    assert ring.get_record() is None, u"Record returned from empty ring"
+
+
+def test_full_ring():
+    ring = RB.RingBuffer(64)
+    assert not ring.put_record(b"\x00" * 61), u"Oversize record accepted"
+    assert ring.put_record(b"\x00" * 40), u"Record rejected by empty ring"
+    assert not ring.put_record(b"\x00" * 20), u"Record accepted by full ring"
+    assert ring.get_record() == b"\x00" * 40, u"Record corrupted"
+    assert ring.put_record(b"\x00" * 20), u"Record rejected after space was freed"
+
+
+def test_channel_overflow():
+    channel = RB.RingChannel(0x100)
+    values = [(i, b"x" * (i * 37 % 400)) for i in range(50)]
+    for value in values[:30]:
+        channel.put(value)
+    received = [channel.get(True, 5) for i in range(10)]
+    for value in values[30:]:
+        channel.put(value)
+    received += [channel.get(True, 5) for i in range(40)]
+    assert received == values, u"Overflowed values lost or reordered"
+
+
+def test_channel_values():
+    channel = RB.RingChannel(0x1000)
+    values = [(3, 7, b"ping", b"\x01\x02"), -1, (1, 2, "host", "127.0.0.1", 8333), (4, 5, bitcoin.message.Ping(1))]
+    for value in values:
+        channel.put(value)
+    for value in values[:3]:
+        assert channel.get(False) == value, u"Value not round tripped"
+    assert channel.get(False)[2].nonce == 1, u"Pickled value not round tripped"
+    try:
+        channel.get(True, 0.01)
+        assert False, u"Value returned from empty channel"
+    except Queue.Empty:
+        pass
+
+
+def produce(channel, count):
+    for i in range(count):
+        channel.put((i, b"x" * (i % 300)))
+
+
+def test_cross_process():
+    channel = RB.RingChannel(0x400)
+    count = 2000
+    process = multiprocessing.Process(target=produce, args=(channel, count))
+    process.start()
+    for i in range(count):
+        assert channel.get(True, 5) == (i, b"x" * (i % 300)), u"Value %d received out of order" % i
+    process.join()
+
+
+def get_tests():
+    return [
+        ("Ring Wrap Around Test", test_wrap_around),
+        ("Ring Full Test", test_full_ring),
+        ("Ring Channel Overflow Test", test_channel_overflow),
+        ("Ring Channel Values Test", test_channel_values),
+        ("Ring Cross Process Test", test_cross_process)
+    ]
+
+
+def get_name():
+    return "Ring Buffer Tests"
@@ -0,0 +1,65 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import network.send_lanes
+
+Lanes = network.send_lanes
+
+
+def test_lane_priority():
+    lanes = Lanes.SendLanes()
+    lanes.put(Lanes.get_lane("block"), "block")
+    lanes.put(Lanes.get_lane("inv"), "inv")
+    lanes.put(Lanes.get_lane("pong"), "pong")
+
+    order = []
+    entry = lanes.pop()
+    while entry is not None:
+        order.append(entry[1])
+        lanes.charge(entry[0], 100)
+        entry = lanes.pop()
+    assert order == ["pong", "inv", "block"], u"Lanes not served in priority order"
+    assert len(lanes) == 0, u"Items left in lanes"
+
+
+def test_lane_quotas():
+    quotas = {Lanes.LANE_CONTROL: 1000, Lanes.LANE_ANNOUNCE: 1000, Lanes.LANE_BULK: 1000}
+    lanes = Lanes.SendLanes(quotas)
+    for i in range(10):
+        lanes.put(Lanes.LANE_CONTROL, "control")
+        lanes.put(Lanes.LANE_BULK, "bulk")
+
+    order = []
+    for i in range(6):
+        lane, item = lanes.pop()
+        lanes.charge(lane, 500)
+        order.append(item)
+    assert order == ["control", "control", "bulk", "bulk", "control", "control"], \
+        u"Lanes did not share bandwidth by quota"
+
+    # A large bulk message uses several rounds of the bulk quota
+    lanes = Lanes.SendLanes(quotas)
+    lanes.put(Lanes.LANE_BULK, "bulk")
+    lanes.put(Lanes.LANE_BULK, "bulk")
+    lane, item = lanes.pop()
+    lanes.charge(lane, 5000)
+    for i in range(4):
+        lanes.put(Lanes.LANE_CONTROL, "control")
+    order = [lanes.pop()[1] for i in range(5)]
+    assert order == ["control"] * 4 + ["bulk"], u"Control messages delayed by bulk data"
+
+    try:
+        Lanes.SendLanes({Lanes.LANE_CONTROL: 1000, Lanes.LANE_ANNOUNCE: 0, Lanes.LANE_BULK: 1000})
+        assert False, u"Zero quota accepted"
+    except ValueError:
+        pass
+
+
+def get_tests():
+    return [
+        ("Lane Priority Test", test_lane_priority),
+        ("Lane Quota Test", test_lane_quotas)
+    ]
+
+
+def get_name():
+    return "Send Lanes Tests"
@@ -36,6 +36,23 @@ def run_test(test_module_name):
 
 run_test('difficulty_target_test')
 run_test('byte_array_codec_test')
+run_test('bitcoin_codec_test')
+run_test('timer_queue_test')
+run_test('ring_buffer_test')
+run_test('batch_channel_test')
+run_test('peer_send_test')
+run_test('send_lanes_test')
+run_test('buffer_accounting_test')
+run_test('buffer_pool_test')
+run_test('listener_test')
+run_test('peer_shards_test')
+run_test('connector_test')
+run_test('address_manager_test')
+run_test('connection_pool_test')
+run_test('latency_histogram_test')
+run_test('ping_manager_test')
+run_test('fast_path_test')
+run_test('async_manager_test')
 
 print
 print ("Test Results")
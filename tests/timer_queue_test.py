@@ -0,0 +1,61 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import network.timer_queue
+
+TQ = network.timer_queue
+
+
+def test_timer_order():
+    timers = TQ.TimerQueue()
+    fired = []
+    for delay in (5, 1, 3, 2, 4):
+        timers.call_at(100 + delay, fired.append, delay)
+
+    assert timers.get_deadline() == 101, u"Incorrect next deadline"
+    assert timers.run_due(100) == 0, u"Timer fired early"
+    assert timers.run_due(103) == 3, u"Incorrect number of timers fired"
+    assert fired == [1, 2, 3], u"Timers fired out of order"
+    assert timers.run_due(200) == 2, u"Incorrect number of timers fired"
+    assert fired == [1, 2, 3, 4, 5], u"Timers fired out of order"
+    assert timers.get_deadline() is None, u"Deadline reported for empty queue"
+
+
+def test_timer_cancel():
+    timers = TQ.TimerQueue()
+    fired = []
+    first = timers.call_at(10, fired.append, 1)
+    timers.call_at(20, fired.append, 2)
+    first.cancel()
+
+    assert timers.get_deadline() == 20, u"Cancelled timer reported as next deadline"
+    timers.run_due(30)
+    assert fired == [2], u"Cancelled timer fired"
+
+
+def test_timer_compact():
+    timers = TQ.TimerQueue()
+    fired = []
+    live = [timers.call_at(i, fired.append, i) for i in range(0, 1000, 10)]
+    cancelled = [timers.call_at(i, fired.append, i) for i in range(1, 1000)]
+    # Timers cancelled by a timer which is due with them do not fire
+    timers.call_at(0, lambda: [timer.cancel() for timer in cancelled])
+
+    assert len(timers) == len(live) + len(cancelled) + 1, u"Incorrect number of live timers"
+    timers.run_due(0)
+    assert len(timers) == len(live) - 1, u"Cancelled timers counted as live"
+    assert timers.run_due(1000) == len(live) - 1, u"Incorrect number of timers fired"
+    assert fired == list(range(0, 1000, 10)), u"Cancelled timer fired"
+    live[0].cancel()
+    assert len(timers) == 0, u"Fired timer cancelled again"
+
+
+def get_tests():
+    return [
+        ("Timer Order Test", test_timer_order),
+        ("Timer Cancel Test", test_timer_cancel),
+        ("Timer Compact Test", test_timer_compact)
+    ]
+
+
+def get_name():
+    return "Timer Queue Tests"